@@ -0,0 +1,314 @@
+#!/usr/bin/python
+"""Benchmarks the host-side hot paths for every devkit family.
+
+usage: benchmark.py [options]
+options:
+    --baseline=FILE   baseline results (default: benchmark_baseline.json
+                      in the same directory as this script)
+    --save            store the results as the new baseline
+    --tolerance=0.3   allowed relative regression before failing
+    --min-time=0.5    minimum time (seconds) spent measuring each operation
+    --case=NAME       only run cases whose name contains NAME (repeatable)
+    --no-synthetic    only run the samples shipped with the test suite
+
+Each operation runs in a forked process, so that its peak memory usage can be
+measured in isolation. Operations measured:
+    parse     hexfile.load into a devkit which discards the data
+    model     DevKitModel.write of every record of the image
+    fix       DevKitModel.fix_bootloader
+    transfer  DevKitModel.transfer to an in-memory device
+
+Exits with status 1 if any operation got slower (or used more memory) than
+the baseline allows. Baselines are machine-dependent: regenerate them with
+--save whenever the benchmarking machine changes, and also along with any
+change which intentionally makes an operation faster or slower (commit the
+new baseline with it), otherwise later regressions are hidden by the gain
+or reported against stale figures."""
+import os, re, sys, copy, json, time, random, struct, getopt, logging, resource
+import multiprocessing
+from binascii import unhexlify
+from StringIO import StringIO
+from mikroeuhb import devkit, hexfile
+from mikroeuhb.bootinfo import BootInfo, pack
+from mikroeuhb.device import Device
+from mikroeuhb.tests.device import FakeDevFile, gzresource, \
+    STM32Program, PIC18Program, DSPIC33Program, PIC32Program
+
+def shipped(testcase):
+    """Case built from one of the samples shipped with the test suite"""
+    raw = unhexlify(re.sub(r'\s+', '', testcase.bootinfo))
+    return {'bootinfo': dict(BootInfo(raw)),
+            'hexdata': lambda: gzresource(testcase.hexfile).read()}
+
+def synthetic(bootinfo, base_addr, size, pic24=False):
+    """Case built from size bytes of random data, written from base_addr
+       (as seen by the program) onwards"""
+    return {'bootinfo': bootinfo,
+            'hexdata': lambda: synth_hex(base_addr, size, pic24)}
+
+def synth_hex(base_addr, size, pic24=False, rec_len=16, seed=0):
+    """Return an Intel HEX image containing size bytes of random data.
+       If pic24 is True, every fourth byte is a null padding byte."""
+    rnd = random.Random(seed)
+    data = bytearray(unhexlify('%0*x' % (2*size, rnd.getrandbits(8*size))))
+    if pic24:
+        data[3::4] = b'\x00' * len(data[3::4])
+    out = []
+    def record(addr, record_type, payload):
+        rec = bytearray(struct.pack('>BHB', len(payload), addr, record_type)) + payload
+        rec.append(-sum(rec) & 0xff)
+        out.append(':' + bytes(rec).encode('hex').upper() + '\n')
+    upper = None
+    for off in xrange(0, size, rec_len):
+        addr = base_addr + off
+        if addr >> 16 != upper:
+            upper = addr >> 16
+            record(0, 0x04, bytearray(struct.pack('>H', upper)))
+        record(addr & 0xffff, 0x00, data[off:off+rec_len])
+    record(0, 0x01, bytearray())
+    return ''.join(out)
+
+cases = [
+    ('stm32calc',     shipped(STM32Program)),
+    ('pic18ledblink', shipped(PIC18Program)),
+    ('dspic33calc',   shipped(DSPIC33Program)),
+    ('pic32calc',     shipped(PIC32Program)),
+]
+synthetic_cases = [
+    ('arm-2m',    synthetic({'McuType': 'ARM', 'EraseBlock': 0x1000,
+                             'BootStart': 0x1f0000, 'McuSize': 0x200000},
+                            0, 0x1f0000 - 0x1000)),
+    ('stm32-896k', synthetic({'McuType': 'STM32F4XX', 'EraseBlock': 0x4000,
+                              'BootStart': 0xe0000, 'McuSize': 0x100000},
+                             0x08000000, 0xe0000 - 0x20000)),
+    ('pic18-128k', synthetic({'McuType': 'PIC18', 'EraseBlock': 0x40,
+                              'BootStart': 0x1e000, 'McuSize': 0x20000},
+                             0, 0x1d000)),
+    ('dspic33-688k', synthetic({'McuType': 'DSPIC33', 'EraseBlock': 0xc00,
+                                'BootStart': 0x54000, 'McuSize': 0x80400},
+                               0, 2*0x50000, pic24=True)),
+    ('pic32-512k', synthetic({'McuType': 'PIC32', 'EraseBlock': 0x1000,
+                              'BootStart': 0x9d07c000, 'McuSize': 0x80000},
+                             0x1d000000, 0x7a000)),
+    ('pic32mz-2m', synthetic({'McuType': 'PIC32MZ', 'EraseBlock': 0x4000,
+                              'BootStart': 0x9d1fc000, 'McuSize': 0x200000},
+                             0x1d000000, 0x1f0000)),
+]
+
+class PacketCounter(object):
+    """Stands in for FakeDevFile.transfers, counting packets instead
+       of keeping their hexlified contents"""
+    def __init__(self):
+        self.count = 0
+    def append(self, item):
+        self.count += 1
+
+class CountingDevFile(FakeDevFile):
+    """In-memory device which is already in bootloader mode"""
+    def __init__(self, bootinfo):
+        FakeDevFile.__init__(self, pack(bootinfo))
+        self.transfers = PacketCounter()
+        self.bootloadermode = True
+
+class NullDevKit(object):
+    """Records the data written by hexfile.load, but does nothing else"""
+    def __init__(self):
+        self.records = []
+        self.size = 0
+    def write(self, addr, data):
+        self.records.append((addr, data))
+        self.size += len(data)
+
+def _lines(data):
+    f = StringIO(data)
+    f.xreadlines = f.readlines
+    return f
+
+def _loaded(bootinfo, records):
+    kit = devkit.factory(bootinfo)
+    for addr, data in records:
+        kit.write(addr, data)
+    return kit
+
+def _transfer(kit, f):
+    kit.transfer(Device(f))
+    return f
+
+def _blocks_size(kit):
+    return sum([len(blk) for blk in kit.blocks.itervalues()])
+
+def _timeit(setup, op, min_time):
+    """Call op(setup()) repeatedly for at least min_time seconds. Returns
+       the best time of a single call and the result of the last call."""
+    best, spent, result = None, 0., None
+    while spent < min_time or best is None:
+        arg = setup()
+        t0 = time.time()
+        result = op(arg)
+        elapsed = time.time() - t0
+        spent += elapsed
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+def _reset_peak():
+    """Reset the peak RSS counter (Linux >= 4.0). Returns False if we
+       need to fall back to ru_maxrss."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except IOError:
+        return False
+
+def _peak_kb(resettable):
+    if resettable:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def measure(case, op, min_time):
+    """Measure a single operation, returning a dictionary of results"""
+    bootinfo = case['bootinfo']
+    hexdata = case['hexdata']()
+    parsed = NullDevKit()
+    hexfile.load(_lines(hexdata), parsed)
+    loaded = _loaded(bootinfo, parsed.records) if op in ('fix', 'transfer') else None
+    if op == 'transfer':
+        loaded.fix_bootloader()
+    resettable = _reset_peak()
+    packets = 0
+    if op == 'parse':
+        best, _ = _timeit(lambda: _lines(hexdata),
+                          lambda f: hexfile.load(f, NullDevKit()), min_time)
+        size = parsed.size
+    elif op == 'model':
+        best, kit = _timeit(lambda: None,
+                            lambda _: _loaded(bootinfo, parsed.records), min_time)
+        size = parsed.size
+    elif op == 'fix':
+        best, kit = _timeit(lambda: copy.deepcopy(loaded),
+                            lambda kit: kit.fix_bootloader() or kit, min_time)
+        size = _blocks_size(kit)
+    elif op == 'transfer':
+        best, f = _timeit(lambda: CountingDevFile(bootinfo),
+                          lambda f: _transfer(loaded, f), min_time)
+        size = _blocks_size(loaded)
+        packets = f.transfers.count
+    best = max(best, 1e-9)
+    return {'ops_per_sec': 1./best,
+            'bytes_per_sec': size/best,
+            'packets_per_sec': packets/best,
+            'peak_kb': _peak_kb(resettable)}
+
+def _measure_child(conn, case, op, min_time):
+    try:
+        conn.send(measure(case, op, min_time))
+    except Exception as e:
+        conn.send({'error': '%s: %s' % (type(e).__name__, e)})
+    conn.close()
+
+def measure_isolated(case, op, min_time):
+    """Run measure() in a separate process"""
+    parent_conn, child_conn = multiprocessing.Pipe(False)
+    p = multiprocessing.Process(target=_measure_child,
+                                args=(child_conn, case, op, min_time))
+    p.start()
+    result = parent_conn.recv()
+    p.join()
+    return result
+
+def compare(name, result, baseline, tolerance):
+    """Return a list of regressions of result in relation to baseline"""
+    regressions = []
+    if name not in baseline:
+        return regressions
+    base = baseline[name]
+    if result['ops_per_sec'] < base['ops_per_sec'] * (1. - tolerance):
+        regressions.append('%s: %.1f ops/sec (baseline %.1f)' % (
+            name, result['ops_per_sec'], base['ops_per_sec']))
+    # Memory measurements have some noise, hence the extra slack
+    if result['peak_kb'] > base['peak_kb'] * (1. + tolerance) + 1024:
+        regressions.append('%s: peak memory %d KiB (baseline %d KiB)' % (
+            name, result['peak_kb'], base['peak_kb']))
+    return regressions
+
+def main():
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'h',
+                                   ['help', 'baseline=', 'save', 'tolerance=',
+                                    'min-time=', 'case=', 'no-synthetic'])
+    except getopt.GetoptError as err:
+        sys.stderr.write(str(err) + '\n' + __doc__)
+        sys.exit(1)
+
+    baseline_file = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                 'benchmark_baseline.json')
+    save = False
+    tolerance = 0.3
+    min_time = 0.5
+    filters = []
+    selected = cases + synthetic_cases
+
+    for o, a in opts:
+        if o in ('-h', '--help'):
+            sys.stderr.write(__doc__)
+            sys.exit()
+        elif o == '--baseline':
+            baseline_file = a
+        elif o == '--save':
+            save = True
+        elif o == '--tolerance':
+            tolerance = float(a)
+        elif o == '--min-time':
+            min_time = float(a)
+        elif o == '--case':
+            filters.append(a)
+        elif o == '--no-synthetic':
+            selected = cases
+        else: assert(False)
+
+    logging.basicConfig(level=logging.ERROR)
+    if filters:
+        selected = [(name, case) for name, case in selected
+                    if any([f in name for f in filters])]
+
+    baseline = {}
+    if os.path.exists(baseline_file):
+        with open(baseline_file) as f:
+            baseline = json.load(f)
+
+    results = {}
+    regressions = []
+    print('%-24s %12s %14s %14s %10s' % ('case/op', 'ops/sec', 'bytes/sec',
+                                         'packets/sec', 'peak KiB'))
+    for case_name, case in selected:
+        for op in ('parse', 'model', 'fix', 'transfer'):
+            name = '%s/%s' % (case_name, op)
+            result = measure_isolated(case, op, min_time)
+            if 'error' in result:
+                regressions.append('%s: %s' % (name, result['error']))
+                print('%-24s %s' % (name, result['error']))
+                continue
+            results[name] = result
+            print('%-24s %12.1f %14.0f %14.0f %10d' % (
+                name, result['ops_per_sec'], result['bytes_per_sec'],
+                result['packets_per_sec'], result['peak_kb']))
+            sys.stdout.flush()
+            regressions += compare(name, result, baseline, tolerance)
+
+    if save:
+        baseline.update(results)
+        with open(baseline_file, 'w') as f:
+            json.dump(baseline, f, indent=1, sort_keys=True,
+                      separators=(',', ': '))
+            f.write('\n')
+        print('baseline saved to %s' % baseline_file)
+    elif regressions:
+        sys.stderr.write('\nREGRESSIONS DETECTED:\n' +
+                         ''.join(['    %s\n' % r for r in regressions]))
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
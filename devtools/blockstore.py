@@ -0,0 +1,82 @@
+#!/usr/bin/python
+"""Manages a store of images prepared for programming (see
+mikroeuhb/blockstore.py), in which blocks shared by several images are
+kept once.
+
+usage: blockstore.py [options] DIR add NAME BOOTINFO file.hex [file.hex ...]
+       blockstore.py DIR list
+       blockstore.py DIR stats
+       blockstore.py DIR remove NAME [NAME ...]
+       blockstore.py DIR gc
+options:
+    --overlap=POLICY    for add, what to do if several hex files overlap:
+                        error (default), last-wins or first-wins
+    --disable-bootloader
+                        for add, prepare the image as mikroe-uhb
+                        --disable-bootloader would (use with caution)
+
+BOOTINFO is a hex string (as in mikroeuhb/tests/device.py) or a file
+containing either a hex string or the raw response to INFO. Images
+added to DIR may be programmed with mikroe-uhb --store=DIR NAME."""
+import sys, getopt, logging
+from mikroeuhb import planner
+from mikroeuhb.blockstore import BlockStore
+from mikroeuhb.bootinfo import BootInfo
+from mikroeuhb.devkit import ImageError
+from mikroeuhb.image import Image, OverlapError
+
+def main():
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'h',
+                                   ['help', 'overlap=', 'disable-bootloader'])
+    except getopt.GetoptError as err:
+        sys.stderr.write(str(err) + '\n' + __doc__)
+        sys.exit(1)
+    overlap, disable_bootloader = 'error', False
+    for o, a in opts:
+        if o in ('-h', '--help'):
+            sys.stderr.write(__doc__)
+            sys.exit()
+        elif o == '--overlap':
+            overlap = a
+        elif o == '--disable-bootloader':
+            disable_bootloader = True
+        else: assert(False)
+    if len(args) < 2:
+        sys.stderr.write(__doc__)
+        sys.exit(1)
+
+    logging.basicConfig(level=logging.WARNING)
+    store, command = BlockStore(args[0]), args[1]
+    if command == 'add' and len(args) >= 5:
+        bootinfo = BootInfo(planner.read_bootinfo(args[3]))
+        try:
+            image = Image(overlap)
+            for filename in args[4:]:
+                with open(filename, 'r') as f:
+                    image.add(f)
+            manifest = store.add(args[2], bootinfo, image.freeze(), disable_bootloader)
+        except (ImageError, OverlapError) as err:
+            sys.stderr.write(str(err) + '\n')
+            sys.exit(1)
+        print('%s: %d blocks' % (args[2], len(manifest.blocks)))
+    elif command == 'list' and len(args) == 2:
+        for name in store.names():
+            manifest = store.manifest(name)
+            print('%-30s %-12s %4d blocks' % (name, manifest.bootinfo['McuType'],
+                                              len(manifest.blocks)))
+    elif command == 'stats' and len(args) == 2:
+        stats = store.stats()
+        print('%(images)d images referring to %(blocks)d blocks (%(bytes)d bytes), '
+              'stored as %(unique)d unique blocks (%(stored_bytes)d bytes)' % stats)
+    elif command == 'remove' and len(args) >= 3:
+        for name in args[2:]:
+            store.remove(name)
+    elif command == 'gc' and len(args) == 2:
+        print('%d blocks removed' % store.gc())
+    else:
+        sys.stderr.write(__doc__)
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
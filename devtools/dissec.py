@@ -1,8 +1,28 @@
 #!/usr/bin/python
-"""A standalone dissector for files processed by usbcap.awk"""
-import sys, struct
+"""A streaming dissector for UHB captures.
+
+usage: dissec.py [options] [capture]
+options:
+    -s | --stats-only     do not print each packet, only the final statistics
+    --device=BUS:DEV      only dissect transfers of the given USB device
+    --erase-block=0x4000  buffer size assumed until an INFO reply is seen
+
+The capture is read from stdin if no file is supplied. Supported formats:
+    - lines in the format output by usbcap.awk (and used by FakeDevFile),
+      optionally prefixed by a timestamp in seconds
+    - usbmon text (/sys/kernel/debug/usb/usbmon/Nu) -- note that usbmon
+      only shows the first 32 bytes of each transfer in this format
+    - usbmon binary, as read from /dev/usbmonN
+    - pcap and pcapng files containing usbmon packets (LINKTYPE_USB_LINUX
+      or LINKTYPE_USB_LINUX_MMAPPED), e.g. saved by Wireshark or tcpdump
+
+Captures are processed one packet at a time, so memory usage does not
+depend on the size of the capture. A truncated last record (e.g. of a
+capture still being written) is ignored."""
+import sys, struct, getopt
 from binascii import hexlify, unhexlify
-EraseBlock = 0x4000  # change according to the one reported by the device
+from mikroeuhb.bootinfo import BootInfo
+
 cmd_enum = {
     1: 'SYNC',
     2: 'INFO',
@@ -11,39 +31,330 @@ cmd_enum = {
     11: 'WRITE',
     21: 'ERASE',
 }
-idle = True
-counter, buf_size = 0, 0
-for line in sys.stdin.readlines():
-    direction, data = line.strip().split(' ', 2)
-    data = unhexlify(data)
-    assert(direction in ('i','o'))
-    if direction == 'i':
-        if data in (b'\x00', b'\x02'):
-            print('In: USB RESET')
-        elif data[0:1] == b'\x0f':
-            cmd = ord(data[1:2])
-            print('In: ACK: %5s (%02x)' % (cmd_enum[cmd], cmd))
+
+# Readers: generators of (timestamp, direction, data, length) tuples, where
+# timestamp may be None, direction is 'i' or 'o', and length is the length
+# of the transfer (data may be truncated in some capture formats).
+
+def _unhexlify(s):
+    """Decode hex digits, returning None if they were cut in the middle"""
+    try:
+        return unhexlify(s)
+    except (TypeError, ValueError):
+        return None
+
+def read_text(f, device=None):
+    """Read usbcap.awk or usbmon text captures"""
+    for line in f:
+        if not isinstance(line, str):
+            line = line.decode('ascii')
+        fields = line.split()
+        if not fields:
+            continue
+        if fields[0] in ('i', 'o') and len(fields) >= 2:
+            data = _unhexlify(fields[1])
+            if data is not None:
+                yield None, fields[0], data, len(data)
+        elif len(fields) >= 3 and fields[1] in ('i', 'o'):
+            data = _unhexlify(fields[2])
+            if data is not None:
+                yield float(fields[0]), fields[1], data, len(data)
+        elif len(fields) >= 6 and fields[2] in ('S', 'C'):
+            # usbmon text: tag timestamp event addr status length [= words]
+            addr = fields[3].split(':')
+            if addr[0] not in ('Ii', 'Io'):
+                continue
+            if device and (int(addr[1]), int(addr[2])) != device:
+                continue
+            direction = addr[0][1]
+            if (fields[2], direction) not in (('S', 'o'), ('C', 'i')):
+                continue
+            if len(fields) < 8 or fields[6] != '=':
+                continue
+            data = _unhexlify(''.join(fields[7:]))
+            if data is not None:
+                yield int(fields[1]) * 1e-6, direction, data, int(fields[5])
+
+_usbmon_hdr = struct.Struct('<QcBBBHccqiiII8s')
+assert(_usbmon_hdr.size == 48)
+
+def _usbmon_event(pkt, device=None):
+    """Parse an usbmon binary event, returning None if it should be ignored"""
+    (_, event, xfer_type, epnum, devnum, busnum, _, flag_data,
+     ts_sec, ts_usec, _, length, len_cap, _) = _usbmon_hdr.unpack_from(pkt)
+    if xfer_type != 1 or len_cap == 0:  # only interrupt transfers with data
+        return None
+    if device and (busnum, devnum) != device:
+        return None
+    direction = 'i' if epnum & 0x80 else 'o'
+    if (event, direction) not in ((b'S', 'o'), (b'C', 'i')):
+        return None
+    return ts_sec + ts_usec * 1e-6, direction, pkt[48:48+len_cap], length
+
+def read_usbmon(f, device=None):
+    """Read events from a /dev/usbmonN device"""
+    while True:
+        hdr = f.read(48)
+        if len(hdr) < 48:
+            return
+        len_cap, = struct.unpack_from('<I', hdr, 36)
+        data = f.read(len_cap)
+        if len(data) < len_cap:
+            return
+        ev = _usbmon_event(hdr + data, device)
+        if ev:
+            yield ev
+
+def _usbmon_hdr_len(linktype):
+    if linktype not in (189, 220):
+        raise IOError('unsupported link-layer type %d' % linktype)
+    return 48 if linktype == 189 else 64
+
+def _strip_hdr(pkt, hdr_len):
+    """Drop the extra fields of LINKTYPE_USB_LINUX_MMAPPED headers,
+       so that _usbmon_event can parse the packet"""
+    return pkt[:48] + pkt[hdr_len:]
+
+def read_pcap(f, magic, device=None):
+    """Read a pcap file (after its magic number was consumed)"""
+    endian = '<' if magic in (b'\xd4\xc3\xb2\xa1', b'\x4d\x3c\xb2\xa1') else '>'
+    _, _, _, _, _, linktype = struct.unpack(endian + 'HHiIII', f.read(20))
+    hdr_len = _usbmon_hdr_len(linktype)
+    while True:
+        rec = f.read(16)
+        if len(rec) < 16:
+            return
+        _, _, incl_len, _ = struct.unpack(endian + 'IIII', rec)
+        pkt = f.read(incl_len)
+        if len(pkt) < incl_len:
+            return
+        ev = _usbmon_event(_strip_hdr(pkt, hdr_len), device)
+        if ev:
+            yield ev
+
+def read_pcapng(f, device=None):
+    """Read a pcapng file (after the type of the first block was consumed)"""
+    block_type = 0x0a0d0d0a
+    endian = '<'
+    linktypes = {}
+    while True:
+        if block_type == 0x0a0d0d0a:  # section header: check byte order
+            raw_len = f.read(4)
+            bom = f.read(4)
+            endian = '<' if bom == b'\x4d\x3c\x2b\x1a' else '>'
+            block_len, = struct.unpack(endian + 'I', raw_len)
+            body = f.read(block_len - 12)
+            linktypes = {}
         else:
-            print('In: BootInfo? (len=%d)' % ord(data[0:1]))
-    else:
-        if idle:
-            stx, cmd, addr, counter = struct.unpack('<BBLH', data[:8])
+            raw_len = f.read(4)
+            if len(raw_len) < 4:
+                return
+            block_len, = struct.unpack(endian + 'I', raw_len)
+            body = f.read(block_len - 8)
+            if len(body) < block_len - 8:
+                return
+            if block_type == 1:  # interface description
+                linktype, = struct.unpack_from(endian + 'H', body)
+                linktypes[len(linktypes)] = linktype
+            elif block_type == 6:  # enhanced packet
+                iface, _, _, cap_len, _ = struct.unpack_from(endian + 'IIIII', body)
+                linktype = linktypes[iface]
+                if linktype in (189, 220):
+                    pkt = body[20:20+cap_len]
+                    ev = _usbmon_event(_strip_hdr(pkt, _usbmon_hdr_len(linktype)),
+                                       device)
+                    if ev:
+                        yield ev
+        raw_type = f.read(4)
+        if len(raw_type) < 4:
+            return
+        block_type, = struct.unpack(endian + 'I', raw_type)
+
+class _Chain(object):
+    """File-like object which first returns some already read bytes"""
+    def __init__(self, head, f):
+        self.head, self.f = head, f
+    def read(self, size):
+        data, self.head = self.head[:size], self.head[size:]
+        if len(data) < size:
+            data += self.f.read(size - len(data))
+        return data
+    def __iter__(self):
+        if self.head:
+            line = self.head + self.f.readline()
+            self.head = b''
+            yield line
+        for line in self.f:
+            yield line
+
+def open_capture(f, device=None):
+    """Detect the capture format and return the adequate reader"""
+    if hasattr(f, 'name') and f.name.startswith('/dev/usbmon'):
+        return read_usbmon(f, device)
+    magic = f.read(4)
+    if magic in (b'\xd4\xc3\xb2\xa1', b'\xa1\xb2\xc3\xd4',
+                 b'\x4d\x3c\xb2\xa1', b'\xa1\xb2\x3c\x4d'):
+        return read_pcap(f, magic, device)
+    if magic == b'\x0a\x0d\x0d\x0a':
+        return read_pcapng(f, device)
+    return read_text(_Chain(magic, f), device)
+
+class Stats(object):
+    """Accumulates timing statistics of each command type"""
+    def __init__(self):
+        self.cmds = {}         # name -> [count, total, max duration, max gap]
+        self.write_bytes = 0
+        self.write_time = 0.
+        self.first = self.last = None
+        self.packets = 0
+    def packet(self, ts):
+        self.packets += 1
+        if ts is not None:
+            if self.first is None:
+                self.first = ts
+            self.last = ts
+    def command(self, name, duration, max_gap, nbytes=0):
+        s = self.cmds.setdefault(name, [0, 0., 0., 0.])
+        s[0] += 1
+        s[1] += duration
+        s[2] = max(s[2], duration)
+        s[3] = max(s[3], max_gap)
+        if name == 'WRITE':
+            self.write_bytes += nbytes
+            self.write_time += duration
+    def report(self, out):
+        out.write('\n%d packets' % self.packets)
+        if self.first is None:
+            out.write(' (no timestamps available)\n')
+            return
+        elapsed = self.last - self.first
+        out.write(' in %.3f s (%.1f packets/s)\n' % (
+            elapsed, self.packets / elapsed if elapsed else 0))
+        out.write('%-7s %7s %10s %10s %10s %10s\n' % (
+            'command', 'count', 'total ms', 'mean ms', 'max ms', 'max gap'))
+        for name in sorted(self.cmds):
+            count, total, max_t, max_gap = self.cmds[name]
+            out.write('%-7s %7d %10.1f %10.3f %10.3f %10.3f\n' % (
+                name, count, total * 1e3, total * 1e3 / count,
+                max_t * 1e3, max_gap * 1e3))
+        if self.write_time:
+            out.write('WRITE throughput: %.0f bytes/s\n' % (
+                self.write_bytes / self.write_time))
+
+class Dissector(object):
+    def __init__(self, out, erase_block=0x4000, verbose=True):
+        self.out = out
+        self.verbose = verbose
+        self.erase_block = erase_block
+        self.erase_block_known = False
+        self.stats = Stats()
+        self.idle = True
+        self.counter = self.buf_size = 0
+        self.current = None   # (name, start ts, last ts, max gap, bytes)
+        self.last_cmd = None
+
+    def _print(self, ts, msg):
+        if self.verbose:
+            if ts is not None:
+                self.out.write('%.6f ' % ts)
+            self.out.write(msg + '\n')
+
+    def _touch(self, ts):
+        if self.current and ts is not None:
+            name, start, last, max_gap, nbytes = self.current
+            self.current = (name, start, ts, max(max_gap, ts - last), nbytes)
+
+    def _finish(self, ts):
+        """Account the duration of the current command"""
+        if self.current is None:
+            return
+        name, start, last, max_gap, nbytes = self.current
+        self.current = None
+        if start is None:
+            return
+        self.stats.command(name, last - start, max_gap, nbytes)
+        self._print(None, '  %s took %.3f ms (max gap %.3f ms)' % (
+            name, (last - start) * 1e3, max_gap * 1e3))
+
+    def feed(self, ts, direction, data, length):
+        self.stats.packet(ts)
+        self._touch(ts)
+        if direction == 'i':
+            if data in (b'\x00', b'\x02'):
+                self._print(ts, 'In: USB RESET')
+            elif data[0:1] == b'\x0f':
+                cmd = ord(data[1:2])
+                self._print(ts, 'In: ACK: %5s (%02x)' % (cmd_enum.get(cmd, '?'), cmd))
+                if self.idle:
+                    self._finish(ts)
+            else:
+                info = BootInfo(data)
+                if self.last_cmd == 'INFO' and 'EraseBlock' in info:
+                    self.erase_block = info['EraseBlock']
+                    self.erase_block_known = True
+                self._print(ts, 'In: BootInfo (len=%d): %s' % (
+                    ord(data[0:1]), ', '.join(repr(info).strip().split('\n'))))
+                self._finish(ts)
+        elif self.idle:
+            self._finish(ts)
+            stx, cmd, addr, self.counter = struct.unpack('<BBLH', data[:8])
             assert(stx == 0x0f)
             cmd = cmd_enum[cmd]
-            print('Out: CMD %5s (addr=0x%08x counter=0x%04x)' % (cmd, addr, counter))
+            self.last_cmd = cmd
+            self._print(ts, 'Out: CMD %5s (addr=0x%08x counter=0x%04x)' % (
+                cmd, addr, self.counter))
+            self.current = (cmd, ts, ts, 0., self.counter if cmd == 'WRITE' else 0)
             if cmd == 'WRITE':
-                buf_size = EraseBlock
-                idle = False
+                if not self.erase_block_known:
+                    sys.stderr.write('warning: WRITE before INFO reply, assuming '
+                                     'EraseBlock = 0x%x\n' % self.erase_block)
+                    self.erase_block_known = True
+                self.buf_size = self.erase_block
+                self.idle = False
+            elif cmd == 'REBOOT':
+                self._finish(ts)
         else:
-            read_len = min(counter, len(data))
-            print('Out: Data %s' % hexlify(data[:read_len]).upper().decode('ascii'))
-            counter -= read_len
-            buf_size -= read_len
-            assert(buf_size >= 0)
-            assert(counter >= 0)
-            if buf_size == 0 or counter == 0:
-                buf_size = EraseBlock
-                print('Expecting ACK')
-            if counter == 0:
-                idle = True
-            
+            read_len = min(self.counter, length)
+            shown = hexlify(data[:read_len]).upper().decode('ascii')
+            if read_len > len(data):
+                shown += '...'
+            self._print(ts, 'Out: Data %s' % shown)
+            self.counter -= read_len
+            self.buf_size -= read_len
+            assert(self.buf_size >= 0)
+            assert(self.counter >= 0)
+            if self.buf_size == 0 or self.counter == 0:
+                self.buf_size = self.erase_block
+                self._print(None, 'Expecting ACK')
+            if self.counter == 0:
+                self.idle = True
+
+def main():
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'hs',
+                                   ['help', 'stats-only', 'device=', 'erase-block='])
+    except getopt.GetoptError as err:
+        sys.stderr.write(str(err) + '\n' + __doc__)
+        sys.exit(1)
+    verbose = True
+    device = None
+    erase_block = 0x4000
+    for o, a in opts:
+        if o in ('-h', '--help'):
+            sys.stderr.write(__doc__)
+            sys.exit()
+        elif o in ('-s', '--stats-only'):
+            verbose = False
+        elif o == '--device':
+            device = tuple([int(x) for x in a.split(':')])
+        elif o == '--erase-block':
+            erase_block = int(a, 0)
+        else: assert(False)
+    f = open(args[0], 'rb') if args else getattr(sys.stdin, 'buffer', sys.stdin)
+    dissector = Dissector(sys.stdout, erase_block, verbose)
+    for ts, direction, data, length in open_capture(f, device):
+        dissector.feed(ts, direction, data, length)
+    dissector.stats.report(sys.stdout)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+#!/usr/bin/python
+"""Queries the session history recorded by mikroe-uhb --history.
+
+usage: history.py [options] history.db command
+commands:
+    throughput      daily throughput of successful sessions
+    erases          how many times each block of each board was erased
+options:
+    --by=KEY        group throughput by station (default), hub, family or mcu
+    --days=N        only consider sessions of the last N days
+    --limit=N       only show the N most erased blocks"""
+import sys, getopt
+from mikroeuhb.history import History, groupings
+
+def main():
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'h',
+                                   ['help', 'by=', 'days=', 'limit='])
+    except getopt.GetoptError as err:
+        sys.stderr.write(str(err) + '\n' + __doc__)
+        sys.exit(1)
+    by, days, limit = 'station', None, None
+    for o, a in opts:
+        if o in ('-h', '--help'):
+            sys.stderr.write(__doc__)
+            sys.exit()
+        elif o == '--by':
+            if a not in groupings:
+                sys.stderr.write('invalid grouping: %s\n' % a + __doc__)
+                sys.exit(1)
+            by = a
+        elif o == '--days':
+            days = float(a)
+        elif o == '--limit':
+            limit = int(a)
+        else: assert(False)
+    if len(args) != 2 or args[1] not in ('throughput', 'erases'):
+        sys.stderr.write(__doc__)
+        sys.exit(1)
+
+    history = History(args[0])
+    if args[1] == 'throughput':
+        print('%-24s %-10s %8s %12s %10s' % (by, 'day', 'sessions', 'bytes', 'KiB/s'))
+        for key, day, sessions, nbytes, rate in history.throughput(by, days):
+            print('%-24s %-10s %8d %12d %10.1f' % (key, day, sessions, nbytes,
+                                                   rate / 1024.))
+    else:
+        print('%-16s %-12s %-12s %6s %8s' % ('station', 'port', 'mcu', 'block', 'erases'))
+        for station, port, mcu, blk, count in history.erase_counts(limit):
+            print('%-16s %-12s %-12s %6d %8d' % (station, port, mcu, blk, count))
+
+if __name__ == '__main__':
+    main()
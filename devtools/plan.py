@@ -0,0 +1,111 @@
+#!/usr/bin/python
+"""Plans a programming session without any device attached.
+
+usage: plan.py [options] bootinfo file.hex [file.hex ...]
+options:
+    --diff=OLD.hex      plan the update of a device last programmed with
+                        OLD.hex (may be given several times), reporting
+                        which blocks differ
+    --json              output the plan as JSON
+    --calibrate=FILE    adjust the timing profile to the durations measured
+                        in a session saved by mikroe-uhb --profile-json=FILE
+    --erase-block-time=SECONDS, --erase-kib-time=SECONDS,
+    --write-kib-time=SECONDS, --hid-interval=SECONDS
+                        override parameters of the timing profile
+    --overlap=POLICY    what to do if several hex files overlap:
+                        error (default), last-wins or first-wins
+    --only-range=RANGE, --exclude-range=RANGE
+                        as in mikroe-uhb
+
+bootinfo is a hex string (as in mikroeuhb/tests/device.py) or a file
+containing either a hex string or the raw response to INFO. Prints every
+ERASE and WRITE command which would be sent, the number of reports
+exchanged, and an estimate of how long the session would take."""
+import sys, json, getopt, logging
+from mikroeuhb import planner, timing
+from mikroeuhb.bootinfo import BootInfo
+from mikroeuhb.devkit import AddressRange, ImageError, SelectionError
+from mikroeuhb.image import Image, OverlapError
+
+def load(filenames, overlap):
+    image = Image(overlap)
+    for filename in filenames:
+        with open(filename, 'r') as f:
+            image.add(f)
+    return image
+
+def main():
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'h',
+                                   ['help', 'diff=', 'json', 'calibrate=',
+                                    'erase-block-time=', 'erase-kib-time=',
+                                    'write-kib-time=', 'hid-interval=',
+                                    'overlap=', 'only-range=', 'exclude-range='])
+    except getopt.GetoptError as err:
+        sys.stderr.write(str(err) + '\n' + __doc__)
+        sys.exit(1)
+    old, as_json, calibration, overrides = [], False, None, {}
+    overlap, only, exclude = 'error', [], []
+    for o, a in opts:
+        if o in ('-h', '--help'):
+            sys.stderr.write(__doc__)
+            sys.exit()
+        elif o == '--diff':
+            old.append(a)
+        elif o == '--json':
+            as_json = True
+        elif o == '--calibrate':
+            calibration = a
+        elif o in ('--erase-block-time', '--erase-kib-time', '--write-kib-time',
+                   '--hid-interval'):
+            overrides[o[2:].replace('-', '_')] = float(a)
+        elif o == '--overlap':
+            overlap = a
+        elif o == '--only-range':
+            only.append(AddressRange.parse(a))
+        elif o == '--exclude-range':
+            exclude.append(AddressRange.parse(a))
+        else: assert(False)
+    if len(args) < 2:
+        sys.stderr.write(__doc__)
+        sys.exit(1)
+
+    logging.basicConfig(level=logging.WARNING)
+    bootinforaw = planner.read_bootinfo(args[0])
+    mcu = BootInfo(bootinforaw)['McuType']
+    try:
+        new = load(args[1:], overlap)
+        if old:
+            changed, plan = planner.diff(bootinforaw, load(old, overlap), new,
+                                         only=only, exclude=exclude)
+        else:
+            plan = planner.plan(bootinforaw, new, only=only, exclude=exclude)
+    except (ImageError, SelectionError, OverlapError) as err:
+        sys.stderr.write(str(err) + '\n')
+        sys.exit(1)
+
+    profile = timing.profile(mcu)
+    if calibration:
+        with open(calibration) as f:
+            profile = planner.calibrate(profile, json.load(f), plan.kit)
+    if overrides:
+        params = dict([(name, getattr(profile, name)) for name in
+                       ('erase_block_time', 'erase_kib_time', 'write_kib_time',
+                        'hid_interval')])
+        params.update(overrides)
+        profile = timing.TimingProfile(**params)
+
+    if as_json:
+        report = json.loads(plan.to_json(profile))
+        if old:
+            report['changed'] = [list(plan.kit._write_span(blk)) for blk in changed]
+        print(json.dumps(report, sort_keys=True))
+        return
+    if old:
+        print('%d of %d blocks differ' % (len(changed), len(plan.kit.blocks)))
+        for blk in changed:
+            print('    block %d: 0x%x-0x%x' % ((blk,) + plan.kit._write_span(blk)))
+    sys.stdout.write(plan.format_text(profile))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+#!/usr/bin/python
+"""Replays a capture against the current programming code.
+
+usage: replay.py [options] capture file.hex
+options:
+    --no-timing     serve responses immediately, even if the capture
+                    contains timestamps
+    --speed=1.0     divide the recorded device delays by this factor
+    --lenient       count divergences from the capture instead of aborting
+
+The capture must be in the format output by usbcap.awk (use -v timestamps=1
+to reproduce the recorded timing) and may be gzip compressed. Reports how
+long the session took, and how much of it was spent waiting for the device
+(as recorded) instead of running host-side code."""
+import sys, time, getopt, logging
+from gzip import GzipFile
+from mikroeuhb.device import Device
+from mikroeuhb.profiler import PhaseTimer
+from mikroeuhb.replay import ReplayDevFile
+
+def main():
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'h',
+                                   ['help', 'no-timing', 'speed=', 'lenient'])
+    except getopt.GetoptError as err:
+        sys.stderr.write(str(err) + '\n' + __doc__)
+        sys.exit(1)
+    timing, speed, strict = True, 1., True
+    for o, a in opts:
+        if o in ('-h', '--help'):
+            sys.stderr.write(__doc__)
+            sys.exit()
+        elif o == '--no-timing':
+            timing = False
+        elif o == '--speed':
+            speed = float(a)
+        elif o == '--lenient':
+            strict = False
+        else: assert(False)
+    if len(args) != 2:
+        sys.stderr.write(__doc__)
+        sys.exit(1)
+
+    logging.basicConfig(level=logging.WARNING)
+    capture = open(args[0], 'rb')
+    if args[0].endswith('.gz'):
+        capture = GzipFile(fileobj=capture, mode='rb')
+    f = ReplayDevFile(capture, timing=timing, speed=speed, strict=strict)
+    timer = PhaseTimer()
+    start = time.time()
+    Device(f, timer).program(open(args[1], 'r'), False)
+    elapsed = time.time() - start
+
+    sys.stdout.write(timer.format_summary())
+    sys.stdout.write('%d packets replayed, %d mismatches\n' % (f.packets, f.mismatches))
+    sys.stdout.write('total %.3f s: %.3f s waiting for the device, %.3f s host-side\n' % (
+        elapsed, f.device_wait, elapsed - f.device_wait))
+
+if __name__ == '__main__':
+    main()
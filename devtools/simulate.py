@@ -1,6 +1,6 @@
 # Simulates device programming
 # usage: simulate.py bootinfo file.hex
-from mikroeuhb.tests.device import FakeDevFile
+from mikroeuhb.tests.emulator import EmulatedDevFile
 from mikroeuhb.device import Device
 from mikroeuhb.bootinfo import BootInfo
 from binascii import unhexlify
@@ -13,8 +13,9 @@ assert(len(bootinforaw) % 2 == 0)
 bootinforaw += '00' * (64 - len(bootinforaw)/2)
 bootinforaw = unhexlify(bootinforaw)
 
-fakefile = FakeDevFile(bootinforaw)
+fakefile = EmulatedDevFile(bootinforaw)
 dev = Device(fakefile)
 dev.program(open(sys.argv[2]), False)
 
-print('\n'.join(fakefile.transfers))
\ No newline at end of file
+print('\n'.join(fakefile.transfers))
+sys.stderr.write('simulated time: %.3f s\n' % fakefile.time)
\ No newline at end of file
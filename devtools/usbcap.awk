@@ -5,11 +5,21 @@
 # the one used by mikroeuhb.tests.FakeDevFile.transfers. This way, captures
 # made when running mikrobootloader in a virtual machine can be compared
 # (using e.g. gvimdiff) to the behavior of this project.
+# Run with "-v timestamps=1" to prefix each line with the time (in seconds)
+# elapsed since the start of the capture, as understood by dissec.py.
+/field name="frame\.time_relative"/ {
+	if(match($0, /show="([0-9.]+)"/, a))
+		ts = a[1]
+}
 {
 	if(match($0, /Direction: (IN|OUT)/, a))
 		dir = a[1] == "IN" ? "i" : "o"
 }
 /field name="usb\.capdata"/ {
-	if(match($0, /value="([0-9a-f]+)"/, a))
-		print dir " " a[1]	
+	if(match($0, /value="([0-9a-f]+)"/, a)) {
+		if(timestamps)
+			print ts " " dir " " a[1]
+		else
+			print dir " " a[1]
+	}
 }
@@ -0,0 +1,74 @@
+#!/usr/bin/python
+"""Checks many hex files against the bootinfo of many devices at once,
+without any device attached.
+
+usage: validate.py [options] --bootinfo=BOOTINFO [...] file.hex [file.hex ...]
+options:
+    --bootinfo=[NAME=]BOOTINFO
+                        profile to check the files against (may be given
+                        several times); BOOTINFO is a hex string (as in
+                        mikroeuhb/tests/device.py) or a file containing
+                        either a hex string or the raw response to INFO
+    --jobs=N            number of processes (default: number of CPUs)
+    --overlap=POLICY    what to do if a hex file has overlapping records
+                        from several sources: error (default), last-wins
+                        or first-wins
+    --json              output the report as JSON
+    --strict            also fail if configuration data or padding bytes
+                        would be dropped
+
+Reports, for each file and profile, the data which does not fit into the
+memory of the device, the configuration data and padding bytes which
+would be dropped, the number of blocks which would be written and an
+estimate of how long programming would take. Exits with status 1 if any
+file does not fit into any of the devices. Configuration data is dropped
+by the bootloader, which is harmless for the configuration words of the
+MCU, but usually means that the image was built for another family."""
+import os, sys, getopt, logging
+from mikroeuhb import planner, validate
+from mikroeuhb.image import policies
+
+def main():
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'h',
+                                   ['help', 'bootinfo=', 'jobs=', 'overlap=', 'json',
+                                    'strict'])
+    except getopt.GetoptError as err:
+        sys.stderr.write(str(err) + '\n' + __doc__)
+        sys.exit(1)
+    profiles, jobs, overlap, as_json, strict = [], None, 'error', False, False
+    for o, a in opts:
+        if o in ('-h', '--help'):
+            sys.stderr.write(__doc__)
+            sys.exit()
+        elif o == '--bootinfo':
+            name, sep, arg = a.partition('=')
+            if not sep:
+                name, arg = os.path.basename(a), a
+            profiles.append((name, planner.read_bootinfo(arg)))
+        elif o == '--jobs':
+            jobs = int(a)
+        elif o == '--overlap':
+            if a not in policies:
+                sys.stderr.write('invalid overlap policy: %s\n' % a)
+                sys.exit(1)
+            overlap = a
+        elif o == '--json':
+            as_json = True
+        elif o == '--strict':
+            strict = True
+        else: assert(False)
+    if not profiles or not args:
+        sys.stderr.write(__doc__)
+        sys.exit(1)
+
+    logging.basicConfig(level=logging.WARNING)
+    reports = validate.matrix(args, profiles, jobs, overlap)
+    if as_json:
+        print(validate.to_json(reports, strict))
+    else:
+        sys.stdout.write(validate.format_text(reports))
+    sys.exit(1 if validate.failed(reports, strict) else 0)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,236 @@
+"""Content-addressed store of prepared images, for programs keeping many
+variants of a firmware (e.g. differing only in a configuration sector)
+ready to be programmed.
+
+Each erase block of a devkit model, after the bootloader fix, is stored
+once in a file named after the SHA-256 hash of its contents, under
+DIR/blocks. An image is a manifest (DIR/manifests/NAME.json) holding the
+bootinfo fields it was prepared for and the hash of each of its blocks.
+Within a process, each block file is mapped into memory once, however
+many images refer to it, and shared by the devkit models loaded from
+the store as a read-only Block. As the mappings are backed by the page
+cache, processes sharing a store also share the memory of its blocks."""
+import os, re, json, mmap, errno, hashlib, tempfile, threading
+import devkit, image
+
+_hash_re = re.compile(r'^[0-9a-f]{64}$')
+
+class ImageMismatch(ValueError):
+    """Raised when a stored image was prepared for a different device, or
+       with a different bootloader fix, than the one being programmed"""
+    pass
+
+def block_hash(data):
+    return hashlib.sha256(bytes(data)).hexdigest()
+
+class Block(object):
+    """Read-only view of a block stored in a BlockStore. Supports len(),
+       indexing and slicing, which return bytestrings, and conversion to
+       bytes, as needed by the devkit model to transfer it."""
+    __slots__ = ('digest', '_map')
+    def __init__(self, digest, mapping):
+        self.digest, self._map = digest, mapping
+
+    def __len__(self):
+        return len(self._map)
+
+    def __getitem__(self, key):
+        return self._map[key]
+
+    def __bytes__(self):
+        return self._map[:]
+    __str__ = __bytes__
+
+    def __repr__(self):
+        return '<Block %s>' % self.digest
+
+class Manifest(object):
+    """Blocks of an image prepared for a device: the bootinfo fields of the
+       device, the hash of each block (keyed by block number), the blocks
+       patched by the bootloader fix (as in DevKitModel.patched), and
+       whether the bootloader was disabled by the fix."""
+    fields = ('McuType', 'BootStart', 'EraseBlock', 'McuSize')
+
+    def __init__(self, bootinfo, blocks, patched, disable_bootloader=False):
+        self.bootinfo = dict([(str(k), v) for k, v in bootinfo.items()
+                              if k in self.fields])
+        self.bootinfo['McuType'] = str(self.bootinfo['McuType'])
+        self.blocks = dict([(int(blk), str(digest)) for blk, digest in blocks.items()])
+        self.patched = dict([(str(role), set(blks)) for role, blks in patched.items()])
+        self.disable_bootloader = disable_bootloader
+
+    def to_json(self):
+        return json.dumps({
+            'bootinfo': self.bootinfo,
+            'blocks': dict([(str(blk), digest) for blk, digest in self.blocks.items()]),
+            'patched': dict([(role, sorted(blks)) for role, blks in self.patched.items()]),
+            'disable_bootloader': self.disable_bootloader,
+        }, sort_keys=True)
+
+    @staticmethod
+    def from_json(s):
+        d = json.loads(s)
+        return Manifest(d['bootinfo'], d['blocks'], d['patched'],
+                        d.get('disable_bootloader', False))
+
+    def check(self, bootinfo):
+        """Raise ImageMismatch if the image was prepared for a device whose
+           memory differs from the one described by a bootinfo"""
+        for field in self.fields:
+            if bootinfo[field] != self.bootinfo[field]:
+                raise ImageMismatch('image was prepared for %s=%r, device has %r' % (
+                    field, self.bootinfo[field], bootinfo[field]))
+
+class StoredImage(object):
+    """Image loaded from a BlockStore, which may be supplied to
+       flash.flash (and Device.program) instead of an image.Image. As its
+       blocks were already fixed, it builds the devkit model itself."""
+    def __init__(self, store, name, manifest):
+        self.store, self.name, self.manifest = store, name, manifest
+
+    def model(self, bootinfo, disable_bootloader=False):
+        """Return a devkit model for the device described by bootinfo,
+           holding the blocks of the image"""
+        self.manifest.check(bootinfo)
+        if disable_bootloader != self.manifest.disable_bootloader:
+            raise ImageMismatch('image was prepared with disable_bootloader=%s' %
+                             self.manifest.disable_bootloader)
+        kit = devkit.factory(bootinfo)
+        for blk, digest in self.manifest.blocks.items():
+            kit.blocks[blk] = self.store.block(digest)
+        kit.patched = dict([(role, set(blks)) for role, blks
+                            in self.manifest.patched.items()])
+        return kit
+
+class BlockStore(object):
+    """Store of blocks and manifests kept in a directory. May be shared by
+       threads and by processes."""
+    def __init__(self, directory):
+        self.directory = directory
+        self._blocks = {}    # hash -> Block
+        self._lock = threading.Lock()
+        for sub in ('blocks', 'manifests'):
+            try:
+                os.makedirs(os.path.join(directory, sub))
+            except OSError as err:
+                if err.errno != errno.EEXIST:
+                    raise
+
+    def _block_path(self, digest):
+        return os.path.join(self.directory, 'blocks', digest[:2], digest[2:])
+
+    def _manifest_path(self, name):
+        if not name or os.sep in name or name.startswith('.'):
+            raise ValueError('invalid image name "%s"' % name)
+        return os.path.join(self.directory, 'manifests', name + '.json')
+
+    def _write(self, path, data):
+        """Write a file atomically, so that readers never see it partially
+           written"""
+        directory = os.path.dirname(path)
+        try:
+            os.makedirs(directory)
+        except OSError as err:
+            if err.errno != errno.EEXIST:
+                raise
+        fd, tmp = tempfile.mkstemp(dir=directory, prefix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.rename(tmp, path)
+        except:
+            os.unlink(tmp)
+            raise
+
+    def put(self, data):
+        """Store a block unless it is already stored, returning its hash"""
+        digest = block_hash(data)
+        path = self._block_path(digest)
+        if not os.path.exists(path):
+            self._write(path, bytes(data))
+        return digest
+
+    def block(self, digest):
+        """Return the Block with the given hash, mapping its file into
+           memory if this was not done before"""
+        with self._lock:
+            if digest not in self._blocks:
+                with open(self._block_path(digest), 'rb') as f:
+                    mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                self._blocks[digest] = Block(digest, mapping)
+            return self._blocks[digest]
+
+    def save(self, name, bootinfo, kit, disable_bootloader=False):
+        """Store the blocks of a devkit model built from bootinfo (after
+           fix_bootloader was called with disable_bootloader) as the image
+           name, returning its Manifest. An image with the same name is
+           replaced."""
+        blocks = dict([(blk, self.put(data)) for blk, data in kit.blocks.items()])
+        manifest = Manifest(bootinfo, blocks, kit.patched, disable_bootloader)
+        self._write(self._manifest_path(name), manifest.to_json().encode('ascii'))
+        return manifest
+
+    def add(self, name, bootinfo, hexf, disable_bootloader=False):
+        """Prepare an image (an image.Image, image.PreparedImage or Intel
+           HEX file object) for a device described by a bootinfo, as
+           flash.flash would, and store it as the image name. Raises
+           devkit.ImageError if the image does not fit into the device."""
+        if not hasattr(hexf, 'index'):
+            hexf = image.load([hexf])
+        kit = devkit.factory(bootinfo)
+        kit.validate(hexf.index())
+        hexf.write_to(kit)
+        kit.fix_bootloader(disable_bootloader)
+        return self.save(name, bootinfo, kit, disable_bootloader)
+
+    def manifest(self, name):
+        with open(self._manifest_path(name), 'rb') as f:
+            return Manifest.from_json(f.read().decode('ascii'))
+
+    def image(self, name):
+        """Return the StoredImage name"""
+        return StoredImage(self, name, self.manifest(name))
+
+    def names(self):
+        return sorted([filename[:-len('.json')] for filename in
+                       os.listdir(os.path.join(self.directory, 'manifests'))
+                       if filename.endswith('.json') and not filename.startswith('.')])
+
+    def _stored(self):
+        """Hashes of every stored block"""
+        top = os.path.join(self.directory, 'blocks')
+        return [sub + name for sub in os.listdir(top)
+                for name in os.listdir(os.path.join(top, sub))
+                if _hash_re.match(sub + name)]
+
+    def stats(self):
+        """Return a dictionary with the number of images, of blocks they
+           refer to, and of unique blocks stored, and the sizes in bytes of
+           the blocks referred to and of those stored"""
+        referred, referred_bytes, sizes = 0, 0, {}
+        for digest in self._stored():
+            sizes[digest] = os.path.getsize(self._block_path(digest))
+        names = self.names()
+        for name in names:
+            for digest in self.manifest(name).blocks.values():
+                referred += 1
+                referred_bytes += sizes.get(digest, 0)
+        return {'images': len(names), 'blocks': referred, 'unique': len(sizes),
+                'bytes': referred_bytes, 'stored_bytes': sum(sizes.values())}
+
+    def remove(self, name):
+        """Remove the image name (its blocks are kept until gc is called)"""
+        os.unlink(self._manifest_path(name))
+
+    def gc(self):
+        """Remove the blocks which no image refers to, returning how many
+           were removed. Must not be called while images are being saved."""
+        used = set()
+        for name in self.names():
+            used.update(self.manifest(name).blocks.values())
+        removed = 0
+        for digest in self._stored():
+            if digest not in used:
+                os.unlink(self._block_path(digest))
+                removed += 1
+        return removed
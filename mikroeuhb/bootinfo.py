@@ -119,3 +119,34 @@ class BootInfo(dict):
                 v = repr(v)
             s += '%s: %s\n' % (k,v)
         return s
+
+def pack(info, endianness='<', size=64):
+    """Assemble a BootInfo struct from a dictionary (inverse of BootInfo).
+       Fields are laid out following the same alignment rules assumed by
+       the parser, and the result is padded with zeros to size bytes (by
+       default, the size of a USB HID packet). Mostly useful for simulating
+       devices which were never seen in the wild."""
+    ids = dict([(name, field_type) for field_type, (name, _, _)
+                in _field.iteritems()])
+    names = ['McuType'] + sorted([name for name in info if name != 'McuType'],
+                                 key=lambda name: ids[name])
+    buf = bytearray(1)
+    for name in names:
+        field_type = ids[name]
+        _, num_bytes, enum_map = _field[field_type]
+        value = info[name]
+        if enum_map:
+            value = dict([(v, k) for k, v in enum_map.iteritems()]).get(value, value)
+        pad_bytes = min(num_bytes, 4)
+        if 'McuType' in info and name in _fieldalign_override:
+            pad_bytes = _fieldalign_override[name].get(info['McuType'], pad_bytes)
+        align = pad_bytes if num_bytes <= 4 else 1
+        buf += b'\x00' * ((align - len(buf) % align) % align)
+        buf.append(field_type)
+        if num_bytes <= 4:
+            buf += b'\x00' * ((pad_bytes - len(buf) % pad_bytes) % pad_bytes)
+            value = struct.pack(endianness + {1: 'B', 2: 'H', 4: 'L'}[num_bytes], value)
+        buf += bytes(value).ljust(num_bytes, b'\x00')[:num_bytes]
+    buf[0] = len(buf)
+    assert(len(buf) <= size)
+    return bytes(buf.ljust(size, b'\x00'))
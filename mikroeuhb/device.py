@@ -1,6 +1,8 @@
-import re, struct, logging
+import re, time, struct, logging
 from util import hexlify
 from bootinfo import BootInfo
+from profiler import null_timer
+from packettrace import null_trace
 logger = logging.getLogger(__name__)
 
 HID_buf_size = 64   # Size of a USB HID packet, fixed by the standard
@@ -47,18 +49,7 @@ class Command:
         """Receive a command from a hidraw device"""
         return Command.from_buf(f.read(HID_buf_size))
     
-    _map = None
-    def _init_map(self):
-        """Init a internal map from command code to string"""
-        if not self._map:
-            self._map = {}
-            for attr in dir(self):
-                value = getattr(self, attr)
-                if re.match(r'^[A-Z]+$', attr) and isinstance(value, int):
-                    self._map[value] = attr
-
     def __repr__(self):
-        self._init_map()
         return '%s, cmd=%s, addr=0x%08x, counter=0x%04x' % (
             'stx' if self.stx == STX else 'invalid',
             self._map[self.cmd] if self.cmd in self._map else hex(self.cmd),
@@ -68,35 +59,63 @@ class Command:
         """If the Command code is cmd, return True. Otherwise, log an error
            to this module's logger, and return False."""
         if self.cmd != cmd:
-            self._init_map()
             logger.error('Expected command %s, got %d (%s)' % (
                 self._map[cmd], self.cmd,
                 self._map[self.cmd] if self.cmd in self._map else 'invalid'))
             return False
         return True
 
+Command._map = dict([(value, attr) for attr, value in vars(Command).items()
+                     if re.match(r'^[A-Z]+$', attr) and isinstance(value, int)])
+"""Map from command code to name (built once, never changed)"""
+
 class Device:
     bootinfo = None
-    def __init__(self, fileObj):
-        """Create a Device given a hidraw device file object"""
+    kit = None
+    """Devkit model built by the last call to program"""
+    rebooted_at = None
+    """Time at which the last REBOOT command was sent"""
+    port = None
+    """Port at which the board is attached, identifying its transfer journal"""
+    def __init__(self, fileObj, timer=null_timer, trace=null_trace, port=None):
+        """Create a Device given a hidraw device file object. Supply a
+           profiler.PhaseTimer as timer to record how long each phase
+           of the programming process takes, and a packettrace.PacketTrace as
+           trace to keep the last reports exchanged with the device.
+           The port defaults to the key of fileObj, if it is a lease.Lease
+           (as returned by the hid module)."""
         self.f = fileObj
+        self.port = port if port is not None else getattr(fileObj, 'key', None)
+        self.timer = timer
+        self.trace = trace
+    def _write(self, buf):
+        self.trace.record('o', buf)
+        self.f.write(b'\x00' + buf)
+    def _read(self):
+        buf = self.f.read(HID_buf_size)
+        self.trace.record('i', buf)
+        return buf
     def send(self, cmd):
         """Send a Command"""
-        logger.debug('send cmd: ' + repr(cmd))
-        cmd.send(self.f)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('send cmd: ' + repr(cmd))
+        self._write(cmd.buf())
     def send_data(self, data):
         """Send data (mainly for writing the flash)"""
-        logger.debug('send data: ' + hexlify(data))
-        self.f.write(b'\x00' + data.ljust(HID_buf_size, b'\xff'))
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('send data: ' + hexlify(data))
+        self._write(data.ljust(HID_buf_size, b'\xff'))
     def recv(self):
         """Receive a Command (mainly for checking ACKs)"""
-        cmd = Command.recv(self.f)
-        logger.debug('recv cmd: ' + repr(cmd))
+        cmd = Command.from_buf(self._read())
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('recv cmd: ' + repr(cmd))
         return cmd
     def recv_data(self):
         """Receive data (mainly for getting the BootInfo struct)"""
-        data = self.f.read(HID_buf_size)
-        logger.debug('recv data: ' + hexlify(data))
+        data = self._read()
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('recv data: ' + hexlify(data))
         return data
         
     def _simple_cmd(self, cmd):
@@ -117,23 +136,49 @@ class Device:
     def cmd_reboot(self):
         """Send a REBOOT command (restarts the device)"""
         self.send(Command.from_attr(Command.REBOOT))
+        self.rebooted_at = time.time()
         
-    def program(self, hexf=None, print_info=True, disable_bootloader=False):
+    def program(self, hexf=None, print_info=True, disable_bootloader=False,
+                journal_dir=None, resume=False, only=(), exclude=(),
+                baseline=None, progress=None, keepalive=.5):
         """Do a sequence of commands to program the hexf file
            (codified in Intel HEX format) to the flash memory.
+           Instead of a file, hexf may also be an image.Image, e.g.
+           composed of several hex files, or an image.BackgroundImage
+           still being prepared (INFO is sent every keepalive seconds
+           while waiting for it, so the device stays in the bootloader).
            If hexf is not supplied, only read the bootinfo.
+           The image is checked against the memory map of the device
+           before it is put into BOOT mode, raising a devkit.ImageError
+           if it does not fit.
            If print_info is True, print bootinfo to standard output.
            Use disable_bootloader with caution.
+           If journal_dir is supplied, keep a transfer journal there, as
+           long as the port of the device is known. If resume is also True,
+           skip anything which was acknowledged by the device during a
+           previous session programming the same file to the same board.
+           Supply lists of devkit.AddressRange as only and/or exclude to
+           transfer only part of the Flash memory (see DevKitModel.select).
+           If a baseline snapshot of the device contents is supplied (see
+           DevKitModel.snapshot), only the blocks which changed since then
+           are transferred. Supply a progress.ProgressHooks as progress to
+           be informed of the progress of the transfer.
+           Returns the devkit model, if hexf is supplied.
+           This is a convenience wrapper around flash.flash, which is
+           preferable when programming several devices at once.
         """
-        import devkit, hexfile
-        bootinfo = self.cmd_info()
-        if print_info:
-            print(repr(bootinfo))
-        if hexf:
-            self.cmd_boot()
-            self.cmd_sync()
-            kit = devkit.factory(bootinfo)
-            hexfile.load(hexf, kit)
-            kit.fix_bootloader(disable_bootloader)
-            kit.transfer(self)
-            self.cmd_reboot()
+        # imported here, as flash (through devkit) depends on this module
+        import flash
+        def on_info(bootinfo):
+            if print_info:
+                print(repr(bootinfo))
+        if not hexf:
+            with self.timer.phase('info'):
+                on_info(self.cmd_info())
+            return
+        options = flash.Options(disable_bootloader=disable_bootloader,
+                                only=only, exclude=exclude, baseline=baseline,
+                                journal_dir=journal_dir, resume=resume,
+                                progress=progress, keepalive=keepalive,
+                                on_info=on_info)
+        return flash.flash(self, hexf, options).kit
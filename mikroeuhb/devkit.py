@@ -1,36 +1,196 @@
 import struct, logging
 from util import hexlify, maketrans, bord
 from device import Device, Command, HID_buf_size
+import memmap
 logger = logging.getLogger(__name__)
 
+class InstructionTemplate(object):
+    """A MCU instruction template, compiled once into the masks and shifts
+       needed to place field values into it.
+
+       The template must be supplied as a string of bits, of length 8, 16,
+       24 or 32. The template may contain lowercase letters (a-z) which are
+       substituted by field bits. By default, all letters belong to a single
+       unnamed field, in which 'a' is the most significant bit, 'b' the next
+       one, and so on. Named fields may be declared by supplying a fields
+       dictionary mapping each name to the letters which compose the field
+       (from the most to the least significant bit). Endianness may be
+       specified using Python's struct module notation."""
+    _formats = {8: 'B', 16: 'H', 24: 'L', 32: 'L'}
+
+    def __init__(self, template, fields=None, endianness='<'):
+        assert(len(template) in self._formats and endianness in '<>')
+        self.template = template
+        fields = dict(fields or {})
+        letter_field = {}  # letter -> (field name, bit position in the field)
+        for name, letters in fields.items():
+            for i, c in enumerate(letters):
+                letter_field[c] = (name, len(letters) - 1 - i)
+        self.widths = dict([(name, len(letters)) for name, letters in fields.items()])
+        a, z = map(ord, 'az')
+        max_c = 0
+        for c in template:
+            if c not in '01' and c not in letter_field:
+                c = ord(c)
+                if c < a or c > z:
+                    raise ValueError('char "%c" disallowed in template' % c)
+                max_c = max(max_c, c - a + 1)
+        if max_c != 0:
+            self.widths[None] = max_c
+        # Group the field bits by the shift needed to move them from the
+        # field value to their place in the instruction.
+        shifts = {}  # field name -> {shift: mask}
+        for pos, c in enumerate(template):
+            if c in '01':
+                continue
+            name, src = letter_field.get(c, (None, max_c - 1 - (ord(c) - a)))
+            dst = len(template) - 1 - pos
+            masks = shifts.setdefault(name, {})
+            masks[dst - src] = masks.get(dst - src, 0) | (1 << src)
+        self._shifts = dict([(name, tuple(masks.items()))
+                             for name, masks in shifts.items()])
+        self._base = int(template.translate(
+            maketrans('abcdefghijklmnopqrstuvwxyz', 26*'0')), 2)
+        self._struct = struct.Struct(endianness + self._formats[len(template)])
+        self._slice = slice(None)
+        if len(template) == 24:
+            self._slice = slice(None, -1) if endianness == '<' else slice(1, None)
+
+    def _place(self, name, value):
+        if value >> self.widths[name] != 0 or value < 0:
+            raise ValueError('value 0x%x does not fit into field %s' % (value, name))
+        instruction = 0
+        for shift, mask in self._shifts[name]:
+            if shift >= 0:
+                instruction |= (value & mask) << shift
+            else:
+                instruction |= (value & mask) >> -shift
+        return instruction
+
+    def encode(self, field=None, **fields):
+        """Encode the instruction, returning it as a bytestring. The unnamed
+           field is supplied as the first argument, named fields as keyword
+           arguments."""
+        instruction = self._base
+        if None in self.widths:
+            if field is None:
+                raise ValueError('supplied template requires a field')
+            instruction |= self._place(None, field)
+        if set(fields) != set(self.widths) - set([None]):
+            raise ValueError('template requires fields %s' % ', '.join(
+                sorted([k for k in self.widths if k is not None])))
+        for name, value in fields.items():
+            instruction |= self._place(name, value)
+        return self._struct.pack(instruction)[self._slice]
+
+    __call__ = encode
+
+_templates = {}
+def compile_instruction(template, endianness='<'):
+    """Return a (cached) InstructionTemplate for a template string"""
+    key = (template, endianness)
+    compiled = _templates.get(key)
+    if compiled is None:
+        compiled = _templates.setdefault(key, InstructionTemplate(template,
+                                                                  endianness=endianness))
+    return compiled
+
 def encode_instruction(template, field=None, endianness='<'):
     """Encodes a MCU instruction, returning it as a bytestring.
-       The template must be supplied as a string of bits, of
-       length 8, 16, 24 or 32. The template may contain lowercase
-       letters (a-z) which are substituted by a field (from the
-       most to the least significant bits). Endianness may be
-       specified using Python's struct module notation."""
-    _map = {8: 'B', 16: 'H', 24: 'L', 32: 'L'}
-    assert(len(template) in _map and endianness in '<>')
-    a,z = map(ord, 'az')
-    max_c = 0
-    for c in template:
-        if c not in '01':
-            c = ord(c)
-            if c < a or c > z:
-                raise ValueError('char "%c" disallowed in template' % c)
-            max_c = max(max_c, c - a + 1)
-    if max_c != 0:
-        if field == None:
-            raise ValueError('supplied template requires a field')
-        orig = ''.join([chr(a+i) for i in xrange(max_c)])
-        field = bin(field)[2:].rjust(max_c, '0')
-        template = template.translate(maketrans(orig, field))
-    instruction = int(template, 2)
-    instruction = struct.pack(endianness + _map[len(template)], instruction)
-    if len(template) == 24:
-        instruction = instruction[:-1] if endianness == '<' else instruction[1:]
-    return instruction
+       See InstructionTemplate for the template format."""
+    return compile_instruction(template, endianness).encode(field)
+
+def encode_instructions(sequence):
+    """Encode a sequence of (template, field) tuples, in which template is
+       either a string or an InstructionTemplate, returning a single
+       bytestring containing all of the instructions."""
+    return b''.join([(t if isinstance(t, InstructionTemplate) else
+                      compile_instruction(t)).encode(field)
+                     for t, field in sequence])
+
+class ImageProblem(tuple):
+    """Interval [start,end) of "virtual" addresses of an image which does
+       not fit into the memory map of a devkit. Kinds of problems are:
+       'bootloader' (data for the region occupied by the bootloader),
+       'outside' (data for addresses which are not in the Flash memory),
+       'config' (configuration data, which is dropped since the bootloader
+       does not support writing it) and 'padding' (non-null padding bytes
+       in PIC24/DSPIC hex files, which are dropped when the image is
+       written). 'config' and 'padding' problems are not fatal."""
+    _descriptions = {
+        'bootloader': 'data for the bootloader region',
+        'outside': 'data outside of the Flash memory',
+        'config': 'configuration data (ignored)',
+        'padding': 'non-null padding bytes (ignored)',
+    }
+    def __new__(cls, kind, start, end):
+        assert(kind in cls._descriptions)
+        return tuple.__new__(cls, (kind, start, end))
+    kind = property(lambda self: self[0])
+    start = property(lambda self: self[1])
+    end = property(lambda self: self[2])
+    fatal = property(lambda self: self[0] not in ('config', 'padding'))
+    def __repr__(self):
+        return '0x%x-0x%x: %s' % (self.start, self.end,
+                                  self._descriptions[self.kind])
+
+class ImageError(ValueError):
+    """Raised when an image does not fit into the memory map of a devkit.
+       The problems attribute contains a list of ImageProblem tuples."""
+    def __init__(self, problems):
+        ValueError.__init__(self, 'image does not fit into the device:\n' +
+                            '\n'.join(['    ' + repr(p) for p in problems]))
+        self.problems = problems
+
+class AddressRange(tuple):
+    """Interval [start,end) of addresses, either "virtual" (as seen by the
+       program, i.e. as found in the hex file) or physical (as supplied to
+       the WRITE and ERASE commands)."""
+    def __new__(cls, start, end, physical=False):
+        if end <= start:
+            raise ValueError('empty address range 0x%x-0x%x' % (start, end))
+        return tuple.__new__(cls, (start, end, physical))
+    start = property(lambda self: self[0])
+    end = property(lambda self: self[1])
+    physical = property(lambda self: self[2])
+    def __repr__(self):
+        return '%s0x%x-0x%x' % ('phy:' if self.physical else '',
+                                self.start, self.end)
+
+    @staticmethod
+    def parse(s):
+        """Parse a range given as START-END (end exclusive), with addresses
+           in decimal or hex (0x prefix). A 'phy:' prefix indicates physical
+           addresses."""
+        physical = s.startswith('phy:')
+        if physical:
+            s = s[len('phy:'):]
+        try:
+            start, end = [int(x, 0) for x in s.split('-')]
+        except ValueError:
+            raise ValueError('invalid address range "%s"' % s)
+        return AddressRange(start, end, physical)
+
+class SelectionError(ValueError):
+    """Raised when a selection of address ranges cannot be programmed
+       without breaking the bootloader fix"""
+
+def _subtract(start, end, ranges):
+    """Return the parts of [start,end) which are not covered by a sorted
+       list of non-overlapping ranges [start,end)"""
+    parts = []
+    for r_start, r_end in ranges:
+        if r_end <= start:
+            continue
+        if r_start >= end:
+            break
+        if r_start > start:
+            parts.append((start, r_start))
+        start = max(start, r_end)
+        if start >= end:
+            return parts
+    parts.append((start, end))
+    return parts
 
 class DevKitModel:
     """Inherit from this class to implement support for new development kits.
@@ -41,12 +201,14 @@ class DevKitModel:
     """Offset in memory to which the Flash contents are mapped.
        This value is subtracted from the address supplied to self.write,
        in order to convert "virtual" addresses (seen by the program) to
-       "physical" addresses (relative to the start of the Flash memory)."""
+       "physical" addresses (relative to the start of the Flash memory).
+       Set from the windows of the memory map of the MCU, if present."""
 
     config_data_addr = None
     """Address used for writing MCU configuration data (if not None).
        Writing this is not supported by the bootloader, so we simply
-       ignore any writes to addresses after this address."""
+       ignore any writes to addresses after this address. Set from the
+       windows of the memory map of the MCU, if present."""
 
     def __init__(self, bootinfo):
         """Initialize the devkit model. The bootinfo dictionary needs to
@@ -59,23 +221,20 @@ class DevKitModel:
         # buffer space in device (dev_buf_rem) may be broken.
         assert(self.EraseBlock % HID_buf_size == 0)
         self.blocks = {}
+        self.patched = {}
+        self.problems = []
+        self.memmap = memmap.lookup(bootinfo['McuType'])
+        for name, value in self.memmap.windows.items():
+            setattr(self, name, value)
         self._init_blockaddr()
 
     def _init_blockaddr(self):
-        """Initialize blocks of size EraseBlock from address 0 to BootStart.
-           Override this method if a devkit does not have a constant block size
-           or if Flash memory addresses are not contiguous. This method needs
-           to initialize self.blockaddr, a list of tuples defining the span
-           interval [start_addr, end_addr) of each block."""
-        self.blockaddr = []
-        self._init_blockrange(0, self.BootStart)
-
-    def _init_blockrange(self, range_start, range_end):
-        """Initialize a range of blocks of size EraseBlock from
-        address range_start to range_end."""
-        assert((range_end - range_start) % self.EraseBlock == 0)
-        self.blockaddr += [(addr, addr + self.EraseBlock) for addr in
-                           xrange(range_start, range_end, self.EraseBlock)]
+        """Initialize self.blockaddr, a memmap.BlockTable defining the span
+           interval [start_addr, end_addr) of each block, from the memory map
+           of the MCU. To support a new block layout, add an entry to the
+           memmap database instead of overriding this method."""
+        self.blockaddr = self.memmap.table(self.BootStart, self.EraseBlock,
+                                           self.McuSize)
 
     def _lazy_block(self, blk):
         """Lazily initialize a bytearray for block number blk. Override this
@@ -97,6 +256,14 @@ class DevKitModel:
         assert(addr < end_addr)
         return addr
 
+    def _write_span(self, blk):
+        """Get the interval [start,end) of addresses, as supplied to the
+           WRITE command, spanned by a block. Override this method if
+           _write_addr is not a simple offset of the physical address."""
+        start_addr, end_addr = self.blockaddr[blk]
+        start = self._write_addr(blk)
+        return start, start + end_addr - start_addr
+
     def _erase_addr(self, blk):
         """Get the address of a block which needs to be supplied to the
            ERASE command. By default, returns the same as defined in
@@ -105,43 +272,47 @@ class DevKitModel:
            supplied to WRITE."""
         return self._write_addr(blk)
 
-    _ptr = 0
-    """Last Flash memory block to which data were written. Used to speed
-       up block search based on data locality."""
+    _last_blk = (None, 0, 0)
+    """Last Flash memory block found by _find_blk, as a (blk, start_addr,
+       end_addr) tuple. Used to speed up block search based on data
+       locality."""
 
     def _find_blk(self, addr):
-        """Find the Flash block containing a given address."""
-        # Start searching from the last block written.
-        blk = self._ptr
-        while True:
-            try:
-                start_addr, end_addr = self.blockaddr[blk]
-            except IndexError as err:
-                raise IndexError('invalid block %d at address 0x%x' % (
-                    blk, addr))
-            if addr >= end_addr:
-                blk += 1
-            elif addr < start_addr:
-                blk -= 1
-            else:
-                break
-        self._ptr = blk
-        return blk, start_addr, end_addr
+        """Find the Flash block containing a given address. Returns a
+           (blk, start_addr, end_addr) tuple."""
+        found = self._last_blk
+        if not found[1] <= addr < found[2]:
+            blk = self.blockaddr.find(addr)
+            if blk is None:
+                raise IndexError('no block at address 0x%x' % addr)
+            found = self._last_blk = (blk,) + self.blockaddr[blk]
+        return found
 
     def _write_phy(self, addr, data):
         """Write a data bytestring or bytearray to a physical Flash
            memory address (relative to self.blockaddr)."""
         blk, start_addr, end_addr = self._find_blk(addr)
-        # Write data to the block
-        self._lazy_block(blk)
-        write_len = min(end_addr - addr, len(data))
-        write_off = addr - start_addr
-        self.blocks[blk][write_off:write_off+write_len] = data[:write_len]
-        # Check if any data is remaining which did not fit into the block
-        data = data[write_len:]
-        if len(data):
-            logger.debug('data trespassing block limits: addr=0x%x, write_len=0x%x' % (addr, write_len))
-            self._write_phy(addr + write_len, data)
+        if addr + len(data) <= end_addr:
+            # Common case: data fits into a single block
+            self._lazy_block(blk)
+            write_off = addr - start_addr
+            self.blocks[blk][write_off:write_off+len(data)] = data
+            return
+        pos, size = 0, len(data)
+        while True:
+            blk, start_addr, end_addr = self._find_blk(addr)
+            # Write data to the block
+            self._lazy_block(blk)
+            write_len = min(end_addr - addr, size - pos)
+            write_off = addr - start_addr
+            self.blocks[blk][write_off:write_off+write_len] = data[pos:pos+write_len]
+            pos += write_len
+            # Check if any data is remaining which did not fit into the block
+            if pos == size:
+                break
+            logger.debug('data trespassing block limits: addr=0x%x, write_len=0x%x' % (
+                addr, write_len))
+            addr += write_len
 
     def _read_phy(self, addr, size):
         """Read a data bytestring from a physical Flash memory address."""
@@ -156,13 +327,94 @@ class DevKitModel:
             data += self._read_phy(addr + read_len, size - read_len)
         return data
 
+    def _patch(self, role, addr, data):
+        """Write data to a physical Flash memory address as part of the
+           bootloader fix, recording in self.patched[role] the blocks which
+           were touched. Roles used by the devkits are 'reset' (code which
+           makes the MCU start the bootloader upon reset) and 'startprogram'
+           (code called by the bootloader to start the program)."""
+        self._write_phy(addr, data)
+        first, _, _ = self._find_blk(addr)
+        last, _, _ = self._find_blk(addr + len(data) - 1)
+        self.patched.setdefault(role, set()).update(xrange(first, last + 1))
+
+    def _virt_to_phy(self, addr):
+        """Convert a "virtual" address (as seen by the program) to a
+           physical one. By default, simply subtracts flash_mem_offset
+           from the address."""
+        return addr - self.flash_mem_offset
+
+    def _phy_to_virt(self, addr):
+        """Inverse function of _virt_to_phy"""
+        return addr + self.flash_mem_offset
+
+    def _boot_range(self):
+        """Physical interval [start,end) occupied by the bootloader"""
+        return self.BootStart, self.McuSize
+
     def write(self, addr, data):
         """Write a data bytestring or bytearray to a "virtual" address
-           (address as seen by the program). By default, simply
-           subtracts flash_mem_offset from the address. Override this
-           method if a devkit has a more complex memory map."""
+           (address as seen by the program). By default, converts the
+           address using _virt_to_phy. Override this method if a devkit
+           has a more complex memory map."""
         if self.config_data_addr is None or addr < self.config_data_addr:
-            self._write_phy(addr - self.flash_mem_offset, data)
+            self._write_phy(self._virt_to_phy(addr), data)
+
+    def _check_data(self, addr, data, report):
+        """Check data to be written to a "virtual" address, calling
+           report(kind, start, end) for any problems found. Override this
+           method if a devkit has restrictions on the data itself."""
+        pass
+
+    def validate(self, segments):
+        """Check a sorted list of non-overlapping (start, end, data, ...)
+           segments of an image (such as returned by image.Image.index)
+           against the memory map, before anything is written to the device.
+           Returns the list of ImageProblem tuples found, coalescing adjacent
+           problems of the same kind, and keeps it as self.problems. Raises
+           ImageError if any of them is fatal."""
+        boot_start, boot_end = self._boot_range()
+        allowed = []
+        for start, end in self._ranges(xrange(len(self.blockaddr))):
+            allowed += _subtract(self.blockaddr[start][0],
+                                 self.blockaddr[end - 1][1],
+                                 [(boot_start, boot_end)])
+        found = []
+        report = lambda kind, start, end: found.append((start, end, kind))
+        for segment in segments:
+            start, end, data = segment[:3]
+            if self.config_data_addr is not None and end > self.config_data_addr:
+                report('config', max(start, self.config_data_addr), end)
+                if start >= self.config_data_addr:
+                    continue
+                data = data[:self.config_data_addr - start]
+                end = self.config_data_addr
+            for part_start, part_end in _subtract(self._virt_to_phy(start),
+                                                  self._virt_to_phy(end), allowed):
+                # Parts not allowed are either in the bootloader or outside
+                boot = (max(part_start, boot_start), min(part_end, boot_end))
+                if boot[0] < boot[1]:
+                    for outside in _subtract(part_start, part_end, [boot]):
+                        report('outside', *map(self._phy_to_virt, outside))
+                    report('bootloader', *map(self._phy_to_virt, boot))
+                else:
+                    report('outside', self._phy_to_virt(part_start),
+                           self._phy_to_virt(part_end))
+            self._check_data(start, data, report)
+        problems = []
+        for start, end, kind in sorted(found):
+            if problems and problems[-1][0] == kind and problems[-1][2] == start:
+                problems[-1][2] = end
+            else:
+                problems.append([kind, start, end])
+        problems = self.problems = [ImageProblem(*p) for p in problems]
+        for problem in problems:
+            if not problem.fatal:
+                logger.info(repr(problem))
+        fatal = [problem for problem in problems if problem.fatal]
+        if fatal:
+            raise ImageError(fatal)
+        return problems
 
     def fix_bootloader(self, disable_bootloader=False):
         """Make any changes to the program code needed for the bootloader
@@ -170,23 +422,33 @@ class DevKitModel:
            for each different devkit. If disable_bootloader is enabled
            (use with caution), the device will be set in a way, if
            supported, such that the bootloader will not be loaded
-           automatically anymore."""
+           automatically anymore. Use self._patch to write the changes."""
         pass
 
     _write_max = 0x8000
     """Maximum amount of data bytes to be transferred during a
        single WRITE command."""
 
-    def _blk_interval(self, dev, start, end):
+    def _blk_interval(self, dev, start, end, journal=None, progress=None):
         """Erase and write to the device the Flash memory block
-           interval [start,end)."""
+           interval [start,end). If a journal is supplied, each
+           acknowledged ERASE and WRITE command is recorded in it.
+           If a progress.Progress is supplied, it is kept up to date."""
         assert(isinstance(dev, Device))
         dev_buf_size = self.EraseBlock  # size of firmware's char[] fBuffer
         # Erase the Flash memory blocks
-        dev.send(Command.from_attr(Command.ERASE,
-                                   self._erase_addr(end - 1),
-                                   end - start))
-        dev.recv().expect(Command.ERASE)
+        erase_addr = self._erase_addr(end - 1)
+        if progress:
+            progress.range_start(self._write_span(start)[0], self._write_span(end - 1)[1])
+            t0 = progress.clock()
+        with dev.timer.phase('erase', addr=erase_addr, blocks=end - start, blk=start):
+            dev.send(Command.from_attr(Command.ERASE, erase_addr, end - start))
+            dev.recv().expect(Command.ERASE)
+        if journal:
+            journal.erased(start, end)
+        if progress:
+            progress.erased(sum([len(self.blocks[blk]) for blk in xrange(start, end)]),
+                            end - start, progress.clock() - t0)
         # Write each block blk
         for blk in xrange(start, end):
             blk_data = self.blocks[blk]
@@ -197,41 +459,158 @@ class DevKitModel:
                 address = self._write_addr(blk, blk_off)
                 logger.debug('WRITE %d bytes to address 0x%x' % (
                     len(data), address))
-                dev.send(Command.from_attr(Command.WRITE, address, len(data)))
-                dev_buf_rem = dev_buf_size
-                # Split into USB HID packets
-                for i in xrange(0, len(data), HID_buf_size):
-                    pkt = data[i:i+HID_buf_size]
-                    dev.send_data(pkt)
-                    dev_buf_rem -= len(pkt)
-                    if dev_buf_rem == 0:
-                        # Device sends an ACK whenever its buffer gets full
+                if progress:
+                    t0 = progress.clock()
+                with dev.timer.phase('write', addr=address, size=len(data)):
+                    dev.send(Command.from_attr(Command.WRITE, address, len(data)))
+                    dev_buf_rem = dev_buf_size
+                    # Split into USB HID packets
+                    for i in xrange(0, len(data), HID_buf_size):
+                        pkt = data[i:i+HID_buf_size]
+                        dev.send_data(pkt)
+                        dev_buf_rem -= len(pkt)
+                        if dev_buf_rem == 0:
+                            # Device sends an ACK whenever its buffer gets full
+                            dev.recv().expect(Command.WRITE)
+                            dev_buf_rem = dev_buf_size
+                    if dev_buf_rem != dev_buf_size:
+                        # Device also sends an ACK when the WRITE command ends
+                        # (if it has not just been sent because of a full buffer)
                         dev.recv().expect(Command.WRITE)
-                        dev_buf_rem = dev_buf_size
-                if dev_buf_rem != dev_buf_size:
-                    # Device also sends an ACK when the WRITE command ends
-                    # (if it has not just been sent because of a full buffer)
-                    dev.recv().expect(Command.WRITE)
-
-    def transfer(self, dev):
-        """Transfer to the device data which were written to this devkit model"""
-        logger.debug('transfer to device starting')
-        assert(isinstance(dev, Device))
-        # Find ranges of contiguous blocks to which data were written
-        blocks = sorted(self.blocks.keys())
+                if journal:
+                    journal.written(blk, blk_off)
+                if progress:
+                    progress.acked(len(data), progress.clock() - t0)
+
+    def _ranges(self, blocks):
+        """Split a list of block numbers into ranges [start,end) of
+           blocks which are contiguous in the Flash memory."""
+        blocks = sorted(blocks)
+        ranges = []
         if len(blocks) == 0:
-            return  # nothing to transfer
+            return ranges
         previous_end = self.blockaddr[blocks[0]][0]
         frontier_blk = blocks[0]
         previous_blk = blocks[0]
         for blk in blocks:
             start_addr, end_addr = self.blockaddr[blk]
             if start_addr != previous_end:
-                self._blk_interval(dev, frontier_blk, previous_blk+1)
+                ranges.append((frontier_blk, previous_blk+1))
                 frontier_blk = blk
             previous_end = end_addr
             previous_blk = blk
-        self._blk_interval(dev, frontier_blk, previous_blk+1)
+        ranges.append((frontier_blk, previous_blk+1))
+        return ranges
+
+    def _range_blocks(self, rng):
+        """Return the numbers of the blocks which overlap an AddressRange"""
+        if rng.physical:
+            spans = [self._write_span(blk) for blk in xrange(len(self.blockaddr))]
+            start, end = rng.start, rng.end
+        else:
+            spans = self.blockaddr
+            start, end = self._virt_to_phy(rng.start), self._virt_to_phy(rng.end)
+        return [blk for blk, (blk_start, blk_end) in enumerate(spans)
+                if blk_start < end and start < blk_end]
+
+    selected = None
+    """Set of block numbers to be transferred (None if all of them)"""
+
+    def select(self, only=(), exclude=()):
+        """Restrict the transfer to blocks which overlap an AddressRange of
+           only (if not empty) and do not overlap any AddressRange of
+           exclude. As Flash memory is erased by whole blocks, ranges are
+           extended to block boundaries. Call after fix_bootloader: raises
+           SelectionError if the blocks patched by it would be only
+           partially transferred."""
+        selected = set(self.blocks)
+        if only:
+            chosen = set()
+            for rng in only:
+                blocks = self._range_blocks(rng)
+                if not blocks:
+                    raise SelectionError('range %s is outside of the Flash memory'
+                                         % repr(rng))
+                chosen.update(blocks)
+            selected &= chosen
+        for rng in exclude:
+            selected -= set(self._range_blocks(rng))
+        patched = set()
+        for blocks in self.patched.values():
+            patched |= blocks
+        if patched & selected and patched - selected:
+            raise SelectionError(
+                'blocks changed by the bootloader fix (%s) must be either all '
+                'selected or all left out' % ', '.join([
+                    '0x%x-0x%x' % self._write_span(blk) for blk in sorted(patched)]))
+        self.selected = selected
+        for start, end in self._ranges(selected):
+            logger.info('selected 0x%x-0x%x' % (self._write_span(start)[0],
+                                                 self._write_span(end - 1)[1]))
+        return selected
+
+    def snapshot(self):
+        """Return a dictionary mapping block numbers to their contents, to
+           be later supplied to select_changed"""
+        return dict([(blk, bytes(data)) for blk, data in self.blocks.items()])
+
+    def select_changed(self, baseline):
+        """Restrict the transfer to blocks whose contents differ from a
+           snapshot of the blocks known to be in the device, e.g. taken
+           after a previous transfer. Blocks which are in the snapshot but
+           no longer contain data are erased. If a selection was already
+           made by select, only blocks in both selections are kept."""
+        for blk in baseline:
+            if blk not in self.blocks:
+                self._lazy_block(blk)
+        changed = set([blk for blk, data in self.blocks.items()
+                       if baseline.get(blk) != bytes(data)])
+        if self.selected is not None:
+            changed &= self.selected
+        logger.info('%d of %d blocks changed' % (len(changed), len(self.blocks)))
+        self.selected = changed
+        return changed
+
+    def _plan(self, safe_order=False):
+        """Return the list of block ranges [start,end) to be erased and
+           written, in order. If safe_order is True, blocks containing the
+           code which makes the MCU start the bootloader are left to the
+           end, so that the bootloader is still reachable if the transfer
+           is interrupted before them. Only the selected blocks are
+           included (see select)."""
+        blocks = self.blocks.keys()
+        if self.selected is not None:
+            blocks = [blk for blk in blocks if blk in self.selected]
+        if not safe_order or 'reset' not in self.patched:
+            return self._ranges(blocks)
+        reset = self.patched['reset']
+        return (self._ranges([blk for blk in blocks if blk not in reset]) +
+                self._ranges([blk for blk in blocks if blk in reset]))
+
+    def transfer(self, dev, journal=None, progress=None):
+        """Transfer to the device data which were written to this devkit model.
+           If a journal.Journal is supplied, blocks are transferred in a safe
+           order, acknowledged commands are recorded, and blocks already
+           recorded in the journal by an interrupted session are skipped.
+           If a progress.Progress is supplied, it is informed of the total
+           amount of data to be transferred, and of each step taken.
+           Returns the block ranges [start,end) which were transferred."""
+        logger.debug('transfer to device starting')
+        assert(isinstance(dev, Device))
+        ranges = self._plan(safe_order=journal is not None)
+        if journal:
+            ranges = journal.pending(self, ranges)
+        if progress:
+            nbytes = sum([len(self.blocks[blk]) for start, end in ranges
+                          for blk in xrange(start, end)])
+            progress.start(nbytes, nbytes, sum([end - start for start, end in ranges]))
+        for start, end in ranges:
+            self._blk_interval(dev, start, end, journal, progress)
+        if journal:
+            journal.complete()
+        if progress:
+            progress.done()
+        return ranges
 
 
 class ARMDevKit(DevKitModel):
@@ -239,6 +618,11 @@ class ARMDevKit(DevKitModel):
     _supported = ['ARM', 'STELLARIS_M3', 'STELLARIS_M4', 'STELLARIS', 'TIVA_M4']
     """The devkits above appear to use the default Flash memory block model,
        thus only the bootloader fix needs to diverge from the base devkit model."""
+    _movw_r0 = InstructionTemplate('0fgh0000ijklmnop11110e100100abcd')  # movw r0, #imm16
+    _movt_r0 = InstructionTemplate('0fgh0000ijklmnop11110e101100abcd')  # movt r0, #imm16
+    _mov_sp_r0 = InstructionTemplate('0100011010000101')  # mov sp, r0
+    _bx_r0 = InstructionTemplate('0100011100000000')  # bx r0
+
     def fix_bootloader(self, disable_bootloader=False):
         """Fix the first block to point the reset address to the bootloader.
            Put in the location expected by the bootloader a small ARM-Thumb
@@ -252,60 +636,43 @@ class ARMDevKit(DevKitModel):
             resetaddr |= 1
         # Change the reset address to point to the bootloader code.
         if not disable_bootloader:
-            self._write_phy(4, struct.pack('<L', self.BootStart|1))
+            self._patch('reset', 4, struct.pack('<L', self.BootStart|1))
         logger.debug('reset vector after fix:  ' + hexlify(self._read_phy(0, 8)))
 
         def load_r0(value):
             """Return ARM-Thumb instructions for loading a 32-bit value
                into the r0 register."""
-            return b''.join([
-                # movw r0, #lo
-                encode_instruction('0fgh0000ijklmnop11110e100100abcd',
-                                   value & 0xffff),
-                # movt r0, #hi
-                encode_instruction('0fgh0000ijklmnop11110e101100abcd',
-                                   (value >> 16) & 0xffff),
+            return encode_instructions([
+                (self._movw_r0, value & 0xffff),
+                (self._movt_r0, (value >> 16) & 0xffff),
             ])
         program = b''.join([
             load_r0(stackp),
-            encode_instruction('0100011010000101'),  # mov sp, r0
+            self._mov_sp_r0.encode(),
             load_r0(resetaddr),
-            encode_instruction('0100011100000000'),  # bx r0
+            self._bx_r0.encode(),
             ])
         assert(len(program) == 20)  # length expected by bootloader
 
         logger.debug('start program routine: ' + hexlify(program))
-        self._write_phy(self.BootStart - len(program), program)
+        self._patch('startprogram', self.BootStart - len(program), program)
 
 
 class STM32DevKit(ARMDevKit):
-    """Besides being ARM-Thumb devices, STM32s have a different Flash memory block model. See:
-       http://www.mikroe.com/download/eng/documents/compilers/mikroc/pro/arm/help/flash_memory_library.htm#flash_addresstosector
+    """Besides being ARM-Thumb devices, STM32s have a different Flash memory
+       block model, and their Flash memory is mapped to 0x8000000. Both are
+       described by the STM32 entry of memmap.maps. See:
+       https://github.com/ashima/embedded-STM32F-lib/blob/master/readDocs/byhand/memory-overview-STM32F407.xml
     """
     _supported = ['STM32L1XX', 'STM32F1XX', 'STM32F2XX', 'STM32F4XX']
     """STM32 MCUs are listed above"""
-    flash_mem_offset = 0x8000000
-    """Flash memory is mapped to the address above. See:
-       https://github.com/ashima/embedded-STM32F-lib/blob/master/readDocs/byhand/memory-overview-STM32F407.xml
-    """
-    def _init_blockaddr(self):
-        block_list = [(4,  16*1024),
-                      (1,  64*1024),
-                      (6, 128*1024)]
-        self.blockaddr = []
-        start_addr = 0
-        for number_of_blocks, block_size in block_list:
-            for i in xrange(number_of_blocks):
-                end_addr = start_addr + block_size
-                self.blockaddr.append((start_addr, end_addr))
-                start_addr = end_addr
-        assert(end_addr == self.BootStart)
 
 
 class PIC18DevKit(DevKitModel):
     _supported = ['PIC18', 'PIC18FJ']
-
-    config_data_addr = 0x300000
+    # GOTO k (2 words instruction)
+    _goto = (InstructionTemplate('11101111abcdefgh'),
+             InstructionTemplate('1111abcdefghijkl'))
 
     def fix_bootloader(self, disable_bootloader=False):
         jump_to_main_prog = self._read_phy(0, 4)
@@ -314,17 +681,18 @@ class PIC18DevKit(DevKitModel):
             assert(self.BootStart & 1 == 0)
             k = self.BootStart >> 1
             # http://ww1.microchip.com/downloads/en/DeviceDoc/39500a.pdf p.726
-            # GOTO k (2 words instruction)
-            self._write_phy(0, encode_instruction('11101111abcdefgh', k & 0xff))
-            self._write_phy(2, encode_instruction('1111abcdefghijkl', k >> 8))
+            self._patch('reset', 0, encode_instructions([(self._goto[0], k & 0xff),
+                                                         (self._goto[1], k >> 8)]))
         logger.debug('reset code after fix:  ' + hexlify(self._read_phy(0, 4)))
-        self._write_phy(self.BootStart - len(jump_to_main_prog), jump_to_main_prog)
+        self._patch('startprogram', self.BootStart - len(jump_to_main_prog),
+                    jump_to_main_prog)
 
 
 class PIC24DevKit(DevKitModel):
     _supported = ['PIC24', 'DSPIC', 'DSPIC33']
-
-    config_data_addr = 0x1f00008
+    # GOTO lit23 (2 words instruction)
+    _goto = (InstructionTemplate('00000100abcdefghijklmnop'),
+             InstructionTemplate('00000000000000000abcdefg'))
 
     def _pic24_addr_to_phy(self, addr):
         """Convert a PIC24/DSPIC address representation to the
@@ -343,17 +711,35 @@ class PIC24DevKit(DevKitModel):
         assert(addr % 4 == 0)
         return 3*addr//4
 
-    def _init_blockaddr(self):
-        # Take into account that device informs BootStart in PIC24-style address
-        origBootStart = self.BootStart
-        self.BootStart = self._pic24_addr_to_phy(self.BootStart)
-        DevKitModel._init_blockaddr(self)
-        self.BootStart = self._phy_addr_to_pic24(self.BootStart)
-        assert(self.BootStart == origBootStart)
+    def _virt_to_phy(self, addr):
+        return 3*addr//4
+
+    def _phy_to_virt(self, addr):
+        return 4*addr//3
+
+    def _boot_range(self):
+        return (self._pic24_addr_to_phy(self.BootStart),
+                self._pic24_addr_to_phy(self.McuSize))
+
+    def _check_data(self, addr, data, report):
+        # padding bytes (at every fourth byte) must be null
+        first = (3 - addr) % 4
+        padding = bytearray(data[first::4])
+        if padding.count(b'\x00') == len(padding):
+            return
+        for i, padbyte in enumerate(padding):
+            if padbyte != 0:
+                word_addr = addr + first + 4*i - 3
+                report('padding', word_addr, word_addr + 4)
 
     def _write_addr(self, blk, blk_off=0):
         return self._phy_addr_to_pic24(DevKitModel._write_addr(self, blk, blk_off))
 
+    def _write_span(self, blk):
+        start_addr, end_addr = self.blockaddr[blk]
+        return (self._phy_addr_to_pic24(start_addr),
+                self._phy_addr_to_pic24(end_addr))
+
     def write(self, addr, data):
         if addr >= self.config_data_addr:
             return
@@ -375,39 +761,28 @@ class PIC24DevKit(DevKitModel):
         if not disable_bootloader:
             assert(self.BootStart & 1 == 0)
             # http://ww1.microchip.com/downloads/en/DeviceDoc/70157F.pdf p.250
-            # GOTO lit23 (2 words instruction)
-            self._write_phy(0, encode_instruction('00000100abcdefghijklmnop',
-                                                  self.BootStart & 0xffff))
-            self._write_phy(3, encode_instruction('00000000000000000abcdefg',
-                                                  self.BootStart >> 16))
+            self._patch('reset', 0, encode_instructions([
+                (self._goto[0], self.BootStart & 0xffff),
+                (self._goto[1], self.BootStart >> 16)]))
         logger.debug('reset code after fix:  ' + hexlify(self._read_phy(0, 6)))
-        self._write_phy(self._pic24_addr_to_phy(self.BootStart) -
-                        len(jump_to_main_prog), jump_to_main_prog)
+        self._patch('startprogram', self._pic24_addr_to_phy(self.BootStart) -
+                    len(jump_to_main_prog), jump_to_main_prog)
 
 
 class PIC32DevKit(DevKitModel):
     _supported = ['PIC32']
-
-    main_flash_addr = 0x1d000000
-    boot_rom_addr   = 0x1fc00000
-
-    config_data_addr = boot_rom_addr | 0x2ff0  # configuration bits
-
-    def _init_blockaddr(self):
-        self.blockaddr = []
-        
-        self._init_blockrange(self.main_flash_addr, self.main_flash_addr + self.McuSize)
-        # The last Flash block range should stop before the the start of the block
-        # containing configuration bits, to prevent its erasure.
-        config_offset_in_block = (self.config_data_addr - self.boot_rom_addr) % self.EraseBlock
-        config_block_start = self.config_data_addr - config_offset_in_block
-        self._init_blockrange(self.boot_rom_addr, config_block_start)
+    """main_flash_addr, boot_rom_addr and config_data_addr (configuration
+       bits) are set from the PIC32 and PIC32MZ entries of memmap.maps"""
 
     def _pic32_addr_to_phy(self, addr):
         """Convert a PIC32 address representation to the
         physical number-of-the-byte inside the Flash blocks."""
         return addr & 0x1fffffff
 
+    def _boot_range(self):
+        return (self._pic32_addr_to_phy(self.BootStart),
+                self.main_flash_addr + self.McuSize)
+
     def _phy_addr_to_pic32(self, addr, use_cache=True):
         """Inverse function of _pic32_addr_to_phy
 
@@ -450,7 +825,7 @@ class PIC32DevKit(DevKitModel):
                                             startprogram_routine_len)))
         logger.debug('start program routine after fix:  ' +
                      hexlify(startprogram_routine))
-        self._write_phy(startprogram_routine_addr, startprogram_routine)
+        self._patch('startprogram', startprogram_routine_addr, startprogram_routine)
         if not disable_bootloader:
             jump_bootstart_addr = self.boot_rom_addr + jump_bootstart_displ
             jump_bootstart_code = jump_to(self.BootStart)
@@ -458,28 +833,29 @@ class PIC32DevKit(DevKitModel):
             logger.debug('jump to bootstart before fix: ' +
                          hexlify(self._read_phy(jump_bootstart_addr,
                                                 jump_bootstart_len)))
-            self._write_phy(jump_bootstart_addr, jump_bootstart_code)
+            self._patch('reset', jump_bootstart_addr, jump_bootstart_code)
             logger.debug('jump to bootstart after fix:  ' +
                          hexlify(jump_bootstart_code))
             
 class PIC32MZDevKit(PIC32DevKit):
     _supported = ['PIC32MZ']
 
-    boot_rom_addr   = 0x1fc00000
+def _build_map():
+    """Map each supported McuType to its devkit class"""
+    classes = {}
+    for clsname, cls in globals().items():
+        if hasattr(cls, '_supported'):
+            for mcu in cls._supported:
+                # a mcu cannot be supported by two different classes
+                assert(mcu not in classes)
+                classes[mcu] = cls
+    return classes
 
-    config_data_addr = boot_rom_addr | 0xff00  # configuration bits
+_map = _build_map()
 
-_map = {}
 def factory(bootinfo):
     """Factory for constructing devkit objects from a bootinfo dictionary"""
-    if len(_map) == 0:
-        for clsname, cls in globals().iteritems():
-            if hasattr(cls, '_supported'):
-                for mcu in cls._supported:
-                    # a mcu cannot be supported by two different classes
-                    assert(mcu not in _map)
-                    _map[mcu] = cls
     mcu = bootinfo['McuType']
     if not mcu in _map:
-        raise NotImplemented('support for this devkit is not yet implemented')
+        raise NotImplementedError('support for this devkit is not yet implemented')
     return _map[mcu](bootinfo)
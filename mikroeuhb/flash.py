@@ -0,0 +1,134 @@
+"""Reentrant programming API, for programs driving several devices at once
+(e.g. from a thread pool). flash() keeps no state outside of its
+arguments and of the objects it returns, and writes nothing to the
+standard output. A PreparedImage and an Options object may be shared by
+any number of concurrent calls."""
+import time, logging
+import devkit, image, journal, timing, blockstore
+from device import Device
+from progress import Progress
+logger = logging.getLogger(__name__)
+
+class Options(object):
+    """Options for flash(), which are never changed by it. See
+       Device.program for the meaning of each one. If on_info is supplied,
+       it is called with the bootinfo as soon as it is read."""
+    __slots__ = ('disable_bootloader', 'only', 'exclude', 'baseline',
+                 'journal_dir', 'resume', 'progress', 'keepalive', 'on_info')
+    def __init__(self, disable_bootloader=False, only=(), exclude=(),
+                 baseline=None, journal_dir=None, resume=False, progress=None,
+                 keepalive=.5, on_info=None):
+        self.disable_bootloader = disable_bootloader
+        self.only, self.exclude = tuple(only), tuple(exclude)
+        self.baseline = baseline
+        self.journal_dir, self.resume = journal_dir, resume
+        self.progress = progress
+        self.keepalive = keepalive
+        self.on_info = on_info
+
+    def __setattr__(self, name, value):
+        if hasattr(self, name):
+            raise AttributeError('Options are immutable')
+        object.__setattr__(self, name, value)
+
+default_options = Options()
+
+class Result(object):
+    """Outcome of a flash() call: the bootinfo read from the device, the
+       devkit model which was programmed, the block ranges [start,end)
+       which were erased and written, how long the call took and when the
+       REBOOT command was sent (as in time.time())."""
+    def __init__(self, bootinfo, kit, ranges, elapsed, rebooted_at):
+        self.bootinfo, self.kit, self.ranges = bootinfo, kit, ranges
+        self.elapsed, self.rebooted_at = elapsed, rebooted_at
+
+    @property
+    def blocks(self):
+        """Numbers of the blocks which were transferred"""
+        return [blk for start, end in self.ranges for blk in xrange(start, end)]
+
+    @property
+    def bytes_written(self):
+        return sum([len(self.kit.blocks[blk]) for blk in self.blocks])
+
+    def spans(self):
+        """Physical address intervals [start,end) which were written"""
+        return [self.kit._write_span(blk) for blk in self.blocks]
+
+    def snapshot(self):
+        """Contents of the device after programming, to be supplied as the
+           baseline of the next call (see DevKitModel.snapshot)"""
+        return self.kit.snapshot()
+
+def _image(dev, hexf, options):
+    """Return an object implementing index() and write_to(kit) for any of
+       the image kinds accepted by flash()"""
+    if isinstance(hexf, image.BackgroundImage):
+        pending, hexf = hexf, hexf.wait(options.keepalive)
+        while hexf is None:
+            with dev.timer.phase('keepalive'):
+                dev.cmd_info()
+            hexf = pending.wait(options.keepalive)
+    elif not isinstance(hexf, (image.Image, image.PreparedImage)):
+        hexf = image.load([hexf])
+    return hexf
+
+def flash(device, hexf, options=default_options):
+    """Program an image to a device, returning a Result.
+       The device may be a device.Device or a file object opened on the
+       bootloader's HID device. The image may be an image.PreparedImage
+       or a blockstore.StoredImage (which may be shared between threads),
+       an image.Image, an image.BackgroundImage or an Intel HEX file
+       object.
+       A journal is only kept (see Options.journal_dir) if the port of the
+       device is known (see Device.port).
+       Raises devkit.ImageError if the image does not fit in the memory
+       map of the device, before it is put into BOOT mode."""
+    dev = device if isinstance(device, Device) else Device(device)
+    timer = dev.timer
+    started = time.time()
+    with timer.phase('info'):
+        bootinfo = dev.cmd_info()
+    if options.on_info:
+        options.on_info(bootinfo)
+    if isinstance(hexf, blockstore.StoredImage):
+        # blocks were already validated and fixed when they were stored
+        with timer.phase('devkit'):
+            kit = dev.kit = hexf.model(bootinfo, options.disable_bootloader)
+    else:
+        with timer.phase('devkit'):
+            kit = dev.kit = devkit.factory(bootinfo)
+        with timer.phase('parse'):
+            hexf = _image(dev, hexf, options)
+        with timer.phase('validate'):
+            kit.validate(hexf.index())
+        with timer.phase('load'):
+            hexf.write_to(kit)
+        with timer.phase('fix'):
+            kit.fix_bootloader(options.disable_bootloader)
+    if options.only or options.exclude:
+        kit.select(options.only, options.exclude)
+    if options.baseline is not None:
+        kit.select_changed(options.baseline)
+    with timer.phase('boot'):
+        dev.cmd_boot()
+    with timer.phase('sync'):
+        dev.cmd_sync()
+    jnl = None
+    if options.journal_dir and dev.port is None:
+        # a journal keyed only by the model would be shared between boards
+        logger.warning('the port of the device is unknown -- not keeping a journal')
+    elif options.journal_dir:
+        jnl = journal.Journal.for_session(options.journal_dir, kit, bootinfo,
+                                          dev.port, options.resume)
+    tracker = None
+    if options.progress:
+        try:
+            profile = timing.profile(bootinfo['McuType'])
+        except KeyError:
+            profile = None
+        tracker = Progress(options.progress, profile)
+    ranges = kit.transfer(dev, jnl, tracker)
+    with timer.phase('reboot'):
+        dev.cmd_reboot()
+    return Result(bootinfo, kit, ranges, time.time() - started, dev.rebooted_at)
@@ -1,5 +1,5 @@
 import sys
 if sys.platform.startswith("linux"):
-    from linux import open_dev
+    from linux import open_dev, open_devs, usb_events, port_of, topology_of, claim_any
 else:
-    from generic import open_dev
+    from generic import open_dev, open_devs, usb_events, port_of, topology_of, claim_any
@@ -1,4 +1,5 @@
 import time, hid
+from .. import lease
 
 RETRY_INTERVAL = .2
 
@@ -9,16 +10,98 @@ class HidApiWrapper(object):
         self.h.write(bytearray(buff))
     def read(self, max_length):
         return bytes(bytearray(self.h.read(max_length)))
+    def close(self):
+        self.h.close()
 
-def open_dev(vendor, product):
-    """Wait a device to be attached and open it"""
+def _key(path):
+    """hidapi paths are bytes on Python 3"""
+    return path if isinstance(path, str) else path.decode('utf-8', 'replace')
+
+def _open_path(path):
     h = hid.device()
+    h.open_path(path)
+    h.set_nonblocking(False)
+    return HidApiWrapper(h)
+
+def open_dev(vendor, product, registry=None):
+    """Wait a device to be attached, claim it and open it. Returns a
+       lease.Lease usable as a file object. Raises lease.DeviceBusy if
+       every attached device is in use by another process."""
+    registry = registry or lease.Registry()
+    while True:
+        paths = [info['path'] for info in hid.enumerate(vendor, product)]
+        for path in paths:
+            claimed = lease.claim(registry, _key(path), _key(path),
+                                  lambda node: _open_path(path))
+            if claimed is not None:
+                return claimed
+        if paths:
+            raise lease.DeviceBusy('every %04x:%04x device is in use by another '
+                                   'process' % (vendor, product))
+        time.sleep(RETRY_INTERVAL)  # device not connected, retry
+
+def claim_any(vendor, product, registry=None):
+    """Claim any attached device which is not in use by another process,
+       without blocking. Returns a lease.Lease usable as a file object,
+       or None."""
+    registry = registry or lease.Registry()
+    registry.cleanup()
+    for info in hid.enumerate(vendor, product):
+        claimed = lease.claim(registry, _key(info['path']), _key(info['path']),
+                              lambda node: _open_path(info['path']))
+        if claimed is not None:
+            return claimed
+    return None
+
+def open_devs(vendor, product, wait=0., registry=None):
+    """Claim and open every attached device, also waiting up to wait
+       seconds for more devices to be attached. Devices in use by other
+       processes are skipped. Returns a list of (path, lease.Lease)
+       tuples."""
+    deadline = time.time() + wait
+    paths = []
     while True:
-        try:
-            h.open(vendor, product)
+        for info in hid.enumerate(vendor, product):
+            if info['path'] not in paths:
+                paths.append(info['path'])
+        if time.time() + RETRY_INTERVAL > deadline:
             break
-        except IOError as e:
-            pass  # device not connected, retry
         time.sleep(RETRY_INTERVAL)
-    h.set_nonblocking(False)
-    return HidApiWrapper(h)
+    registry = registry or lease.Registry()
+    devs = []
+    for path in paths:
+        claimed = lease.claim(registry, _key(path), _key(path),
+                              lambda node: _open_path(path))
+        if claimed is not None:
+            devs.append((path, claimed))
+    return devs
+
+def usb_events():
+    """Start monitoring HID devices being attached and removed (by polling
+       the list of devices). Returns a poll(timeout) function which returns
+       the next event as an (action, (vendor, product)) tuple, or None
+       after timeout seconds."""
+    def attached():
+        return set([(info['path'], (info['vendor_id'], info['product_id']))
+                    for info in hid.enumerate()])
+    state = {'devs': attached(), 'pending': []}
+    def poll(timeout):
+        deadline = time.time() + timeout
+        while not state['pending']:
+            devs = attached()
+            state['pending'] += [('remove', usbid) for path, usbid in state['devs'] - devs]
+            state['pending'] += [('add', usbid) for path, usbid in devs - state['devs']]
+            state['devs'] = devs
+            if state['pending'] or time.time() + RETRY_INTERVAL > deadline:
+                break
+            time.sleep(RETRY_INTERVAL)
+        return state['pending'].pop(0) if state['pending'] else None
+    return poll
+
+def port_of(f):
+    """USB port paths are not available through hidapi"""
+    return None
+
+def topology_of(f):
+    """Nor is the USB topology"""
+    return None
@@ -1,4 +1,5 @@
-import pyudev, logging
+import os, pyudev, logging, time
+from .. import lease, usbfs
 logger = logging.getLogger(__name__)
 
 def find_usbid(dev):
@@ -31,8 +32,151 @@ def wait_dev(vendor, product, subsystem='hidraw'):
                 logger.info('USB ID matches the expected one')
                 return dev
             
-def open_dev(vendor, product):
-    """Wait a device to be attached and open its device node"""
+def _usb_path(dev):
+    """USB path (e.g. 1-2.3) of the port at which a device is attached"""
+    usb_dev = dev.find_parent('usb', 'usb_device')
+    return usb_dev.sys_name if usb_dev is not None else dev.device_node
+
+def _open_node(node):
+    return open(node, 'r+b', buffering=0)
+
+def _open(dev):
+    """Open a hidraw device through its usbfs node if we are allowed to
+       (see usbfs.UsbFsDevFile), otherwise through hidraw. Set
+       $MIKROE_UHB_TRANSPORT to hidraw or usbfs to force a transport."""
+    transport = os.environ.get('MIKROE_UHB_TRANSPORT', 'auto')
+    if transport != 'hidraw':
+        usb_dev = dev.find_parent('usb', 'usb_device')
+        intf = dev.find_parent('usb', 'usb_interface')
+        node = usb_dev.device_node if usb_dev is not None else None
+        if node and intf is not None and (transport == 'usbfs' or
+                                          os.access(node, os.R_OK | os.W_OK)):
+            try:
+                f = usbfs.UsbFsDevFile(node, interface=int(
+                    intf.attributes.asstring('bInterfaceNumber'), 16))
+                logger.info('using usbfs transport through %s' % node)
+                return f
+            except EnvironmentError as err:
+                if transport == 'usbfs':
+                    raise
+                logger.info('usbfs transport unavailable (%s) -- using hidraw' % err)
+    return _open_node(dev.device_node)
+
+def open_dev(vendor, product, registry=None):
+    """Wait a device to be attached, claim it and open its device node.
+       Returns a lease.Lease usable as a file object. Raises
+       lease.DeviceBusy if another process claimed it first."""
     logger.debug('opening device vendor=%x, product=%x' % (vendor, product))
     udev_dev = wait_dev(vendor, product)
-    return open(udev_dev.device_node, 'r+b', buffering=0)
+    registry = registry or lease.Registry()
+    claimed = lease.claim(registry, _usb_path(udev_dev), udev_dev.device_node,
+                          lambda node: _open(udev_dev))
+    if claimed is None:
+        raise lease.DeviceBusy('%s is in use by another process' % udev_dev.device_node)
+    return claimed
+
+def claim_any(vendor, product, registry=None, subsystem='hidraw'):
+    """Claim any attached device with the supplied USB vendor and product
+       IDs which is not in use by another process, without blocking.
+       Returns a lease.Lease usable as a file object, or None."""
+    registry = registry or lease.Registry()
+    registry.cleanup()
+    context = pyudev.Context()
+    for dev in context.list_devices(subsystem=subsystem):
+        if find_usbid(dev) == (vendor, product):
+            claimed = lease.claim(registry, _usb_path(dev), dev.device_node,
+                                  lambda node: _open(dev))
+            if claimed is not None:
+                return claimed
+    return None
+
+def open_devs(vendor, product, wait=0., subsystem='hidraw', registry=None):
+    """Claim and open the device nodes of every attached device with the
+       supplied USB vendor and product IDs, also waiting up to wait seconds
+       for more devices to be attached. Each device is opened through usbfs
+       or hidraw, as in open_dev. Devices in use by other processes are
+       skipped. Returns a list of (device node, lease.Lease) tuples."""
+    context = pyudev.Context()
+    monitor = pyudev.Monitor.from_netlink(context)
+    monitor.filter_by(subsystem)
+    monitor.start()
+    devs = [dev for dev in context.list_devices(subsystem=subsystem)
+            if find_usbid(dev) == (vendor, product)]
+    deadline = time.time() + wait
+    while True:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            break
+        dev = monitor.poll(timeout=remaining)
+        if dev is None:
+            break
+        if dev.action == 'add' and find_usbid(dev) == (vendor, product) \
+                and dev.device_node not in [d.device_node for d in devs]:
+            logger.info('USB device %04x:%04x plugged at %s' % (
+                vendor, product, dev.device_node))
+            devs.append(dev)
+    registry = registry or lease.Registry()
+    claimed = []
+    for dev in devs:
+        f = lease.claim(registry, _usb_path(dev), dev.device_node,
+                        lambda node, dev=dev: _open(dev))
+        if f is None:
+            logger.info('skipping %s, which is in use' % dev.device_node)
+        else:
+            claimed.append((dev.device_node, f))
+    return claimed
+
+def usb_events():
+    """Start monitoring USB devices being attached and removed. Returns a
+       poll(timeout) function which returns the next event as an (action,
+       (vendor, product)) tuple, or None after timeout seconds."""
+    context = pyudev.Context()
+    monitor = pyudev.Monitor.from_netlink(context)
+    monitor.filter_by('usb', device_type='usb_device')
+    monitor.start()
+    def poll(timeout):
+        dev = monitor.poll(timeout=timeout)
+        if dev is None or dev.action not in ('add', 'remove'):
+            return None
+        # PRODUCT is also available when the device is removed, unlike
+        # the idVendor and idProduct attributes
+        product = dev.get('PRODUCT', '').split('/')
+        if len(product) < 2:
+            return None
+        return dev.action, (int(product[0], 16), int(product[1], 16))
+    return poll
+
+def port_of(f):
+    """Return the USB port path (e.g. 1-2.3) of an opened device node"""
+    try:
+        dev = pyudev.Device.from_device_file(pyudev.Context(), f.name)
+        if dev.device_type != 'usb_device':  # hidraw rather than usbfs
+            dev = dev.find_parent('usb', 'usb_device')
+        return dev.sys_name
+    except (AttributeError, ValueError, EnvironmentError):
+        return None
+
+def topology_of(f):
+    """Return the chain of USB devices from an opened device node up to
+       the root hub, as (name, speed in Mbit/s, multi_tt) tuples (see
+       schedule.tt_group), walking the parents as find_usbid does"""
+    try:
+        dev = pyudev.Device.from_device_file(pyudev.Context(), f.name)
+    except (AttributeError, ValueError, EnvironmentError):
+        return None
+    if dev.device_type != 'usb_device':
+        dev = dev.find_parent('usb', 'usb_device')
+    chain = []
+    while dev is not None:
+        attr = dev.attributes
+        try:
+            speed = float(attr.asstring('speed'))
+        except (KeyError, ValueError):
+            speed = 0.
+        try:
+            multi_tt = int(attr.asstring('bDeviceProtocol'), 16) == 2
+        except (KeyError, ValueError):
+            multi_tt = False
+        chain.append((dev.sys_name, speed, multi_tt))
+        dev = dev.find_parent('usb', 'usb_device')
+    return chain
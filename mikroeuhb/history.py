@@ -0,0 +1,128 @@
+"""History of programming sessions, kept in a SQLite database"""
+import time, socket, sqlite3
+import timing, journal
+
+_schema = """
+CREATE TABLE IF NOT EXISTS sessions (
+    id INTEGER PRIMARY KEY,
+    started REAL,           -- UNIX time
+    station TEXT,           -- host which programmed the device
+    hub TEXT,               -- USB hub (bus and port path)
+    port TEXT,              -- USB port, identifying a board at a station
+    mcu_type TEXT,
+    family TEXT,
+    boot_rev INTEGER,
+    mcu_size INTEGER,
+    device TEXT,            -- hash of the BootInfo (see journal.device_id)
+    image TEXT,             -- hash of the image (see journal.image_hash)
+    bytes INTEGER,          -- bytes written
+    transfer_time REAL,     -- time spent in ERASE and WRITE commands
+    duration REAL,          -- time taken by the whole session
+    outcome TEXT,           -- 'ok' or 'error'
+    error TEXT
+);
+CREATE TABLE IF NOT EXISTS erases (
+    session INTEGER REFERENCES sessions(id),
+    addr INTEGER,           -- address supplied to the ERASE command
+    blocks INTEGER,
+    duration REAL
+);
+CREATE TABLE IF NOT EXISTS erased_blocks (
+    session INTEGER REFERENCES sessions(id),
+    blk INTEGER             -- block number, as in the devkit model
+);
+CREATE TABLE IF NOT EXISTS writes (
+    session INTEGER REFERENCES sessions(id),
+    addr INTEGER,           -- address supplied to the WRITE command
+    size INTEGER,
+    duration REAL
+);
+CREATE INDEX IF NOT EXISTS erased_blocks_session ON erased_blocks(session);
+"""
+
+groupings = {
+    'station': 'station',
+    'hub': 'station || \' \' || hub',
+    'family': 'family',
+    'mcu': 'mcu_type',
+}
+"""SQL expressions by which throughput may be grouped"""
+
+def hub_of(port):
+    """Return the hub of a USB port path such as 1-2.3 (i.e. 1-2)"""
+    if port is None:
+        return None
+    return port.rsplit('.', 1)[0] if '.' in port else port.split('-')[0]
+
+class History(object):
+    """Records programming sessions in a SQLite database. Each session is
+       recorded at once, from the phases kept by a profiler.PhaseTimer
+       during the session, so nothing is written to the database while
+       data is being transferred to the device."""
+    def __init__(self, path, station=None):
+        self.db = sqlite3.connect(path)
+        self.db.executescript(_schema)
+        self.station = station or socket.gethostname()
+
+    def record(self, timer, bootinfo, kit=None, port=None, error=None):
+        """Record a session, given the PhaseTimer which timed it, the
+           bootinfo of the device, the devkit model (if it was built), the
+           USB port of the device and the error which ended the session
+           (if any). Returns the session id."""
+        phases = timer.phases
+        erases = [(p[3]['addr'], p[3]['blocks'], p[3].get('blk'), p[2])
+                  for p in phases if p[0] == 'erase']
+        writes = [(p[3]['addr'], p[3]['size'], p[2]) for p in phases if p[0] == 'write']
+        bootinfo = bootinfo or {}
+        mcu = bootinfo.get('McuType')
+        with self.db:
+            cur = self.db.execute(
+                'INSERT INTO sessions (started, station, hub, port, mcu_type, '
+                'family, boot_rev, mcu_size, device, image, bytes, transfer_time, '
+                'duration, outcome, error) VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)', (
+                    timer.origin, self.station, hub_of(port), port, mcu,
+                    timing.family(mcu) if mcu else None,
+                    bootinfo.get('BootRev'), bootinfo.get('McuSize'),
+                    journal.device_id(bootinfo) if bootinfo else None,
+                    journal.image_hash(kit) if kit is not None else None,
+                    sum([size for _, size, _ in writes]),
+                    sum([e[3] for e in erases]) + sum([w[2] for w in writes]),
+                    timer.clock() - timer.origin,
+                    'ok' if error is None else 'error',
+                    None if error is None else str(error) or type(error).__name__))
+            session = cur.lastrowid
+            self.db.executemany('INSERT INTO erases VALUES (?,?,?,?)',
+                                [(session, addr, blocks, duration)
+                                 for addr, blocks, _, duration in erases])
+            self.db.executemany('INSERT INTO erased_blocks VALUES (?,?)',
+                                [(session, blk + i) for _, blocks, blk, _ in erases
+                                 if blk is not None for i in xrange(blocks)])
+            self.db.executemany('INSERT INTO writes VALUES (?,?,?,?)',
+                                [(session,) + w for w in writes])
+        return session
+
+    def throughput(self, by='station', days=None, now=None):
+        """Return the daily throughput of successful sessions grouped by
+           one of the keys of groupings, as (key, day, sessions, bytes,
+           bytes per second of transfer) tuples"""
+        if by not in groupings:
+            raise ValueError('cannot group by "%s"' % by)
+        since = (now or time.time()) - days * 86400 if days else 0
+        return self.db.execute(
+            "SELECT %s AS k, date(started, 'unixepoch') AS day, count(*), "
+            "sum(bytes), sum(bytes) / sum(transfer_time) FROM sessions "
+            "WHERE outcome = 'ok' AND started >= ? AND transfer_time > 0 "
+            "GROUP BY k, day ORDER BY k, day" % groupings[by], (since,)).fetchall()
+
+    def erase_counts(self, limit=None):
+        """Return how many times each block of each board was erased, as
+           (station, port, mcu_type, blk, count) tuples, most erased first"""
+        query = ('SELECT station, port, mcu_type, blk, count(*) AS n '
+                 'FROM erased_blocks JOIN sessions ON session = sessions.id '
+                 'GROUP BY station, port, mcu_type, blk ORDER BY n DESC, blk')
+        if limit:
+            query += ' LIMIT %d' % limit
+        return self.db.execute(query).fetchall()
+
+    def close(self):
+        self.db.close()
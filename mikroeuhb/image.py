@@ -0,0 +1,261 @@
+"""Devkit-independent memory images, possibly composed of several hex files"""
+import threading
+from heapq import heappush, heappop
+import hexfile
+
+class OverlapError(ValueError):
+    """Raised when images overlap and the overlap policy is 'error'.
+       The overlaps attribute contains a list of Overlap tuples."""
+    def __init__(self, overlaps):
+        ValueError.__init__(self, 'images overlap:\n' + '\n'.join(
+            ['    ' + repr(o) for o in overlaps]))
+        self.overlaps = overlaps
+
+class Overlap(tuple):
+    """Interval [start,end) written by both the first and the second source"""
+    def __new__(cls, start, end, first, second):
+        return tuple.__new__(cls, (start, end, first, second))
+    start = property(lambda self: self[0])
+    end = property(lambda self: self[1])
+    first = property(lambda self: self[2])
+    second = property(lambda self: self[3])
+    def __repr__(self):
+        return '0x%x-0x%x: %s and %s' % self
+
+policies = ('error', 'last-wins', 'first-wins')
+
+class Image(object):
+    """Memory image (as seen by the program, i.e. in "virtual" addresses)
+       which can be later written to any devkit model. Implements the same
+       write(addr, data) method as a devkit, so it can be filled by
+       hexfile.load. Contiguous writes coming from the same source are
+       coalesced into a single extent.
+
+       Data from several sources (e.g. application, calibration and data
+       hex files) may be added. Overlaps between different sources are
+       resolved according to policy: 'error' raises an OverlapError,
+       'last-wins' keeps data from the source added last, 'first-wins'
+       keeps data from the source added first. Within a single source,
+       later records always overwrite earlier ones, as in hexfile.load."""
+    def __init__(self, policy='error'):
+        if policy not in policies:
+            raise ValueError('unknown overlap policy "%s"' % policy)
+        self.policy = policy
+        self.sources = []
+        self.extents = []   # [addr, bytearray, source index] lists
+        self._source = None
+        self._index = None  # cached result of self.index()
+
+    def add(self, f, source=None):
+        """Parse an Intel HEX file object into the image. The source name
+           is used for reporting overlaps (by default, the file name)."""
+        if source is None:
+            source = getattr(f, 'name', '<image %d>' % len(self.sources))
+        self.sources.append(source)
+        self._source = len(self.sources) - 1
+        try:
+            hexfile.load(f, self)
+        finally:
+            self._source = None
+        return self
+
+    def write(self, addr, data):
+        if self._source is None:
+            raise ValueError('write outside of Image.add')
+        self._index = None
+        if self.extents:
+            last = self.extents[-1]
+            if last[2] == self._source and last[0] + len(last[1]) == addr:
+                last[1] += data
+                return
+        self.extents.append([addr, bytearray(data), self._source])
+
+    def extend(self, other):
+        """Append the sources and extents of another Image to this one,
+           as if its hex files had been added again (without parsing
+           them). Returns self."""
+        offset = len(self.sources)
+        self._index = None
+        self.sources += other.sources
+        self.extents += [[addr, data, src + offset]
+                         for addr, data, src in other.extents]
+        return self
+
+    def size(self):
+        """Number of data bytes in the image (counting overlaps twice)"""
+        return sum([len(data) for _, data, _ in self.extents])
+
+    def sorted_extents(self):
+        """Return (start, end, data, source index) tuples sorted by start
+           address (stable with respect to the order of the writes)"""
+        return sorted([(addr, addr + len(data), data, src)
+                       for addr, data, src in self.extents],
+                      key=lambda e: e[0])
+
+    def overlaps(self):
+        """Find intervals written by more than one source, in O(n log n).
+           Each returned overlap is reported against the extent which
+           reached farthest among those starting before it."""
+        found = []
+        reach = None   # extent with the largest end address seen so far
+        for ext in self.sorted_extents():
+            start, end, _, src = ext
+            if reach is not None and start < reach[1] and src != reach[3]:
+                found.append(Overlap(start, min(end, reach[1]),
+                                     self.sources[reach[3]], self.sources[src]))
+            if reach is None or end > reach[1]:
+                reach = ext
+        return found
+
+    def _priority(self, seq, src):
+        """Priority of the seq-th extent when resolving overlaps"""
+        if self.policy == 'first-wins':
+            return (-src, seq)
+        return (src, seq)
+
+    def index(self):
+        """Resolve overlaps according to the policy, returning a sorted list
+           of non-overlapping (start, end, data, source index) tuples. Runs
+           in O(n log n) by sweeping over the extent boundaries while keeping
+           a heap of the extents covering the current point. The result
+           is kept until the image is changed."""
+        if self._index is not None:
+            return self._index
+        exts = self.sorted_extents()
+        prio = dict([(id(data), self._priority(seq, src)) for seq, (_, data, src)
+                     in enumerate(self.extents)])
+        points = sorted(set([e[0] for e in exts] + [e[1] for e in exts]))
+        heap, result, i = [], [], 0
+        for k in xrange(len(points) - 1):
+            point, next_point = points[k], points[k + 1]
+            while i < len(exts) and exts[i][0] <= point:
+                start, end, data, src = exts[i]
+                p = prio[id(data)]
+                heappush(heap, ((-p[0], -p[1]), end, start, data, src))
+                i += 1
+            while heap and heap[0][1] <= point:
+                heappop(heap)
+            if not heap:
+                continue
+            _, _, start, data, src = heap[0]
+            if result and result[-1][1] == point and result[-1][2] is data:
+                result[-1][1] = next_point
+            else:
+                result.append([point, next_point, data, src, start])
+        self._index = [(seg_start, seg_end, data[seg_start-start:seg_end-start], src)
+                       for seg_start, seg_end, data, src, start in result]
+        return self._index
+
+    def write_to(self, kit):
+        """Write the image to a devkit model (or any object implementing a
+           write(addr, data) method), after checking for overlaps"""
+        if self.policy == 'error':
+            overlaps = self.overlaps()
+            if overlaps:
+                raise OverlapError(overlaps)
+        for start, _, data, _ in self.index():
+            kit.write(start, data)
+        return kit
+
+    def freeze(self):
+        """Return a PreparedImage with the current contents of the image"""
+        return PreparedImage(self)
+
+class PreparedImage(object):
+    """Immutable image, with overlaps already resolved (and checked for, if
+       the policy is 'error'). Unlike an Image, which caches its index and
+       may still be changed, a PreparedImage may be shared by threads
+       programming several devices at once."""
+    __slots__ = ('policy', 'sources', '_index')
+    def __init__(self, image):
+        if image.policy == 'error':
+            overlaps = image.overlaps()
+            if overlaps:
+                raise OverlapError(overlaps)
+        self.policy = image.policy
+        self.sources = tuple(image.sources)
+        self._index = tuple([(start, end, bytes(data), src)
+                             for start, end, data, src in image.index()])
+
+    def index(self):
+        """Sorted tuple of non-overlapping (start, end, data, source index)
+           tuples, as in Image.index"""
+        return self._index
+
+    def size(self):
+        """Number of data bytes in the image"""
+        return sum([end - start for start, end, _, _ in self._index])
+
+    def write_to(self, kit):
+        """Write the image to a devkit model"""
+        for start, _, data, _ in self._index:
+            kit.write(start, data)
+        return kit
+
+def load(files, policy='error'):
+    """Build an Image from a list of Intel HEX file objects"""
+    image = Image(policy)
+    for f in files:
+        image.add(f)
+    return image
+
+def prepare(filenames, policy='error'):
+    """Parse a list of Intel HEX files into a PreparedImage"""
+    image = Image(policy)
+    for filename in filenames:
+        with open(filename, 'r') as f:
+            image.add(f)
+    return image.freeze()
+
+class BackgroundImage(object):
+    """Parses hex files into an Image (also resolving and checking for
+       overlaps) in a background thread, so that parsing takes place while
+       waiting for the device to be attached. The files are opened right
+       away, so that an EnvironmentError (e.g. a missing file) is raised
+       by the constructor rather than once the device is attached."""
+    def __init__(self, filenames, policy='error'):
+        self.filenames = filenames
+        self.policy = policy
+        self._files = []
+        try:
+            for filename in filenames:
+                self._files.append(open(filename, 'r'))
+        except EnvironmentError:
+            self._close()
+            raise
+        self._image = self._error = None
+        self._done = threading.Event()
+        thread = threading.Thread(target=self._run, name='hex parser')
+        thread.daemon = True
+        thread.start()
+
+    def _close(self):
+        for f in self._files:
+            f.close()
+
+    def _run(self):
+        try:
+            image = Image(self.policy)
+            for f in self._files:
+                image.add(f)
+            if self.policy == 'error':
+                overlaps = image.overlaps()
+                if overlaps:
+                    raise OverlapError(overlaps)
+            image.index()
+            self._image = image
+        except Exception as err:
+            self._error = err
+        finally:
+            self._close()
+            self._done.set()
+
+    def wait(self, timeout=None):
+        """Return the Image, or None if it is still being prepared after
+           timeout seconds. Exceptions raised while preparing the image
+           are raised again here."""
+        if not self._done.wait(timeout):
+            return None
+        if self._error is not None:
+            raise self._error
+        return self._image
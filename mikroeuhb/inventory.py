@@ -0,0 +1,75 @@
+"""Inventory of every attached bootloader, queried concurrently"""
+import threading, time, json, logging
+from device import Device
+logger = logging.getLogger(__name__)
+
+group_fields = ('McuType', 'BootRev', 'McuSize')
+
+class _Query(threading.Thread):
+    """Thread which sends INFO to a device and keeps its BootInfo (or the
+       exception raised while querying it)"""
+    def __init__(self, name, f):
+        threading.Thread.__init__(self, name='inventory %s' % name)
+        self.daemon = True  # do not hang the process on a mute device
+        self.dev = Device(f)
+        self.bootinfo = self.error = None
+    def run(self):
+        try:
+            self.bootinfo = self.dev.cmd_info()
+        except Exception as err:
+            self.error = err
+
+def scan(devs, timeout=1.):
+    """Send INFO to every device of a list of (name, file object) tuples
+       at once, waiting up to timeout seconds for all of them to reply.
+       Returns a list of (name, BootInfo or None, error message or None)
+       tuples, in the same order as devs."""
+    queries = [_Query(name, f) for name, f in devs]
+    for q in queries:
+        q.start()
+    deadline = time.time() + timeout
+    results = []
+    for (name, _), q in zip(devs, queries):
+        q.join(max(0., deadline - time.time()))
+        if q.is_alive():
+            logger.warning('device %s did not reply to INFO' % name)
+            results.append((name, None, 'timeout'))
+        elif q.error is not None:
+            logger.warning('device %s: %s' % (name, q.error))
+            results.append((name, None, str(q.error)))
+        else:
+            results.append((name, q.bootinfo, None))
+    return results
+
+def group(results):
+    """Group the devices which replied by McuType, BootRev and McuSize.
+       Returns a sorted list of (key, names) tuples, where key is a
+       tuple of the values of the fields in group_fields."""
+    groups = {}
+    for name, bootinfo, error in results:
+        if bootinfo is not None:
+            key = tuple([bootinfo.get(field) for field in group_fields])
+            groups.setdefault(key, []).append(name)
+    return sorted(groups.items())
+
+def format_text(results):
+    """Return the inventory as a human-readable table"""
+    lines = ['%-12s %8s %10s %5s  devices' % (group_fields + ('count',))]
+    for (mcu, rev, size), names in group(results):
+        lines.append('%-12s %8s %10s %5d  %s' % (
+            mcu, '0x%04x' % rev if rev is not None else '-',
+            '0x%x' % size if size is not None else '-',
+            len(names), ' '.join(names)))
+    for name, bootinfo, error in results:
+        if bootinfo is None:
+            lines.append('%s: %s' % (name, error))
+    return '\n'.join(lines) + '\n'
+
+def to_json(results):
+    """Return the inventory as a JSON string"""
+    return json.dumps({
+        'groups': [dict(zip(group_fields, key), count=len(names), devices=names)
+                   for key, names in group(results)],
+        'errors': [{'device': name, 'error': error}
+                   for name, bootinfo, error in results if bootinfo is None],
+    }, sort_keys=True)
@@ -0,0 +1,106 @@
+"""Transfer journal, which allows resuming interrupted programming sessions"""
+import os, json, hashlib, logging
+logger = logging.getLogger(__name__)
+
+def image_hash(kit):
+    """Hash the data which a devkit model would transfer to the device"""
+    h = hashlib.sha1()
+    for blk in sorted(kit.blocks.keys()):
+        h.update(('%d:%d:%d:' % ((blk,) + tuple(kit.blockaddr[blk]))).encode('ascii'))
+        h.update(bytes(kit.blocks[blk]))
+    return h.hexdigest()
+
+def device_id(bootinfo):
+    """Hash identifying a device model from its bootinfo dictionary"""
+    fields = sorted([(k, repr(v)) for k, v in bootinfo.items()])
+    return hashlib.sha1(repr(fields).encode('ascii')).hexdigest()
+
+def board_id(bootinfo, port):
+    """Hash identifying a physical board: its model, and the port (e.g. the
+       USB path 1-2.3) at which it is attached"""
+    return hashlib.sha1(('%s:%s' % (device_id(bootinfo), port)).encode('utf-8')).hexdigest()
+
+class Journal(object):
+    """Records each ERASE and WRITE command acknowledged by the device in a
+       file, one JSON object per line. The first line identifies the image
+       and the board, so that a journal is only reused by a session which
+       programs the same image to the same board.
+
+       If resume is False, or the existing journal belongs to a different
+       session, the journal starts empty."""
+    def __init__(self, path, image, device, resume=True):
+        self.path = path
+        self.header = {'image': image, 'device': device}
+        self.erased_ranges = []
+        self.written_chunks = set()
+        if resume and os.path.exists(path):
+            self._load()
+        mode = 'a' if self.erased_ranges or self.written_chunks else 'w'
+        self.f = open(path, mode)
+        if mode == 'w':
+            self._append(self.header)
+
+    @staticmethod
+    def for_session(directory, kit, bootinfo, port, resume=True):
+        """Open the journal of a session in directory (created if needed).
+           The file name is derived from the image and board hashes, so
+           that boards of the same model never share a journal."""
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        image, device = image_hash(kit), board_id(bootinfo, port)
+        path = os.path.join(directory, '%s-%s.journal' % (image[:16], device[:16]))
+        return Journal(path, image, device, resume)
+
+    def _load(self):
+        with open(self.path) as f:
+            try:
+                entries = [json.loads(line) for line in f if line.strip()]
+            except ValueError:
+                # The last line may have been cut if the process was killed
+                logger.warning('journal %s is corrupted -- starting over' % self.path)
+                return
+        if not entries or entries[0] != self.header:
+            logger.info('journal %s belongs to another session' % self.path)
+            return
+        for entry in entries[1:]:
+            if 'erase' in entry:
+                self.erased_ranges.append(tuple(entry['erase']))
+            elif 'write' in entry:
+                self.written_chunks.add(tuple(entry['write']))
+        logger.info('resuming from journal %s: %d erase ranges, %d chunks written' % (
+            self.path, len(self.erased_ranges), len(self.written_chunks)))
+
+    def _append(self, entry):
+        self.f.write(json.dumps(entry, sort_keys=True) + '\n')
+        self.f.flush()
+
+    def erased(self, start, end):
+        """Record that blocks [start,end) were erased"""
+        self._append({'erase': [start, end]})
+
+    def written(self, blk, blk_off):
+        """Record that the WRITE chunk starting at blk_off of block blk
+           was acknowledged"""
+        self.written_chunks.add((blk, blk_off))
+        self._append({'write': [blk, blk_off]})
+
+    def _block_done(self, kit, blk):
+        """A block is done if all of its WRITE chunks were acknowledged"""
+        return all([(blk, blk_off) in self.written_chunks for blk_off in
+                    xrange(0, len(kit.blocks[blk]), kit._write_max)])
+
+    def pending(self, kit, ranges):
+        """Filter a transfer plan (list of block ranges) returned by
+           kit._plan, removing blocks which were completely written.
+           Blocks only partially written are erased and written again."""
+        result = []
+        for start, end in ranges:
+            blocks = [blk for blk in xrange(start, end)
+                      if not self._block_done(kit, blk)]
+            result += kit._ranges(blocks)
+        return result
+
+    def complete(self):
+        """Discard the journal after a successful transfer"""
+        self.f.close()
+        os.remove(self.path)
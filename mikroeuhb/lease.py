@@ -0,0 +1,211 @@
+"""Arbitration of devices between processes sharing a station.
+
+Each board is leased by holding an advisory lock (flock) on a file named
+after its USB path in a registry directory. The lock is released by the
+kernel when its holder dies, so a lease left behind by a crashed process
+is simply taken over by the next one to claim the board. The device node
+itself is also locked, so that tools which flock the node directly are
+excluded as well."""
+import os, re, time, errno, tempfile, logging
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # no advisory locking (e.g. on Windows)
+logger = logging.getLogger(__name__)
+
+class DeviceBusy(Exception):
+    """The device is leased by another process"""
+
+def _lock(fd):
+    """Try to lock a file descriptor without blocking"""
+    if fcntl is None:
+        return True
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return True
+    except (IOError, OSError) as err:
+        if err.errno in (errno.EAGAIN, errno.EACCES, errno.EWOULDBLOCK):
+            return False
+        raise
+
+def _cloexec(fd):
+    """Do not let the lock be inherited by programs we execute"""
+    if fcntl is not None:
+        fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+
+def lock_node(f):
+    """Try to lock an opened device node, returning False if another
+       process holds the lock"""
+    return _lock(f.fileno())
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as err:
+        return err.errno == errno.EPERM
+    return True
+
+def default_dir():
+    """Directory of the lease registry: $MIKROE_UHB_LEASES if set, else
+       /run/lock/mikroe-uhb if /run/lock is writable, else a directory
+       under the temporary directory"""
+    if os.environ.get('MIKROE_UHB_LEASES'):
+        return os.environ['MIKROE_UHB_LEASES']
+    if os.access('/run/lock', os.W_OK):
+        return '/run/lock/mikroe-uhb'
+    return os.path.join(tempfile.gettempdir(), 'mikroe-uhb-leases')
+
+class Lease(object):
+    """A claim on a board, valid until released or until the process
+       dies. Once the device is opened and attached, the lease may be used
+       in place of its file object (e.g. supplied to device.Device), and
+       closing it also releases the claim."""
+    def __init__(self, registry, key, fd):
+        self.registry, self.key, self.fd = registry, key, fd
+        self.file = None
+
+    def attach(self, f):
+        self.file = f
+        return self
+
+    @property
+    def name(self):
+        return self.file.name
+
+    def write(self, buf):
+        return self.file.write(buf)
+
+    def read(self, size):
+        return self.file.read(size)
+
+    def fileno(self):
+        return self.file.fileno()
+
+    def release(self):
+        """Close the device (if attached) and give up the claim"""
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        if self.fd is not None:
+            # unlink before unlocking, so nobody locks a file on its way out
+            try:
+                os.unlink(self.registry.path(self.key))
+            except OSError:
+                pass
+            os.close(self.fd)
+            self.fd = None
+
+    close = release
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+class Registry(object):
+    """Directory of lease files, keyed by the USB path of each board
+       (e.g. 1-2.3). Each file holds the pid of its holder, the device node
+       and the time at which it was claimed, for informational purposes."""
+    def __init__(self, directory=None):
+        self.dir = directory or default_dir()
+        try:
+            os.makedirs(self.dir)
+            os.chmod(self.dir, 0o1777)  # shared between users, like /tmp
+        except OSError as err:
+            if err.errno != errno.EEXIST:
+                raise
+
+    def path(self, key):
+        return os.path.join(self.dir, re.sub(r'[^-\w.:]', '_', key) + '.lease')
+
+    def _open_locked(self, path):
+        """Open and lock path, returning the file descriptor, or None if
+           it is locked by someone else. Retries if the file was replaced
+           while we were waiting for the lock."""
+        while True:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o666)
+            _cloexec(fd)
+            if not _lock(fd):
+                os.close(fd)
+                return None
+            try:
+                same = os.fstat(fd).st_ino == os.stat(path).st_ino
+            except OSError:
+                same = False  # unlinked by the previous holder
+            if same:
+                return fd
+            os.close(fd)
+
+    def acquire(self, key, node=None):
+        """Try to claim the board at USB path key without blocking.
+           Returns a Lease, or None if another process holds it."""
+        path = self.path(key)
+        fd = self._open_locked(path)
+        if fd is None:
+            return None
+        previous = os.read(fd, 256).split()
+        if previous and previous[0].isdigit() and int(previous[0]) != os.getpid():
+            logger.info('taking over stale lease of %s from dead process %s' % (
+                key, previous[0]))
+        os.lseek(fd, 0, os.SEEK_SET)
+        os.ftruncate(fd, 0)
+        os.write(fd, ('%d %s %.3f\n' % (os.getpid(), node or '-', time.time())).encode())
+        return Lease(self, key, fd)
+
+    def holders(self):
+        """Return the leases currently held, as (key file, pid, device
+           node, time claimed) tuples"""
+        held = []
+        for name in sorted(os.listdir(self.dir)):
+            if not name.endswith('.lease'):
+                continue
+            try:
+                with open(os.path.join(self.dir, name)) as f:
+                    fields = f.read().split()
+            except IOError:
+                continue
+            if len(fields) == 3 and _pid_alive(int(fields[0])):
+                held.append((name[:-len('.lease')], int(fields[0]),
+                             fields[1], float(fields[2])))
+        return held
+
+    def cleanup(self):
+        """Remove lease files left behind by processes which died. Returns
+           the number of files removed."""
+        removed = 0
+        for name in os.listdir(self.dir):
+            if not name.endswith('.lease'):
+                continue
+            path = os.path.join(self.dir, name)
+            fd = self._open_locked(path)
+            if fd is None:
+                continue  # held by a live process
+            try:
+                os.unlink(path)
+                removed += 1
+            finally:
+                os.close(fd)
+        if removed:
+            logger.info('removed %d stale leases from %s' % (removed, self.dir))
+        return removed
+
+def claim(registry, key, node, opener):
+    """Claim the board at USB path key, then open its device node with
+       opener(node) and lock it. Returns the attached Lease, or None if
+       the board is busy or went away meanwhile."""
+    lease = registry.acquire(key, node)
+    if lease is None:
+        return None
+    try:
+        f = opener(node)
+    except EnvironmentError as err:
+        logger.info('could not open %s: %s' % (node, err))
+        lease.release()
+        return None
+    if hasattr(f, 'fileno') and not lock_node(f):
+        logger.info('%s is locked by another process' % node)
+        f.close()
+        lease.release()
+        return None
+    return lease.attach(f)
@@ -0,0 +1,181 @@
+"""Database of MCU memory maps, from which the Flash block layout of each
+   devkit is computed.
+
+Each entry of maps describes the memory of an MCU family (keyed as in
+timing.family) or of a single part (keyed by its McuType, taking
+precedence over its family), using only JSON-compatible values:
+
+    windows     attributes set on the devkit model, e.g. flash_mem_offset
+                or config_data_addr (see devkit.DevKitModel)
+    regions     list of Flash regions made of erasable blocks, each with:
+        start, end  bounds of the region (end exclusive), as numbers or as
+                    expressions summing numbers, names of windows and the
+                    BootStart, EraseBlock and McuSize bootinfo fields,
+                    e.g. "main_flash_addr + McuSize"
+        align       if "down", the end is moved down to a block boundary
+        sectors     list of [count, size] runs of blocks, for parts whose
+                    blocks are not all EraseBlock bytes long
+    scale       [num, den] ratio between physical Flash byte positions and
+                the addresses reported by the device, applied to the bounds
+
+More entries may be loaded from JSON files with the same format, either
+by calling load() or by listing them in $MIKROE_UHB_MEMMAP, so that new
+parts are supported without changing code."""
+import os, json, bisect, threading
+from array import array
+import timing
+
+maps = {
+    'default': {
+        'regions': [{'start': 0, 'end': 'BootStart'}],
+    },
+    # http://www.mikroe.com/download/eng/documents/compilers/mikroc/pro/arm/help/flash_memory_library.htm#flash_addresstosector
+    'STM32': {
+        'windows': {'flash_mem_offset': 0x8000000},
+        'regions': [{'start': 0, 'end': 'BootStart',
+                     'sectors': [[4, 16*1024], [1, 64*1024], [6, 128*1024]]}],
+    },
+    'PIC18': {
+        'windows': {'config_data_addr': 0x300000},
+        'regions': [{'start': 0, 'end': 'BootStart'}],
+    },
+    # three bytes of Flash for every two units of PIC24 address
+    'PIC24': {
+        'windows': {'config_data_addr': 0x1f00008},
+        'regions': [{'start': 0, 'end': 'BootStart'}],
+        'scale': [3, 2],
+    },
+    # the boot Flash region stops before the block containing the
+    # configuration bits, to prevent its erasure
+    'PIC32': {
+        'windows': {'main_flash_addr': 0x1d000000, 'boot_rom_addr': 0x1fc00000,
+                    'config_data_addr': 0x1fc02ff0},
+        'regions': [{'start': 'main_flash_addr', 'end': 'main_flash_addr + McuSize'},
+                    {'start': 'boot_rom_addr', 'end': 'config_data_addr',
+                     'align': 'down'}],
+    },
+    'PIC32MZ': {
+        'windows': {'main_flash_addr': 0x1d000000, 'boot_rom_addr': 0x1fc00000,
+                    'config_data_addr': 0x1fc0ff00},
+        'regions': [{'start': 'main_flash_addr', 'end': 'main_flash_addr + McuSize'},
+                    {'start': 'boot_rom_addr', 'end': 'config_data_addr',
+                     'align': 'down'}],
+    },
+}
+
+_compiled = {}   # key of maps -> MemoryMap
+_loaded_env = False
+_lock = threading.RLock()   # guards the caches above and MemoryMap._tables
+
+def load(path):
+    """Load more entries from a JSON file, replacing entries with the
+       same keys"""
+    with open(path) as f:
+        entries = json.load(f)
+    with _lock:
+        for key, entry in entries.items():
+            maps[str(key)] = entry
+            _compiled.pop(str(key), None)
+
+def _eval(expr, names):
+    """Evaluate a bound given as a number or as a sum of terms"""
+    if not hasattr(expr, 'split'):
+        return expr
+    total = 0
+    for term in expr.split('+'):
+        term = term.strip()
+        if term in names:
+            total += names[term]
+        else:
+            try:
+                total += int(term, 0)
+            except ValueError:
+                raise ValueError('unknown name "%s" in memory map' % term)
+    return total
+
+class BlockTable(object):
+    """Compiled block layout: block blk spans [starts[blk], ends[blk]).
+       Behaves as a sequence of (start, end) tuples, and finds the block
+       containing an address by bisection."""
+    def __init__(self, starts, ends):
+        self.starts, self.ends = starts, ends
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __getitem__(self, blk):
+        return self.starts[blk], self.ends[blk]
+
+    def __iter__(self):
+        return iter(zip(self.starts, self.ends))
+
+    def find(self, addr):
+        """Return the number of the block containing addr, or None"""
+        blk = bisect.bisect_right(self.starts, addr) - 1
+        if blk < 0 or addr >= self.ends[blk]:
+            return None
+        return blk
+
+class MemoryMap(object):
+    """An entry of maps, ready to be compiled into BlockTables. Tables are
+       compiled once for each combination of bootinfo fields, and shared
+       by every devkit model built with them (so they must not be changed)."""
+    def __init__(self, key, entry):
+        self.key = key
+        self.windows = dict([(str(name), value) for name, value in
+                             entry.get('windows', {}).items()])
+        self.regions = entry['regions']
+        self.scale = tuple(entry.get('scale', (1, 1)))
+        self._tables = {}
+
+    def _scale(self, addr):
+        num, den = self.scale
+        if addr % den != 0:
+            raise ValueError('address 0x%x is not a multiple of %d' % (addr, den))
+        return num * addr // den
+
+    def table(self, BootStart, EraseBlock, McuSize):
+        """Return the BlockTable for the given bootinfo fields"""
+        key = (BootStart, EraseBlock, McuSize)
+        with _lock:
+            if key not in self._tables:
+                self._tables[key] = self._compile(BootStart, EraseBlock, McuSize)
+            return self._tables[key]
+
+    def _compile(self, BootStart, EraseBlock, McuSize):
+        names = dict(self.windows, BootStart=BootStart, EraseBlock=EraseBlock,
+                     McuSize=McuSize)
+        starts, ends = array('L'), array('L')
+        for region in self.regions:
+            start = self._scale(_eval(region['start'], names))
+            end = self._scale(_eval(region['end'], names))
+            if region.get('align') == 'down':
+                end -= (end - start) % EraseBlock
+            sectors = region.get('sectors') or [((end - start) // EraseBlock, EraseBlock)]
+            addr = start
+            for count, size in sectors:
+                for i in xrange(count):
+                    starts.append(addr)
+                    addr += size
+                    ends.append(addr)
+            if addr != end:
+                raise ValueError('blocks of memory map "%s" span [0x%x,0x%x) '
+                                 'instead of [0x%x,0x%x)' % (self.key, start,
+                                                             addr, start, end))
+        return BlockTable(starts, ends)
+
+def lookup(mcu):
+    """Return the MemoryMap of a McuType (or of its family, if there is no
+       entry specific to the part, or else the default one)"""
+    global _loaded_env
+    with _lock:
+        if not _loaded_env:
+            _loaded_env = True
+            for path in os.environ.get('MIKROE_UHB_MEMMAP', '').split(os.pathsep):
+                if path:
+                    load(path)
+        for key in (mcu, timing.family(mcu), 'default'):
+            if key in maps:
+                if key not in _compiled:
+                    _compiled[key] = MemoryMap(key, maps[key])
+                return _compiled[key]
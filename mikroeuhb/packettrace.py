@@ -0,0 +1,69 @@
+"""Packet trace kept in a ring buffer, for post-mortem analysis of failures"""
+import time
+from array import array
+from util import hexlify
+
+class PacketTrace(object):
+    """Records the last capacity reports exchanged with the device. Space
+       for all of them is preallocated, so that recording a report only
+       copies its raw contents along with a timestamp and its direction
+       ('o' for host to device, 'i' for device to host).
+
+       The trace can be dumped in the format output by devtools/usbcap.awk
+       with timestamps, which is read by devtools/dissec.py, devtools/replay.py
+       and the test captures."""
+    def __init__(self, capacity=4096, packet_size=64, clock=time.time):
+        assert(capacity > 0)
+        self.capacity = capacity
+        self.packet_size = packet_size
+        self.clock = clock
+        self.origin = clock()
+        self.count = 0      # number of reports recorded since the creation
+        self._times = array('d', [0.]) * capacity
+        self._dirs = bytearray(capacity)
+        self._lens = array('H', [0]) * capacity
+        self._data = bytearray(capacity * packet_size)
+
+    def record(self, direction, data):
+        """Record a report (data is truncated to packet_size bytes)"""
+        i = self.count % self.capacity
+        self.count += 1
+        self._times[i] = self.clock()
+        self._dirs[i] = ord(direction)
+        n = min(len(data), self.packet_size)
+        self._lens[i] = n
+        off = i * self.packet_size
+        self._data[off:off+n] = data if n == len(data) else data[:n]
+
+    def dropped(self):
+        """Number of reports which were overwritten by newer ones"""
+        return max(0, self.count - self.capacity)
+
+    def packets(self):
+        """Yield the recorded (timestamp, direction, data) tuples, oldest
+           first, with timestamps relative to the creation of the trace"""
+        first = self.dropped()
+        for k in xrange(first, self.count):
+            i = k % self.capacity
+            off = i * self.packet_size
+            yield (self._times[i] - self.origin, chr(self._dirs[i]),
+                   bytes(self._data[off:off+self._lens[i]]))
+
+    def dump(self, f):
+        """Write the recorded reports to the text file f"""
+        for ts, direction, data in self.packets():
+            f.write('%.6f %s %s\n' % (ts, direction, hexlify(data)))
+
+class NullTrace(object):
+    """Trace which records nothing (used when tracing is disabled)"""
+    count = 0
+    def record(self, direction, data):
+        pass
+    def dropped(self):
+        return 0
+    def packets(self):
+        return iter(())
+    def dump(self, f):
+        pass
+
+null_trace = NullTrace()
@@ -0,0 +1,179 @@
+"""Offline planning of programming sessions: which commands would be sent
+   to a device, how many reports they take and how long they would last,
+   computed without any device attached"""
+import os, re, json
+from binascii import unhexlify
+from device import Device, Command, HID_buf_size
+import timing
+
+def read_bootinfo(arg):
+    """Return the raw BootInfo given as a hex string (as in the tests) or
+       as the name of a file containing either a hex string or the raw
+       INFO response"""
+    if os.path.exists(arg):
+        with open(arg, 'rb') as f:
+            data = f.read()
+        if re.match(br'^[0-9a-fA-F\s]+$', data):
+            data = unhexlify(re.sub(br'\s+', b'', data))
+    else:
+        data = unhexlify(re.sub(r'\s+', '', arg))
+    return data.ljust(HID_buf_size, b'\x00')
+
+class Step(object):
+    """A command sent to the device, along with the data reports which
+       followed it and the reports sent back by the device (ACKs or, for
+       INFO, the BootInfo). For ERASE, nbytes is the size of the blocks
+       erased; for WRITE, the amount of data written."""
+    __slots__ = ('cmd', 'addr', 'counter', 'packets', 'replies', 'nbytes')
+    def __init__(self, cmd, addr, counter):
+        self.cmd, self.addr, self.counter = cmd, addr, counter
+        self.packets = self.replies = self.nbytes = 0
+
+    @property
+    def name(self):
+        return Command._map.get(self.cmd, hex(self.cmd))
+
+    def reports(self):
+        return 1 + self.packets + self.replies
+
+    def duration(self, profile):
+        """Estimated duration: one HID interval per report (in either
+           direction), plus the time the device takes to erase or program"""
+        busy = 0.
+        if self.cmd == Command.ERASE:
+            busy = profile.erase_time(self.nbytes, self.counter)
+        elif self.cmd == Command.WRITE:
+            busy = profile.write_time(self.nbytes)
+        return self.reports() * profile.hid_interval + busy
+
+class PlanDevice(Device):
+    """Device which records the commands and data sent to it instead of
+       talking to a real device, acknowledging every command. Its INFO
+       response is the supplied raw BootInfo."""
+    def __init__(self, bootinforaw):
+        Device.__init__(self, None)
+        self.bootinforaw = bootinforaw
+        self.steps = []
+    def send(self, cmd):
+        self.steps.append(Step(cmd.cmd, cmd.addr, cmd.counter))
+    def send_data(self, data):
+        step = self.steps[-1]
+        step.packets += 1
+        step.nbytes += len(data)
+    def recv(self):
+        step = self.steps[-1]
+        step.replies += 1
+        return Command.from_attr(step.cmd, step.addr, step.counter)
+    def recv_data(self):
+        self.steps[-1].replies += 1
+        return self.bootinforaw
+
+class Plan(object):
+    """Commands which Device.program would send to program an image, as a
+       list of Steps. Also keeps the devkit model which was programmed."""
+    def __init__(self, kit, steps):
+        self.kit, self.steps = kit, steps
+        # erase addresses refer to the last block erased
+        last_blk = dict([(kit._erase_addr(blk), blk) for blk in xrange(len(kit.blockaddr))])
+        for step in steps:
+            if step.cmd == Command.ERASE:
+                last = last_blk[step.addr]
+                step.nbytes = sum([end - start for start, end in
+                                   [kit.blockaddr[blk] for blk in
+                                    xrange(last - step.counter + 1, last + 1)]])
+
+    def totals(self):
+        """Return a dictionary with the number of commands of each kind, of
+           data reports sent, of reports sent back by the device, of blocks
+           erased and of bytes written"""
+        totals = dict([(name, 0) for name in Command._map.values()])
+        totals.update(packets=0, replies=0, blocks=0, bytes=0)
+        for step in self.steps:
+            totals[step.name] += 1
+            totals['packets'] += step.packets
+            totals['replies'] += step.replies
+            if step.cmd == Command.ERASE:
+                totals['blocks'] += step.counter
+            elif step.cmd == Command.WRITE:
+                totals['bytes'] += step.nbytes
+        return totals
+
+    def estimate(self, profile):
+        """Estimated duration of the session, in seconds"""
+        return sum([step.duration(profile) for step in self.steps])
+
+    def format_text(self, profile):
+        lines = ['%-6s %10s %8s %8s %7s %9s' % ('cmd', 'addr', 'count',
+                                                'packets', 'replies', 'time')]
+        for step in self.steps:
+            lines.append('%-6s 0x%08x %8d %8d %7d %8.3fs' % (
+                step.name, step.addr, step.counter, step.packets, step.replies,
+                step.duration(profile)))
+        totals = self.totals()
+        lines.append('%(ERASE)d ERASE (%(blocks)d blocks), %(WRITE)d WRITE '
+                     '(%(bytes)d bytes), %(packets)d data reports, '
+                     '%(replies)d replies' % totals)
+        lines.append('estimated duration: %.3fs (%r)' % (self.estimate(profile),
+                                                         profile))
+        return '\n'.join(lines) + '\n'
+
+    def to_json(self, profile):
+        return json.dumps({
+            'steps': [{'cmd': step.name, 'addr': step.addr, 'counter': step.counter,
+                       'packets': step.packets, 'replies': step.replies,
+                       'bytes': step.nbytes, 'duration': step.duration(profile)}
+                      for step in self.steps],
+            'totals': self.totals(),
+            'estimate': self.estimate(profile),
+        }, sort_keys=True)
+
+def plan(bootinforaw, hexf, **kwargs):
+    """Plan the programming of hexf (a file, image.Image or
+       image.BackgroundImage) to a device with the supplied raw BootInfo.
+       Keyword arguments are passed to Device.program (e.g. only, exclude
+       or baseline). Returns a Plan."""
+    dev = PlanDevice(bootinforaw)
+    kit = dev.program(hexf, print_info=False, **kwargs)
+    return Plan(kit, dev.steps)
+
+def diff(bootinforaw, old, new, **kwargs):
+    """Plan the programming of the image new to a device which was last
+       programmed with the image old. Returns the numbers of the blocks
+       which differ, and the Plan of the incremental transfer."""
+    baseline = plan(bootinforaw, old, **kwargs).kit.snapshot()
+    result = plan(bootinforaw, new, baseline=baseline, **kwargs)
+    return sorted(result.kit.selected), result
+
+def calibrate(profile, report, kit):
+    """Return a copy of a timing.TimingProfile adjusted to match the
+       durations measured in a real session, given as the report saved by
+       mikroe-uhb --profile-json (a dictionary) and the devkit model of
+       the device. The erase parameters are scaled by the same factor, and
+       the programming rate is derived from the time left after the HID
+       reports are accounted for."""
+    hid = profile.hid_interval
+    erase_measured = erase_estimated = 0.
+    write_measured = write_bytes = write_reports = 0
+    for phase in report['phases']:
+        if phase['name'] == 'erase':
+            blk, blocks = phase.get('blk'), phase['blocks']
+            if blk is None:
+                nbytes = blocks * kit.EraseBlock
+            else:
+                nbytes = sum([kit.blockaddr[b][1] - kit.blockaddr[b][0]
+                              for b in xrange(blk, blk + blocks)])
+            erase_measured += phase['duration'] - 2 * hid
+            erase_estimated += profile.erase_time(nbytes, blocks)
+        elif phase['name'] == 'write':
+            size = phase['size']
+            packets = (size + HID_buf_size - 1) // HID_buf_size
+            write_measured += phase['duration']
+            write_bytes += size
+            write_reports += 1 + packets + max(1, -(-size // kit.EraseBlock))
+    scale = erase_measured / erase_estimated if erase_estimated > 0 else 1.
+    write_kib_time = profile.write_kib_time
+    if write_bytes:
+        write_kib_time = max(0., write_measured - write_reports * hid) * 1024. / write_bytes
+    return timing.TimingProfile(profile.erase_block_time * scale,
+                                profile.erase_kib_time * scale,
+                                write_kib_time, hid)
@@ -0,0 +1,79 @@
+"""Per-phase timing of programming sessions"""
+import time, json
+
+class _Phase(object):
+    """Context manager which appends a phase to a PhaseTimer upon exit"""
+    __slots__ = ('timer', 'name', 'attrs', 'start')
+    def __init__(self, timer, name, attrs):
+        self.timer, self.name, self.attrs = timer, name, attrs
+    def __enter__(self):
+        self.start = self.timer.clock()
+        return self
+    def __exit__(self, exc_type, exc_value, tb):
+        end = self.timer.clock()
+        self.timer.phases.append((self.name, self.start - self.timer.origin,
+                                  end - self.start, self.attrs))
+
+class PhaseTimer(object):
+    """Records how long each phase of a programming session takes.
+       Phases are recorded as (name, start, duration, attrs) tuples in
+       self.phases, where start is relative to the creation of the timer."""
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self.origin = clock()
+        self.phases = []
+
+    def phase(self, name, **attrs):
+        """Return a context manager which times the phase name. Any
+           keyword arguments are kept along with the phase."""
+        return _Phase(self, name, attrs)
+
+    def summary(self):
+        """Aggregate phases by name, in order of first occurrence. Returns
+           a list of (name, count, total, min, max) tuples."""
+        order, agg = [], {}
+        for name, start, duration, attrs in self.phases:
+            if name not in agg:
+                order.append(name)
+                agg[name] = [0, 0., duration, duration]
+            a = agg[name]
+            a[0] += 1
+            a[1] += duration
+            a[2] = min(a[2], duration)
+            a[3] = max(a[3], duration)
+        return [tuple([name] + agg[name]) for name in order]
+
+    def format_summary(self):
+        """Return the summary as a compact human-readable table"""
+        lines = ['%-10s %6s %10s %10s %10s' % ('phase', 'count', 'total',
+                                               'min', 'max')]
+        for name, count, total, min_t, max_t in self.summary():
+            lines.append('%-10s %6d %9.3fs %9.3fs %9.3fs' % (
+                name, count, total, min_t, max_t))
+        lines.append('elapsed: %.3fs' % (self.clock() - self.origin))
+        return '\n'.join(lines) + '\n'
+
+    def to_json(self):
+        """Return the recorded phases as a JSON string"""
+        return json.dumps({
+            'elapsed': self.clock() - self.origin,
+            'phases': [dict(attrs, name=name, start=start, duration=duration)
+                       for name, start, duration, attrs in self.phases],
+            'summary': [dict(zip(('name', 'count', 'total', 'min', 'max'), s))
+                        for s in self.summary()],
+        }, sort_keys=True)
+
+class _NullPhase(object):
+    __slots__ = ()
+    def __enter__(self):
+        return self
+    def __exit__(self, exc_type, exc_value, tb):
+        pass
+
+class NullTimer(object):
+    """Timer which records nothing (used when profiling is disabled)"""
+    _phase = _NullPhase()
+    def phase(self, name, **attrs):
+        return self._phase
+
+null_timer = NullTimer()
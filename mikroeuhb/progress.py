@@ -0,0 +1,119 @@
+"""Progress reporting and ETA estimation for transfers to the device"""
+import sys, time
+import timing
+
+class ProgressHooks(object):
+    """Inherit from this class and override the callbacks of interest.
+       Each callback receives the Progress object of the transfer."""
+    def on_range_start(self, progress, start, end):
+        """Called before erasing each interval [start,end) of device
+           addresses (as supplied to the ERASE and WRITE commands)"""
+        pass
+    def on_chunk_acked(self, progress):
+        """Called after the device acknowledges WRITE chunks, at most once
+           every Progress.interval seconds"""
+        pass
+    def on_done(self, progress):
+        """Called once the transfer is complete"""
+        pass
+
+_default_profile = timing.TimingProfile(0.020, 0., 0.004)
+
+class Progress(object):
+    """Tracks how many bytes of a transfer were written, and estimates how
+       long the rest of it will take. The estimate starts from a timing
+       profile (see the timing module) and is calibrated by scaling it
+       with the ratio between the measured and the estimated durations of
+       the erases and writes which already took place."""
+    def __init__(self, hooks, profile=None, clock=time.time, interval=.1):
+        self.hooks = hooks
+        self.profile = profile or _default_profile
+        self.clock = clock
+        self.interval = interval
+        self.bytes_total = self.bytes_done = 0
+        self.erase_total = self.erase_done = (0, 0)  # (bytes, blocks)
+        self._times = {'erase': [0., 0.], 'write': [0., 0.]}  # [measured, estimated]
+        self._start = self._last = None
+
+    def _write_estimate(self, nbytes):
+        # programming time, plus one HID interval per 64-byte report
+        return self.profile.write_time(nbytes) + \
+            nbytes * self.profile.hid_interval / 64.
+
+    def _scale(self, op):
+        measured, estimated = self._times[op]
+        return measured / estimated if measured > 0 and estimated > 0 else 1.
+
+    def start(self, bytes_total, erase_bytes, erase_blocks):
+        """Called by the devkit model when the transfer plan is known"""
+        self.bytes_total = bytes_total
+        self.erase_total = (erase_bytes, erase_blocks)
+        self._start = self._last = self.clock()
+
+    def range_start(self, start, end):
+        self.hooks.on_range_start(self, start, end)
+
+    def erased(self, nbytes, nblocks, seconds):
+        """Record that nblocks blocks (nbytes bytes) were erased in seconds"""
+        self.erase_done = (self.erase_done[0] + nbytes, self.erase_done[1] + nblocks)
+        t = self._times['erase']
+        t[0] += seconds
+        t[1] += self.profile.erase_time(nbytes, nblocks)
+
+    def acked(self, nbytes, seconds):
+        """Record that a WRITE chunk of nbytes bytes was acknowledged after
+           seconds, calling the hooks if interval seconds elapsed since the
+           last time they were called"""
+        self.bytes_done += nbytes
+        t = self._times['write']
+        t[0] += seconds
+        t[1] += self._write_estimate(nbytes)
+        now = self.clock()
+        if now - self._last >= self.interval:
+            self._last = now
+            self.hooks.on_chunk_acked(self)
+
+    def done(self):
+        self.hooks.on_done(self)
+
+    def elapsed(self):
+        return self.clock() - self._start if self._start is not None else 0.
+
+    def rate(self):
+        """Measured rate, in bytes written per second (erases included)"""
+        elapsed = self.elapsed()
+        return self.bytes_done / elapsed if elapsed > 0 else 0.
+
+    def eta(self):
+        """Estimated number of seconds until the transfer is complete"""
+        erase_bytes = self.erase_total[0] - self.erase_done[0]
+        erase_blocks = self.erase_total[1] - self.erase_done[1]
+        return (self._scale('erase') * self.profile.erase_time(erase_bytes, erase_blocks) +
+                self._scale('write') * self._write_estimate(self.bytes_total - self.bytes_done))
+
+    def fraction(self):
+        return float(self.bytes_done) / self.bytes_total if self.bytes_total else 1.
+
+class ProgressBar(ProgressHooks):
+    """Text progress bar, redrawn in place on a terminal"""
+    def __init__(self, stream=sys.stderr, width=30):
+        self.stream = stream
+        self.width = width
+
+    def _draw(self, progress, label, seconds):
+        filled = int(round(progress.fraction() * self.width))
+        seconds = int(seconds)
+        self.stream.write('\r[%s%s] %3d%% %7.1f KiB/s  %s %d:%02d ' % (
+            '#' * filled, ' ' * (self.width - filled), 100 * progress.fraction(),
+            progress.rate() / 1024., label, seconds // 60, seconds % 60))
+        self.stream.flush()
+
+    def on_range_start(self, progress, start, end):
+        self._draw(progress, 'ETA', progress.eta())
+
+    def on_chunk_acked(self, progress):
+        self._draw(progress, 'ETA', progress.eta())
+
+    def on_done(self, progress):
+        self._draw(progress, 'took', progress.elapsed())
+        self.stream.write('\n')
@@ -0,0 +1,59 @@
+"""Measurement of how long a device takes to start the application after
+   the REBOOT command"""
+import time, logging
+logger = logging.getLogger(__name__)
+
+class RebootError(Exception):
+    """Raised when the application is not detected after REBOOT"""
+
+class RebootTimeout(RebootError):
+    """The expected event did not happen in time"""
+
+class BootloaderReentered(RebootError):
+    """The bootloader was attached again after REBOOT, which suggests the
+       bootloader fix is broken (the application jumps back to it)"""
+
+def wait_reboot(poll, bootloader, app=None, start=None, timeout=10.,
+                reenter_window=1., clock=time.time):
+    """Wait for a device to come back after REBOOT. poll(timeout) must
+       return the next USB event as an (action, (vendor, product)) tuple,
+       where action is 'add' or 'remove', or None if timeout seconds
+       elapsed without any event (see hid.usb_events).
+
+       If app is None, wait for the bootloader (a (vendor, product) tuple)
+       to go away, then keep watching for reenter_window seconds in case
+       it comes back. Otherwise, wait for the application USB ID to
+       appear. Returns the time elapsed since start (by default, the time
+       of the call) until the bootloader went away or the application
+       appeared. Raises BootloaderReentered if the bootloader appears
+       again, or RebootTimeout if nothing expected happened within
+       timeout."""
+    if start is None:
+        start = clock()
+    deadline = start + timeout
+    gone = None
+    while True:
+        remaining = deadline - clock()
+        if remaining <= 0:
+            break
+        event = poll(remaining)
+        if event is None:
+            continue
+        action, usbid = event
+        now = clock()
+        logger.debug('%.3fs after REBOOT: %s %04x:%04x' % ((now - start, action) + usbid))
+        if action == 'remove' and usbid == bootloader and gone is None:
+            gone = now - start
+            if app is None:
+                deadline = now + reenter_window
+        elif action == 'add' and usbid == bootloader:
+            raise BootloaderReentered('bootloader attached again %.3fs after REBOOT'
+                                      % (now - start))
+        elif action == 'add' and usbid == app:
+            return now - start
+    if app is None and gone is not None:
+        return gone
+    if gone is None:
+        raise RebootTimeout('bootloader still attached %.1fs after REBOOT' % timeout)
+    raise RebootTimeout('application %04x:%04x not attached %.1fs after REBOOT'
+                        % (app + (timeout,)))
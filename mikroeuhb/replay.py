@@ -0,0 +1,92 @@
+"""Replay of captured UHB sessions, for reproducing real-world timing"""
+import time, logging
+from binascii import unhexlify
+from util import hexlify
+logger = logging.getLogger(__name__)
+
+class ReplayMismatch(Exception):
+    """Raised when the host sends something different from the capture"""
+
+def parse_capture(f):
+    """Parse a capture in the format output by devtools/usbcap.awk (and
+       used by FakeDevFile.transfers), i.e. lines containing a direction
+       ('i' or 'o') and a hex string, optionally preceded by a timestamp in
+       seconds. Yields (timestamp, direction, data) tuples, where timestamp
+       is None if not present."""
+    for lineno, line in enumerate(f):
+        if not isinstance(line, str):
+            line = line.decode('ascii')
+        fields = line.split()
+        if not fields:
+            continue
+        if len(fields) == 2:
+            ts, (direction, data) = None, fields
+        elif len(fields) == 3:
+            ts, direction, data = float(fields[0]), fields[1], fields[2]
+        else:
+            raise IOError('line %d: malformed' % (lineno + 1))
+        if direction not in ('i', 'o'):
+            raise IOError('line %d: invalid direction' % (lineno + 1))
+        yield ts, direction, unhexlify(data)
+
+class ReplayDevFile(object):
+    """Device file-object which serves the device responses recorded in a
+       capture, while checking that the host sends the same reports as in
+       the capture.
+
+       If the capture contains timestamps and timing is True, a response is
+       only served after the same delay, counted from the last report sent
+       by the host, which was observed in the capture (divided by speed).
+       This way, the device side of the recorded session is reproduced,
+       while the host side runs at whatever speed the current code runs.
+
+       If strict is True, a ReplayMismatch is raised as soon as the host
+       diverges from the capture. Otherwise, mismatches are only counted
+       in self.mismatches, and the replay goes on."""
+    def __init__(self, capture, timing=True, speed=1., strict=True,
+                 clock=time.time, sleep=time.sleep):
+        self.records = parse_capture(capture)
+        self.timing = timing
+        self.speed = speed
+        self.strict = strict
+        self.clock, self.sleep = clock, sleep
+        self.mismatches = 0
+        self.packets = 0
+        self.device_wait = 0.   # time spent honoring recorded delays
+        self._last_out = None   # (capture timestamp, wall time) of last write
+
+    def _next(self, direction):
+        try:
+            ts, rec_dir, data = next(self.records)
+        except StopIteration:
+            raise ReplayMismatch('packet %d: capture ended, but host wants to %s' %
+                                 (self.packets, 'read' if direction == 'i' else 'write'))
+        if rec_dir != direction:
+            raise ReplayMismatch('packet %d: capture expects the host to %s' %
+                                 (self.packets, 'read' if rec_dir == 'i' else 'write'))
+        self.packets += 1
+        return ts, data
+
+    def write(self, buf):
+        # Strip the report number, as done by hidraw
+        buf = buf[1:]
+        ts, data = self._next('o')
+        self._last_out = (ts, self.clock())
+        if bytes(buf) != data:
+            self.mismatches += 1
+            msg = 'packet %d: host sent %s, capture has %s' % (
+                self.packets - 1, hexlify(buf), hexlify(data))
+            if self.strict:
+                raise ReplayMismatch(msg)
+            logger.warning(msg)
+
+    def read(self, size):
+        ts, data = self._next('i')
+        if self.timing and ts is not None and self._last_out is not None \
+                and self._last_out[0] is not None:
+            last_ts, last_wall = self._last_out
+            remaining = last_wall + (ts - last_ts) / self.speed - self.clock()
+            if remaining > 0:
+                self.sleep(remaining)
+                self.device_wait += remaining
+        return data[:size]
@@ -0,0 +1,159 @@
+"""Scheduling of concurrent programming sessions on a station with many
+boards, taking the USB topology into account.
+
+Full-speed devices attached (possibly through other hubs) to a high-speed
+hub share the bandwidth of its transaction translator (TT), a single one
+for the whole hub, or one for each port of a multi-TT hub. Programming
+every board behind the same TT at once makes each of them slower, and
+may even lower the throughput of the whole group. The Scheduler limits
+how many sessions run at once in each group, and adapts the limit by
+measuring the throughput of the group."""
+import time, threading, logging
+logger = logging.getLogger(__name__)
+
+high_speed = 480.   # Mbit/s, as in the speed attribute of usb_device
+
+def tt_group(chain):
+    """Return the key of the group of devices sharing bandwidth with a
+       device, given the chain of USB devices from the device up to the
+       root hub as (name, speed in Mbit/s, multi_tt) tuples, where name is
+       the port path of the device (e.g. 1-2.3) or of the root hub (e.g.
+       usb1), and multi_tt tells whether a hub has a TT for each port.
+       Devices which are not behind a TT are grouped by bus."""
+    if not chain:
+        return None
+    name, speed, _ = chain[0]
+    if speed < high_speed:
+        for i in xrange(1, len(chain)):
+            hub, hub_speed, multi_tt = chain[i]
+            if hub.startswith('usb'):
+                break   # root hubs handle full-speed devices themselves
+            if hub_speed >= high_speed:
+                return chain[i - 1][0] if multi_tt else hub
+    return chain[-1][0]
+
+class _Group(object):
+    """Sessions of a group, and the state of its concurrency limit"""
+    def __init__(self, key, limit):
+        self.key, self.limit = key, limit
+        self.queue = []
+        self.running = 0
+        self.rates = {}        # limit -> measured throughput (bytes/s)
+        self.settled = False
+        self.epoch = 0         # incremented each time the limit changes
+        self.window_start = None
+        self.window_bytes = self.window_jobs = 0
+
+class Scheduler(object):
+    """Decides which sessions may start, limiting the sessions running at
+       once in each group. The limit of a group starts at initial and is
+       raised while this raises the throughput of the group by more than
+       tolerance, up to ceiling. The throughput at a limit is measured
+       over the first limit sessions started with it.
+
+       Sessions are added with add(), and either run by run(), or driven
+       by the caller through ready() and done() (e.g. in a simulation, with
+       a clock other than time.time)."""
+    def __init__(self, initial=1, ceiling=8, tolerance=.05, clock=time.time):
+        self.initial, self.ceiling = initial, ceiling
+        self.tolerance = tolerance
+        self.clock = clock
+        self.groups = {}
+        self._order = []    # group keys, in the order they were first seen
+        self._started = {}  # session name -> (group, epoch)
+
+    def add(self, name, group, job):
+        """Queue a session in a group (e.g. the result of tt_group)"""
+        if group not in self.groups:
+            self.groups[group] = _Group(group, min(self.initial, self.ceiling))
+            self._order.append(group)
+        self.groups[group].queue.append((name, job))
+
+    def pending(self):
+        return sum([len(g.queue) for g in self.groups.values()])
+
+    def running(self):
+        return sum([g.running for g in self.groups.values()])
+
+    def limits(self):
+        """Current limit of each group"""
+        return dict([(key, g.limit) for key, g in self.groups.items()])
+
+    def ready(self):
+        """Return the (name, job) tuples of the sessions which may start
+           now, and consider them running"""
+        now, started = self.clock(), []
+        for key in self._order:
+            g = self.groups[key]
+            while g.queue and g.running < g.limit:
+                name, job = g.queue.pop(0)
+                if g.window_start is None:
+                    g.window_start = now
+                g.running += 1
+                self._started[name] = (g, g.epoch)
+                started.append((name, job))
+        return started
+
+    def done(self, name, nbytes):
+        """Record that a session finished, having written nbytes bytes"""
+        g, epoch = self._started.pop(name)
+        g.running -= 1
+        if g.settled or epoch != g.epoch:
+            return
+        g.window_bytes += nbytes
+        g.window_jobs += 1
+        if g.window_jobs < g.limit:
+            return
+        now = self.clock()
+        elapsed = now - g.window_start
+        if elapsed <= 0:
+            return
+        rate = g.rates[g.limit] = g.window_bytes / elapsed
+        previous = g.rates.get(g.limit - 1)
+        if previous is not None and rate < previous * (1 + self.tolerance):
+            g.limit -= 1
+            g.settled = True
+        elif g.limit >= self.ceiling:
+            g.settled = True
+        else:
+            g.limit += 1
+        logger.info('group %s: %.0f bytes/s -- limit %d%s' % (
+            g.key, rate, g.limit, ' (settled)' if g.settled else ''))
+        g.epoch += 1
+        g.window_start, g.window_bytes, g.window_jobs = now, 0, 0
+
+    def run(self):
+        """Run every session, each in its own thread, calling the job of
+           the session with no arguments. Jobs should return an object
+           with a bytes_written attribute, such as a flash.Result. Returns
+           a dictionary from session name to a (result, exception) tuple,
+           one of them being None."""
+        cond = threading.Condition()
+        finished, results = [], {}
+        def worker(name, job):
+            result = error = None
+            try:
+                result = job()
+            except Exception as err:
+                error = err
+            with cond:
+                finished.append((name, result, error))
+                cond.notify()
+        with cond:
+            while True:
+                for name, job in self.ready():
+                    thread = threading.Thread(target=worker, args=(name, job),
+                                              name='session %s' % name)
+                    thread.daemon = True
+                    thread.start()
+                if not self.running():
+                    break
+                while not finished:
+                    cond.wait()
+                for name, result, error in finished:
+                    if error is not None:
+                        logger.error('session %s failed: %s' % (name, error))
+                    self.done(name, getattr(result, 'bytes_written', 0))
+                    results[name] = (result, error)
+                del finished[:]
+        return results
@@ -0,0 +1,112 @@
+import re, shutil, tempfile, unittest
+from binascii import unhexlify
+from mikroeuhb.blockstore import BlockStore, Block, ImageMismatch
+from mikroeuhb.bootinfo import BootInfo
+from mikroeuhb.flash import flash, Options
+from mikroeuhb.image import Image, load
+from device import FakeDevFile, gzresource, \
+    STM32Program, PIC18Program, DSPIC33Program, PIC32Program
+from image import NamedLines
+import repeatable
+
+def bootinforaw(sample):
+    return unhexlify(re.sub(r'\s+', '', sample.bootinfo))
+
+def config_record(addr, value):
+    """Intel HEX lines writing a 4-byte value to a 32-bit address"""
+    lines = []
+    for rec in [[2, 0, 0, 4, addr >> 24, (addr >> 16) & 0xff],
+                [4, (addr >> 8) & 0xff, addr & 0xff, 0] +
+                [(value >> s) & 0xff for s in (0, 8, 16, 24)]]:
+        lines.append(':' + ''.join(['%02X' % b for b in rec + [-sum(rec) & 0xff]]))
+    return lines + [':00000001FF']
+
+class StoreCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.store = BlockStore(self.dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+class ProgramStored(StoreCase):
+    """Programming a stored image sends the same reports as programming
+       the hex file, also after reopening the store"""
+    def runTest(self):
+        for sample in (STM32Program, PIC18Program, DSPIC33Program, PIC32Program):
+            raw = bootinforaw(sample)
+            self.store.add(sample.__name__, BootInfo(raw), gzresource(sample.hexfile))
+            expected = [line.strip() for line in gzresource(sample.capfile).xreadlines()]
+            for store in (self.store, BlockStore(self.dir)):
+                fakefile = FakeDevFile(raw)
+                result = flash(fakefile, store.image(sample.__name__))
+                self.assertListEqual(fakefile.transfers, expected)
+                self.assertTrue(all([isinstance(data, Block)
+                                     for data in result.kit.blocks.values()]))
+
+class SharedVariants(StoreCase):
+    """Variants differing in a single block only add that block to the
+       store, and the blocks they share are mapped once and never copied"""
+    variants = 20
+    def runTest(self):
+        raw = bootinforaw(STM32Program)
+        bootinfo = BootInfo(raw)
+        base = load([gzresource(STM32Program.hexfile)])
+        for i in xrange(self.variants):
+            image = Image('last-wins').extend(base)
+            image.add(NamedLines('config', config_record(0x8004000, i)))
+            self.store.add('variant%d' % i, bootinfo, image.freeze())
+        stats = self.store.stats()
+        blocks = len(self.store.manifest('variant0').blocks)
+        self.assertEqual(stats['images'], self.variants)
+        self.assertEqual(stats['blocks'], blocks * self.variants)
+        self.assertEqual(stats['unique'], blocks + self.variants - 1)
+        a = self.store.image('variant0').model(bootinfo)
+        b = self.store.image('variant1').model(bootinfo)
+        self.assertTrue(a.blocks[0] is b.blocks[0])
+        self.assertFalse(a.blocks[1] is b.blocks[1])
+        self.assertEqual(bytes(a.blocks[1])[:4], b'\x00\x00\x00\x00')
+        self.assertEqual(bytes(b.blocks[1])[:4], b'\x01\x00\x00\x00')
+        def change():
+            a.blocks[0][0] = b'\x00'
+        self.assertRaises(TypeError, change)
+        # programming a variant after another only writes what differs
+        first = flash(FakeDevFile(raw), self.store.image('variant0'))
+        second = flash(FakeDevFile(raw), self.store.image('variant1'),
+                       Options(baseline=first.snapshot()))
+        self.assertEqual(second.blocks, [1])
+
+class Mismatch(StoreCase):
+    """Stored images are refused by other devices, and by sessions
+       disabling the bootloader if the image did not"""
+    def runTest(self):
+        self.store.add('stm32', BootInfo(bootinforaw(STM32Program)),
+                       gzresource(STM32Program.hexfile))
+        image = self.store.image('stm32')
+        self.assertRaises(ImageMismatch, lambda: flash(
+            FakeDevFile(bootinforaw(PIC32Program)), image))
+        self.assertRaises(ImageMismatch, lambda: flash(
+            FakeDevFile(bootinforaw(STM32Program)), image,
+            Options(disable_bootloader=True)))
+        self.assertRaises(ValueError, lambda: self.store.image('../stm32'))
+
+class RemoveAndCollect(StoreCase):
+    def runTest(self):
+        bootinfo = BootInfo(bootinforaw(STM32Program))
+        base = load([gzresource(STM32Program.hexfile)])
+        self.store.add('a', bootinfo, base)
+        variant = Image('last-wins').extend(base)
+        variant.add(NamedLines('config', config_record(0x8004000, 1)))
+        self.store.add('b', bootinfo, variant)
+        self.assertEqual(self.store.names(), ['a', 'b'])
+        self.store.remove('b')
+        self.assertEqual(self.store.gc(), 1)
+        self.assertEqual(self.store.gc(), 0)
+        self.assertEqual(self.store.names(), ['a'])
+        stats = self.store.stats()
+        self.assertEqual(stats['unique'], stats['blocks'])
+        self.assertEqual(stats['bytes'], stats['stored_bytes'])
+
+load_tests = repeatable.make_load_tests([
+    ProgramStored, SharedVariants, Mismatch, RemoveAndCollect
+])
@@ -67,6 +67,16 @@ class MultiMediaBoardPIC32MX7(BootInfoCase):
         'McuSize': 0x80000,
     }
 
+class PackRoundTrip(unittest.TestCase):
+    """Check if bootinfo.pack assembles structs which are parsed back
+       to the same dictionary, for all the kits seen in the wild"""
+    def runTest(self):
+        for case in [MikromediaSTM32, MikromediaDSPIC33,
+                     PIC18Board, MultiMediaBoardPIC32MX7]:
+            buf = bootinfo.pack(case.expected)
+            self.assertEqual(len(buf), 64)
+            self.assertDictEqual(bootinfo.BootInfo(buf), case.expected)
+
 class RandomBootInfo(BootInfoCase):
     """Assemble random BootInfo structs, compile them using gcc -m32,
     and check if they are correctly parsed by us"""
@@ -161,4 +171,5 @@ class RandomBootInfo(BootInfoCase):
 
 load_tests = repeatable.make_load_tests([MikromediaSTM32, MikromediaDSPIC33,
                                          MultiMediaBoardPIC32MX7,
-                                         PIC18Board, RandomBootInfo])
+                                         PIC18Board, PackRoundTrip,
+                                         RandomBootInfo])
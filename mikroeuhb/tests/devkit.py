@@ -1,7 +1,11 @@
-import random, unittest, logging
+import os, re, json, random, shutil, tempfile, unittest, logging
 from binascii import unhexlify
 import repeatable, logexception
 import mikroeuhb.devkit as devkit
+import mikroeuhb.memmap as memmap
+import mikroeuhb.hexfile as hexfile
+from mikroeuhb.device import Device, Command
+from device import gzresource, FakeDevFile, STM32Program, DSPIC33Program
 devkit.logger.addHandler(logexception.LogExceptionHandler(level=logging.WARNING))
 
 _stm32 = {
@@ -20,6 +24,54 @@ class EncodeInstr(unittest.TestCase):
         self.assertRaises(ValueError,
             lambda: devkit.encode_instruction('0000000-', '1'))
 
+def _reference_encode(template, field, endianness):
+    """Straightforward (slow) encoder used for checking InstructionTemplate"""
+    n = max([ord(c) - ord('a') + 1 for c in template if c not in '01'] + [0])
+    bits = bin(field)[2:].rjust(n, '0') if n else ''
+    value = int(''.join([c if c in '01' else bits[ord(c) - ord('a')]
+                         for c in template]), 2)
+    nbytes = len(template) // 8
+    digits = ('%0*x' % (2*nbytes, value))
+    raw = unhexlify(digits)
+    return raw[::-1] if endianness == '<' else raw
+
+class CompiledInstr(unittest.TestCase):
+    """Check compiled templates against a straightforward encoder"""
+    templates = ['0fgh0000ijklmnop11110e100100abcd', '0100011010000101',
+                 '11101111abcdefgh', '1111abcdefghijkl',
+                 '00000100abcdefghijklmnop', '00000000000000000abcdefg',
+                 'hgfedcba', '1a0b1c0d1e0f1g0h1i0j1k0l1m0n1o0p']
+    def runTest(self):
+        for template in self.templates:
+            n = max([ord(c) - ord('a') + 1 for c in template if c not in '01'] + [0])
+            for endianness in '<>':
+                compiled = devkit.compile_instruction(template, endianness)
+                self.assertIs(compiled, devkit.compile_instruction(template, endianness))
+                for i in range(20):
+                    field = random.getrandbits(n) if n else None
+                    self.assertEqual(compiled.encode(field),
+                                     _reference_encode(template, field or 0, endianness))
+                if n:
+                    self.assertRaises(ValueError, lambda: compiled.encode(1 << n))
+                    self.assertRaises(ValueError, lambda: compiled.encode())
+
+class NamedFieldsInstr(unittest.TestCase):
+    def runTest(self):
+        # ARM Thumb-2 movw encoding, with imm16 split in named fields
+        t = devkit.InstructionTemplate('0fgh0000ijklmnop11110e100100abcd',
+                                       {'imm4': 'abcd', 'i': 'e', 'imm3': 'fgh',
+                                        'imm8': 'ijklmnop'})
+        value = 0xbeef
+        self.assertEqual(t.encode(imm4=value >> 12, i=(value >> 11) & 1,
+                                  imm3=(value >> 8) & 7, imm8=value & 0xff),
+                         devkit.encode_instruction('0fgh0000ijklmnop11110e100100abcd',
+                                                   value))
+        self.assertRaises(ValueError, lambda: t.encode(imm4=0, i=0, imm3=0))
+        self.assertRaises(ValueError, lambda: t.encode(imm4=0, i=2, imm3=0, imm8=0))
+        self.assertEqual(devkit.encode_instructions([
+            ('11101111abcdefgh', 0x12), (devkit.compile_instruction('1111abcdefghijkl'), 0x345)]),
+            unhexlify('12ef45f3'))
+
 class STM32Factory(unittest.TestCase):
     """Check if the bootinfo dictionary is correctly identified for STM32 devices"""
     def runTest(self):
@@ -89,7 +141,103 @@ class STM32RandomWrites(unittest.TestCase):
                                        for i, (start_addr, end_addr) in enumerate(kit.blockaddr)]),
                              bytes(randmem))
 
+class SelectRanges(unittest.TestCase):
+    """Check if address range selections restrict the transfer plan"""
+    def kit(self, bootinfo, sample):
+        kit = devkit.factory(bootinfo)
+        hexfile.load(gzresource(sample.hexfile), kit)
+        kit.fix_bootloader()
+        return kit
+    def runTest(self):
+        R = devkit.AddressRange.parse
+        kit = self.kit(_stm32, STM32Program)
+        kit.select(only=[R('0x8004000-0x8008000')])
+        self.assertEqual(kit._plan(), [(1, 2)])
+        # ranges are extended to block boundaries
+        kit.select(only=[R('0x8004100-0x8004200'), R('phy:0xc000-0xc001')])
+        self.assertEqual(kit._plan(), [(1, 2), (3, 4)])
+        # all blocks, except the excluded ones
+        kit.select(exclude=[R('phy:0x8000-0x10000')])
+        self.assertEqual(kit._plan(), [(0, 2), (10, 11)])
+        # reset and startprogram blocks must be selected together
+        self.assertRaises(devkit.SelectionError,
+            lambda: kit.select(only=[R('0x8000000-0x8010000')]))
+        self.assertRaises(devkit.SelectionError,
+            lambda: kit.select(exclude=[R('0x80c0000-0x80e0000')]))
+        self.assertRaises(devkit.SelectionError,
+            lambda: kit.select(only=[R('0x9000000-0x9001000')]))
+        self.assertRaises(ValueError, lambda: R('0x100-0x100'))
+        # PIC24 hex file addresses count 4 bytes per instruction,
+        # while device addresses count 2 bytes per instruction
+        kit = self.kit({'McuType': 'DSPIC33', 'EraseBlock': 0xc00,
+                        'BootStart': 0x54000, 'McuSize': 0x80400}, DSPIC33Program)
+        kit.select(only=[R('0x1000-0x2000')])
+        self.assertEqual(kit._plan(), [(1, 2)])
+        kit.select(only=[R('phy:0x800-0x1000')])
+        self.assertEqual(kit._plan(), [(1, 2)])
+        # only the selected block is erased and written by the device
+        fakefile = FakeDevFile(unhexlify(re.sub(r'\s+', '', STM32Program.bootinfo)))
+        Device(fakefile).program(gzresource(STM32Program.hexfile), False,
+                                 only=[R('0x8004000-0x8008000')])
+        cmds = [Command.from_buf(unhexlify(t[2:])) for t in fakefile.transfers
+                if t.startswith(b'o 0f')]
+        self.assertEqual([(c.cmd, c.addr) for c in cmds if c.cmd != Command.WRITE],
+                         [(Command.INFO, 0), (Command.BOOT, 0), (Command.SYNC, 0),
+                          (Command.ERASE, 0x4000), (Command.REBOOT, 0)])
+
+class MemoryMaps(unittest.TestCase):
+    """Check the block tables compiled from the memory map database"""
+    def runTest(self):
+        kit = devkit.factory(_stm32)
+        sizes = 4*[16*1024] + [64*1024] + 6*[128*1024]
+        self.assertEqual(list(kit.blockaddr),
+                         [(sum(sizes[:i]), sum(sizes[:i+1])) for i in range(len(sizes))])
+        self.assertEqual(kit.blockaddr.find(0x10000), 4)
+        self.assertEqual(kit.blockaddr.find(_stm32['BootStart']), None)
+        # tables are compiled once for each set of bootinfo fields
+        self.assertTrue(devkit.factory(_stm32).blockaddr is kit.blockaddr)
+
+        pic32 = {'McuType': 'PIC32', 'EraseBlock': 0x1000,
+                 'BootStart': 0x1fc00000, 'McuSize': 0x80000}
+        kit = devkit.factory(pic32)
+        self.assertEqual(len(kit.blockaddr), 0x80 + 2)
+        self.assertEqual(kit.blockaddr[0x80], (0x1fc00000, 0x1fc01000))
+        self.assertEqual(kit.blockaddr[-1], (0x1fc01000, 0x1fc02000))
+        self.assertEqual(kit.blockaddr.find(0x1d080000), None)  # gap between regions
+        self.assertEqual(kit.config_data_addr, 0x1fc02ff0)
+
+        dspic = {'McuType': 'DSPIC33', 'EraseBlock': 0xc00,
+                 'BootStart': 0x800, 'McuSize': 0x1000}
+        self.assertEqual(list(devkit.factory(dspic).blockaddr), [(0, 0xc00)])
+
+class LoadMemoryMap(unittest.TestCase):
+    """Support a new part by loading its memory map from a JSON file"""
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.saved = dict(memmap.maps)
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+        memmap.maps.clear()
+        memmap.maps.update(self.saved)
+        memmap._compiled.clear()
+    def runTest(self):
+        path = os.path.join(self.dir, 'memmap.json')
+        with open(path, 'w') as f:
+            json.dump({'STM32F1XX': {
+                'windows': {'flash_mem_offset': 0x8000000},
+                'regions': [{'start': 0, 'end': 'BootStart + 0x800',
+                             'align': 'down'}]}}, f)
+        memmap.load(path)
+        bootinfo = dict(_stm32, McuType='STM32F1XX', EraseBlock=0x800, BootStart=0x1e000)
+        kit = devkit.factory(bootinfo)
+        self.assertEqual(len(kit.blockaddr), 0x3d)
+        self.assertEqual(kit.blockaddr[-1], (0x1e000, 0x1e800))
+        # other STM32 parts still use their family entry
+        self.assertEqual(len(devkit.factory(_stm32).blockaddr), 11)
+        # sectors must fill the region
+        self.assertRaises(ValueError, devkit.factory, dict(_stm32, BootStart=0xc0000))
+
 load_tests = repeatable.make_load_tests([
-    EncodeInstr, STM32Factory, STM32Bootloader, STM32IndexError,
-    STM32FullFlashBlock, STM32RandomWrites
+    EncodeInstr, CompiledInstr, NamedFieldsInstr, STM32Factory, STM32Bootloader, STM32IndexError,
+    STM32FullFlashBlock, STM32RandomWrites, SelectRanges, MemoryMaps, LoadMemoryMap
 ])
\ No newline at end of file
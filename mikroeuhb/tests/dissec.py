@@ -0,0 +1,200 @@
+import os, re, imp, struct, unittest
+from io import BytesIO
+from binascii import unhexlify, hexlify
+from mikroeuhb.device import Device, Command, HID_buf_size
+from mikroeuhb.bootinfo import BootInfo
+from device import FakeDevFile, gzresource, \
+    STM32Program, PIC18Program, DSPIC33Program, PIC32Program
+import repeatable
+
+dissec = imp.load_source('dissec_tool', os.path.join(
+    os.path.dirname(__file__), os.pardir, os.pardir, 'devtools', 'dissec.py'))
+
+samples = [STM32Program, PIC18Program, DSPIC33Program, PIC32Program]
+BUS, DEV = 1, 3
+
+def bootinforaw(sample):
+    return unhexlify(re.sub(r'\s+', '', sample.bootinfo))
+
+def cmd(code, addr=0, counter=0):
+    return Command.from_attr(code, addr, counter).buf()
+
+# Writers of (timestamp, direction, data) packets in each capture format,
+# optionally adding packets which must be ignored by the dissector
+
+def usbmon_packet(ts, direction, data, busnum=BUS, devnum=DEV, xfer_type=1,
+                  event=None, mmapped=False):
+    event = event or (b'S' if direction == 'o' else b'C')
+    epnum = 0x81 if direction == 'i' else 0x01
+    hdr = dissec._usbmon_hdr.pack(0, event, xfer_type, epnum, devnum, busnum,
+                                  b'-', b'=', int(ts), int(round(ts % 1 * 1e6)),
+                                  0, len(data), len(data), b'\0' * 8)
+    return hdr + (b'\0' * 16 if mmapped else b'') + data
+
+def noise(ts):
+    """Packets of another device, of a control transfer, and the
+       completion of an OUT transfer"""
+    return [usbmon_packet(ts, 'o', cmd(Command.SYNC), busnum=BUS + 1),
+            usbmon_packet(ts, 'i', cmd(Command.SYNC), xfer_type=2),
+            usbmon_packet(ts, 'o', cmd(Command.SYNC), event=b'C')]
+
+def to_usbmon(packets):
+    out = b''
+    for ts, direction, data in packets:
+        out += b''.join(noise(ts)) + usbmon_packet(ts, direction, data)
+    return out
+
+def to_pcap(packets):
+    out = b'\xd4\xc3\xb2\xa1' + struct.pack('<HHiIII', 2, 4, 0, 0, 65535, 189)
+    for ts, direction, data in packets:
+        for pkt in noise(ts) + [usbmon_packet(ts, direction, data)]:
+            out += struct.pack('<IIII', int(ts), 0, len(pkt), len(pkt)) + pkt
+    return out
+
+def pcapng_block(block_type, body):
+    body += b'\0' * (-len(body) % 4)
+    return struct.pack('<II', block_type, len(body) + 12) + body + \
+        struct.pack('<I', len(body) + 12)
+
+def to_pcapng(packets):
+    out = pcapng_block(0x0a0d0d0a, struct.pack('<IHHq', 0x1a2b3c4d, 1, 0, -1))
+    out += pcapng_block(1, struct.pack('<HHI', 220, 0, 65535))
+    for ts, direction, data in packets:
+        for pkt in noise(ts) + [usbmon_packet(ts, direction, data, mmapped=True)]:
+            out += pcapng_block(6, struct.pack('<IIIII', 0, 0, 0, len(pkt), len(pkt)) + pkt)
+    return out
+
+def to_text(packets):
+    return b''.join([('%.6f %s %s\n' % (ts, direction, hexlify(data).decode('ascii'))
+                      ).encode('ascii') for ts, direction, data in packets])
+
+def to_usbmon_text(packets):
+    lines = []
+    for ts, direction, data in packets:
+        words = hexlify(data).decode('ascii')
+        lines.append('ffff8800 %d %s I%s:%d:%03d:1 0 %d = %s\n' % (
+            int(round(ts * 1e6)), 'S' if direction == 'o' else 'C', direction,
+            BUS, DEV, len(data), ' '.join([words[i:i+8] for i in xrange(0, len(words), 8)])))
+    return ''.join(lines).encode('ascii')
+
+formats = {
+    'text': to_text,
+    'usbmon text': to_usbmon_text,
+    'usbmon': to_usbmon,
+    'pcap': to_pcap,
+    'pcapng': to_pcapng,
+}
+
+class Output(list):
+    """Collects what the dissector prints (a mix of str and unicode on
+       Python 2)"""
+    write = list.append
+    def getvalue(self):
+        return ''.join(self)
+
+def dissect(fmt, buf, verbose=False):
+    f = BytesIO(buf)
+    reader = dissec.read_usbmon(f, (BUS, DEV)) if fmt == 'usbmon' else \
+        dissec.open_capture(f, (BUS, DEV))
+    out = Output()
+    dissector = dissec.Dissector(out, verbose=verbose)
+    for ts, direction, data, length in reader:
+        dissector.feed(ts, direction, data, length)
+    return dissector, out
+
+class CountingDevice(Device):
+    """Counts the commands sent and the bytes announced by WRITE commands"""
+    def __init__(self, *args):
+        Device.__init__(self, *args)
+        self.counts, self.write_bytes = {}, 0
+    def send(self, command):
+        name = Command._map[command.cmd]
+        self.counts[name] = self.counts.get(name, 0) + 1
+        if command.cmd == Command.WRITE:
+            self.write_bytes += command.counter
+        Device.send(self, command)
+
+class SampleCaptures(unittest.TestCase):
+    """Dissect the shipped captures, as they are (without timestamps) and
+       converted to each format with timestamps, finding the commands sent
+       by Device.program and the EraseBlock reported by INFO"""
+    def runTest(self):
+        for sample in samples:
+            raw = bootinforaw(sample)
+            dev = CountingDevice(FakeDevFile(raw))
+            dev.program(gzresource(sample.hexfile), False)
+            erase_block = BootInfo(raw)['EraseBlock']
+
+            dissector, out = dissect('text', gzresource(sample.capfile).read(), True)
+            self.assertEqual(dissector.erase_block, erase_block)
+            printed = re.findall(r'Out: CMD\s+(\w+)', out.getvalue())
+            self.assertEqual(dict([(name, printed.count(name)) for name in set(printed)]),
+                             dev.counts)
+            self.assertEqual(dissector.stats.cmds, {})
+
+            packets = []
+            for i, line in enumerate(gzresource(sample.capfile).xreadlines()):
+                direction, data = line.split()
+                packets.append((1. + i * .001, direction.decode('ascii'), unhexlify(data)))
+            for fmt, writer in formats.items():
+                dissector, _ = dissect(fmt, writer(packets))
+                stats = dissector.stats
+                self.assertEqual(dissector.erase_block, erase_block, fmt)
+                self.assertEqual(stats.packets, len(packets), fmt)
+                self.assertEqual(dict([(name, s[0]) for name, s in stats.cmds.items()]),
+                                 dev.counts, fmt)
+                self.assertEqual(stats.write_bytes, dev.write_bytes, fmt)
+
+class Timing(unittest.TestCase):
+    """Durations, gaps and throughput of a small session with a PIC18,
+       whose EraseBlock (64 bytes) makes the device acknowledge each half
+       of a 128-byte WRITE"""
+    data = b'\x55' * HID_buf_size
+    packets = [
+        (0.000, 'o', cmd(Command.INFO)),
+        (0.002, 'i', bootinforaw(PIC18Program)),
+        (0.010, 'o', cmd(Command.BOOT)),
+        (0.011, 'i', cmd(Command.BOOT)),
+        (0.020, 'o', cmd(Command.ERASE, 0, 1)),
+        (0.050, 'i', cmd(Command.ERASE)),
+        (0.100, 'o', cmd(Command.WRITE, 0, 128)),
+        (0.101, 'o', data),
+        (0.102, 'i', cmd(Command.WRITE)),
+        (0.110, 'o', data),
+        (0.112, 'i', cmd(Command.WRITE)),
+        (0.120, 'o', cmd(Command.REBOOT)),
+    ]
+    # a record cut in the middle, as if the capture was still being written
+    truncated = {
+        'text': lambda buf: buf + b'0.130000 o 0f0',
+        'usbmon text': lambda buf: buf + b'ffff8800 130000 S Io:1:003:1 0 64 = 0f0',
+        'usbmon': lambda buf: buf + usbmon_packet(.13, 'o', cmd(Command.SYNC))[:60],
+        'pcap': lambda buf: buf + struct.pack('<IIII', 0, 0, 112, 112) + b'\0' * 20,
+        'pcapng': lambda buf: buf + struct.pack('<II', 6, 160) + b'\0' * 40,
+    }
+    def runTest(self):
+        for fmt, writer in formats.items():
+            dissector, out = dissect(fmt, self.truncated[fmt](writer(self.packets)), True)
+            stats = dissector.stats
+            self.assertEqual(dissector.erase_block, 64, fmt)
+            self.assertEqual(out.getvalue().count('Expecting ACK'), 2, fmt)
+            self.assertEqual(stats.packets, len(self.packets), fmt)
+            self.assertAlmostEqual(stats.last - stats.first, .12, 5)
+            # (duration, largest gap between packets) of each command
+            expected = {'INFO': (.002, .002), 'BOOT': (.001, .001), 'ERASE': (.030, .030),
+                        'WRITE': (.012, .008), 'REBOOT': (0., 0.)}
+            self.assertEqual(sorted(stats.cmds.keys()), sorted(expected.keys()), fmt)
+            for name, (duration, gap) in expected.items():
+                count, total, max_t, max_gap = stats.cmds[name]
+                self.assertEqual(count, 1)
+                self.assertAlmostEqual(total, duration, 5)
+                self.assertAlmostEqual(max_t, duration, 5)
+                self.assertAlmostEqual(max_gap, gap, 5)
+            self.assertEqual(stats.write_bytes, 128)
+            report = Output()
+            stats.report(report)
+            self.assertIn('WRITE throughput: 10667 bytes/s', report.getvalue())
+
+load_tests = repeatable.make_load_tests([
+    SampleCaptures, Timing
+])
@@ -0,0 +1,249 @@
+import re, errno, random, logging, unittest
+from bisect import bisect_right
+from binascii import unhexlify, hexlify
+import mikroeuhb.devkit as devkit
+import mikroeuhb.hexfile as hexfile
+import mikroeuhb.timing as timing
+from mikroeuhb.device import Device, Command, HID_buf_size
+from mikroeuhb.bootinfo import pack
+from mikroeuhb.util import bord
+from device import FakeDevFile, gzresource, \
+    STM32Program, PIC18Program, DSPIC33Program, PIC32Program
+import repeatable
+logger = logging.getLogger(__name__)
+
+class Faults(object):
+    """Faults to be injected by an EmulatedDevFile. ACKs are numbered in
+       the order they are generated by the device, starting from zero.
+       Those listed in drop are never delivered, those listed in duplicate
+       are delivered twice, and those which are keys of the delay dict
+       are delivered later by the supplied amount of seconds. Faults may
+       also happen randomly with the supplied probabilities."""
+    def __init__(self, drop=(), duplicate=(), delay=None,
+                 p_drop=0., p_duplicate=0., p_delay=0., max_delay=0.1, seed=None):
+        self.drop = set(drop)
+        self.duplicate = set(duplicate)
+        self.delay = dict(delay or {})
+        self.p_drop, self.p_duplicate, self.p_delay = p_drop, p_duplicate, p_delay
+        self.max_delay = max_delay
+        self.rnd = random.Random(seed)
+    def dropped(self, n):
+        return n in self.drop or self.rnd.random() < self.p_drop
+    def duplicated(self, n):
+        return n in self.duplicate or self.rnd.random() < self.p_duplicate
+    def delayed(self, n):
+        if n in self.delay:
+            return self.delay[n]
+        if self.rnd.random() < self.p_delay:
+            return self.rnd.uniform(0, self.max_delay)
+        return 0.
+
+class EmulatedDevFile(FakeDevFile):
+    """FakeDevFile which also emulates the Flash memory of the device and
+       how long the device takes to carry out each operation.
+
+       ERASE and WRITE commands are applied to self.flash, a dictionary from
+       block number (as in the devkit model) to a bytearray, using the same
+       address mapping as the devkit model. Programming behaves as in real
+       Flash memory: bits can only be cleared, unless the block is erased.
+       Blocks never touched are assumed to contain garbage (not erased).
+
+       self.time is the simulated wall-clock time (in seconds), taking into
+       account that a single report is transferred per HID interval, and
+       the erase and program durations from the timing profile.
+
+       If a read is attempted while no response is pending (e.g. because an
+       ACK was dropped), an IOError is raised after read_timeout seconds.
+       Set record to False to avoid keeping self.transfers (which is slow
+       and takes a lot of memory for big images)."""
+    def __init__(self, bootinforaw, profile=None, faults=None,
+                 read_timeout=1., record=True):
+        FakeDevFile.__init__(self, bootinforaw)
+        self.kit = devkit.factory(self.bootinfo)
+        self.profile = profile or timing.profile(self.bootinfo['McuType'])
+        self.faults = faults or Faults()
+        self.read_timeout = read_timeout
+        if not record:
+            self.transfers = _Discard()
+        self.flash = {}
+        self.erased = set()
+        self.erase_count = {}
+        self.time = 0.
+        self.queue = []    # pending responses as (ready_at, buf) tuples
+        self.acks = 0      # number of responses generated so far
+        self._busy = 0.    # processing time of the last command
+        self._pending = 0  # bytes received since the last WRITE ACK
+        self._cursor = None
+        # Map the addresses used in ERASE and WRITE commands to blocks
+        self._erase_map = {}
+        self._write_map = {}
+        for blk, (start_addr, end_addr) in enumerate(self.kit.blockaddr):
+            self._erase_map[self.kit._erase_addr(blk)] = blk
+            for blk_off in xrange(0, end_addr - start_addr, self.kit._write_max):
+                self._write_map[self.kit._write_addr(blk, blk_off)] = (blk, blk_off)
+        self._write_addrs = sorted(self._write_map.keys())
+
+    def _block(self, blk):
+        if blk not in self.flash:
+            start_addr, end_addr = self.kit.blockaddr[blk]
+            self.flash[blk] = bytearray(b'\x5a' * (end_addr - start_addr))
+        return self.flash[blk]
+
+    def _erase(self, addr, count):
+        assert(addr in self._erase_map)  # ERASE address must start a block
+        last = self._erase_map[addr]
+        assert(0 < count <= last + 1)
+        nbytes = 0
+        for blk in xrange(last - count + 1, last + 1):
+            data = self._block(blk)
+            data[:] = b'\xff' * len(data)
+            nbytes += len(data)
+            self.erased.add(blk)
+            self.erase_count[blk] = self.erase_count.get(blk, 0) + 1
+        self._busy = self.profile.erase_time(nbytes, count)
+
+    def _program(self, data):
+        blk, blk_off = self._cursor
+        while len(data):
+            block = self._block(blk)
+            if blk not in self.erased:
+                logger.warning('programming block %d, which was not erased' % blk)
+            n = min(len(block) - blk_off, len(data))
+            for i in xrange(n):
+                block[blk_off + i] &= bord(data[i])
+            data = data[n:]
+            blk_off += n
+            if blk_off == len(block):
+                blk, blk_off = blk + 1, 0
+        self._cursor = (blk, blk_off)
+
+    def _set_response(self, response):
+        assert(len(response) == HID_buf_size)
+        n = self.acks
+        self.acks += 1
+        if self.faults.dropped(n):
+            return
+        ready_at = self.time + self._busy + self.faults.delayed(n)
+        self._busy = 0.
+        self.queue.append((ready_at, response))
+        if self.faults.duplicated(n):
+            self.queue.append((ready_at, response))
+
+    def read(self, size):
+        assert(size == HID_buf_size)
+        if not self.queue:
+            self.time += self.read_timeout
+            raise IOError(errno.ETIMEDOUT, 'no response from emulated device')
+        ready_at, ret = self.queue.pop(0)
+        self.time = max(self.time, ready_at) + self.profile.hid_interval
+        self.transfers.append(b'i ' + hexlify(ret))
+        return ret
+
+    def write(self, buf):
+        assert(bord(buf[0]) == 0)
+        data = buf[1:]
+        self.time += self.profile.hid_interval
+        if self.idle:
+            cmd = Command.from_buf(data)
+            if cmd.cmd == Command.ERASE:
+                self._erase(cmd.addr, cmd.counter)
+            elif cmd.cmd == Command.WRITE:
+                pos = bisect_right(self._write_addrs, cmd.addr) - 1
+                assert(pos >= 0)  # WRITE address must be inside some block
+                blk, blk_off = self._write_map[self._write_addrs[pos]]
+                self._cursor = (blk, blk_off + cmd.addr - self._write_addrs[pos])
+                self._pending = 0
+        else:
+            readlen = min(self.counter, len(data))
+            self._program(data[:readlen])
+            self._pending += readlen
+            if self.availbuf == readlen or self.counter == readlen:
+                self._busy = self.profile.write_time(self._pending)
+                self._pending = 0
+        FakeDevFile.write(self, buf)
+
+    def image(self):
+        """Return a devkit model containing the final Flash memory contents
+           of the blocks which were erased (and possibly programmed)"""
+        kit = devkit.factory(self.bootinfo)
+        for blk in self.erased:
+            kit.blocks[blk] = bytearray(self.flash[blk])
+        return kit
+
+class _Discard(object):
+    """Stands in for FakeDevFile.transfers when recording is disabled"""
+    def append(self, item):
+        pass
+
+class EmulatorCase(unittest.TestCase):
+    """Program a sample onto an emulated device, and check that the final
+       Flash memory contents match the devkit model"""
+    def runTest(self):
+        bootinforaw = unhexlify(re.sub(r'\s+', '', self.sample.bootinfo))
+        emu = EmulatedDevFile(bootinforaw, record=False)
+        dev = Device(emu)
+        kit = devkit.factory(dev.cmd_info())
+        hexfile.load(gzresource(self.sample.hexfile), kit)
+        kit.fix_bootloader()
+        dev.cmd_boot()
+        dev.cmd_sync()
+        kit.transfer(dev)
+        self.assertEqual(sorted(emu.erased), sorted(kit.blocks.keys()))
+        for blk, data in kit.blocks.iteritems():
+            self.assertEqual(emu.flash[blk], data)
+        # At least one HID interval per report, plus erase/program durations
+        self.assertGreater(emu.time, emu.profile.hid_interval * 3)
+        self.assertEqual(emu.image().blocks, kit.blocks)
+
+class STM32Emulator(EmulatorCase):
+    sample = STM32Program
+
+class PIC18Emulator(EmulatorCase):
+    sample = PIC18Program
+
+class DSPIC33Emulator(EmulatorCase):
+    sample = DSPIC33Program
+
+class PIC32Emulator(EmulatorCase):
+    sample = PIC32Program
+
+_arm = {'McuType': 'ARM', 'EraseBlock': 0x400,
+        'BootStart': 0x3f000, 'McuSize': 0x40000}
+
+class EmulatorTiming(unittest.TestCase):
+    """Check the simulated time of a single block write"""
+    def runTest(self):
+        profile = timing.TimingProfile(0.5, 0., 1.024)  # 1 ms per byte
+        emu = EmulatedDevFile(pack(_arm), profile=profile)
+        dev = Device(emu)
+        dev.cmd_boot()
+        kit = devkit.factory(_arm)
+        kit.write(0, b'\x00' * 0x400)
+        kit.transfer(dev)
+        # BOOT: 2 reports, ERASE: 2 reports + 0.5 s,
+        # WRITE: 1 + 16 + 1 reports + 1024 bytes programmed
+        self.assertAlmostEqual(emu.time, 22e-3 + 0.5 + 1.024)
+
+class EmulatorFaults(unittest.TestCase):
+    """Dropped ACKs make reads time out, duplicated ACKs show up
+       as unexpected responses to the next command"""
+    def runTest(self):
+        emu = EmulatedDevFile(pack(_arm), faults=Faults(drop=[1]))
+        dev = Device(emu)
+        dev.cmd_boot()
+        self.assertRaises(IOError, dev.cmd_sync)
+        self.assertAlmostEqual(emu.time, 3e-3 + emu.read_timeout)
+
+        emu = EmulatedDevFile(pack(_arm), faults=Faults(duplicate=[0],
+                                                         delay={1: 0.25}))
+        dev = Device(emu)
+        dev.cmd_boot()
+        dev.send(Command.from_attr(Command.SYNC))
+        self.assertEqual(dev.recv().cmd, Command.BOOT)
+        self.assertEqual(dev.recv().cmd, Command.SYNC)
+        self.assertAlmostEqual(emu.time, 4e-3 + 0.25)
+
+load_tests = repeatable.make_load_tests([
+    STM32Emulator, PIC18Emulator, DSPIC33Emulator, PIC32Emulator,
+    EmulatorTiming, EmulatorFaults
+])
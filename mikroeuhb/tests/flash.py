@@ -0,0 +1,94 @@
+import re, sys, threading, unittest
+from io import BytesIO
+from binascii import unhexlify
+from mikroeuhb.flash import flash, Options, Result
+from mikroeuhb.image import Image, load
+from image import NamedLines
+from device import FakeDevFile, gzresource, \
+    STM32Program, PIC18Program, DSPIC33Program, PIC32Program
+import repeatable
+
+class ConcurrentCase(unittest.TestCase):
+    """Several threads programming their own devices at once, sharing a
+       single prepared image and a single Options object, send exactly
+       the reports of the golden captures and print nothing"""
+    threads = 6
+    def runTest(self):
+        raw = unhexlify(re.sub(r'\s+', '', self.sample.bootinfo))
+        prepared = load([gzresource(self.sample.hexfile)]).freeze()
+        options = Options()
+        fakefiles = [FakeDevFile(raw) for i in xrange(self.threads)]
+        results, errors = [None] * self.threads, []
+        def worker(i):
+            try:
+                results[i] = flash(fakefiles[i], prepared, options)
+            except Exception as err:
+                errors.append(err)
+        stdout, sys.stdout = sys.stdout, BytesIO()
+        try:
+            threads = [threading.Thread(target=worker, args=(i,))
+                       for i in xrange(self.threads)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            printed = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+        self.assertEqual(errors, [])
+        self.assertEqual(printed, b'')
+        expected = [line.strip() for line in gzresource(self.sample.capfile).xreadlines()]
+        for fakefile, result in zip(fakefiles, results):
+            self.assertListEqual(fakefile.transfers, expected)
+            self.assertTrue(isinstance(result, Result))
+            self.assertEqual(result.bootinfo['McuType'],
+                             fakefile.bootinfo['McuType'])
+            self.assertEqual(sorted(result.blocks), sorted(result.kit.blocks))
+            self.assertEqual(result.bytes_written,
+                             sum([len(d) for d in result.kit.blocks.values()]))
+            self.assertNotEqual(result.rebooted_at, None)
+        # every call builds its own devkit model
+        self.assertEqual(len(set([id(result.kit) for result in results])),
+                         self.threads)
+
+class STM32Concurrent(ConcurrentCase):
+    sample = STM32Program
+class PIC18Concurrent(ConcurrentCase):
+    sample = PIC18Program
+class DSPIC33Concurrent(ConcurrentCase):
+    sample = DSPIC33Program
+class PIC32Concurrent(ConcurrentCase):
+    sample = PIC32Program
+
+class ImmutableArguments(unittest.TestCase):
+    """Prepared images and options cannot be changed once built, and a
+       prepared image is not affected by later changes to its Image"""
+    def runTest(self):
+        options = Options(keepalive=.1)
+        def change():
+            options.keepalive = 1
+        self.assertRaises(AttributeError, change)
+        image = Image().add(NamedLines('a', [':0400000001020304F2', ':00000001FF']))
+        prepared = image.freeze()
+        image.add(NamedLines('b', [':0400040005060708DE', ':00000001FF']))
+        self.assertEqual(prepared.index(), ((0, 4, b'\x01\x02\x03\x04', 0),))
+        self.assertEqual(prepared.sources, ('a',))
+        self.assertEqual(prepared.size(), 4)
+        self.assertEqual(len(image.freeze().index()), 2)
+
+class BaselineResult(unittest.TestCase):
+    """The snapshot of a result, used as the baseline of the next call,
+       leaves nothing to be transferred when programming the same image"""
+    def runTest(self):
+        raw = unhexlify(re.sub(r'\s+', '', STM32Program.bootinfo))
+        prepared = load([gzresource(STM32Program.hexfile)]).freeze()
+        first = flash(FakeDevFile(raw), prepared)
+        second = flash(FakeDevFile(raw), prepared, Options(baseline=first.snapshot()))
+        self.assertEqual(len(first.blocks), 5)
+        self.assertEqual(second.ranges, [])
+        self.assertEqual(second.bytes_written, 0)
+
+load_tests = repeatable.make_load_tests([
+    STM32Concurrent, PIC18Concurrent, DSPIC33Concurrent, PIC32Concurrent,
+    ImmutableArguments, BaselineResult
+])
@@ -0,0 +1,49 @@
+import re, unittest
+from binascii import unhexlify
+from mikroeuhb.device import Device
+from mikroeuhb.profiler import PhaseTimer
+from mikroeuhb.history import History, hub_of
+from device import FakeDevFile, gzresource, STM32Program
+import repeatable
+
+class RecordSessions(unittest.TestCase):
+    """Record programming sessions of the STM32 sample in an in-memory
+       database and check throughput and per-block erase counts"""
+    def program(self, history, port, clock):
+        fakefile = FakeDevFile(unhexlify(re.sub(r'\s+', '', STM32Program.bootinfo)))
+        timer = PhaseTimer(clock)
+        dev = Device(fakefile, timer)
+        dev.program(gzresource(STM32Program.hexfile), False)
+        return history.record(timer, dev.bootinfo, dev.kit, port)
+
+    def runTest(self):
+        ticks = iter(xrange(1 << 20))
+        clock = lambda: 1400000000. + next(ticks) * .001
+        history = History(':memory:', station='bench')
+        for port in ('1-2.1', '1-2.2', '1-2.1'):
+            self.program(history, port, clock)
+        history.db.execute("UPDATE sessions SET outcome = 'error' WHERE id = 3")
+
+        rows = history.throughput('hub', days=1, now=1400000100.)
+        self.assertEqual(len(rows), 1)
+        key, day, sessions, nbytes, rate = rows[0]
+        self.assertEqual((key, day, sessions), ('bench 1-2', '2014-05-13', 2))
+        self.assertTrue(nbytes > 0 and rate > 0)
+        self.assertEqual(history.throughput('station', days=1, now=1500000000.), [])
+        self.assertRaises(ValueError, history.throughput, 'bogus')
+
+        counts = history.erase_counts()
+        # the STM32 sample touches blocks 0-3 and 10 of the flash
+        self.assertEqual(sorted([(port, blk) for _, port, _, blk, n in counts if n == 2]),
+                         [('1-2.1', blk) for blk in (0, 1, 2, 3, 10)])
+        self.assertEqual(len(counts), 10)
+        self.assertEqual(len(history.erase_counts(limit=3)), 3)
+        history.close()
+
+class HubOf(unittest.TestCase):
+    def runTest(self):
+        self.assertEqual(hub_of('1-2.3.4'), '1-2.3')
+        self.assertEqual(hub_of('3-1'), '3')
+        self.assertEqual(hub_of(None), None)
+
+load_tests = repeatable.make_load_tests([RecordSessions, HubOf])
@@ -0,0 +1,193 @@
+import os, re, random, struct, shutil, tempfile, threading, unittest
+from binascii import hexlify, unhexlify
+import mikroeuhb.devkit as devkit
+import mikroeuhb.hexfile as hexfile
+from mikroeuhb.device import Device
+from mikroeuhb.image import Image, BackgroundImage, OverlapError
+from device import gzresource, FakeDevFile, STM32Program
+import repeatable
+
+def hexrecords(records):
+    """Assemble a list of (addr, data) tuples into Intel HEX lines"""
+    lines = []
+    upper = None
+    for addr, data in records:
+        if addr >> 16 != upper:
+            upper = addr >> 16
+            rec = bytearray(struct.pack('>BHBH', 2, 0, 4, upper))
+            lines.append(':' + hexlify(rec + bytearray([-sum(rec) & 0xff])).decode('ascii'))
+        rec = bytearray(struct.pack('>BHB', len(data), addr & 0xffff, 0)) + bytearray(data)
+        lines.append(':' + hexlify(rec + bytearray([-sum(rec) & 0xff])).decode('ascii'))
+    lines.append(':00000001FF')
+    return lines
+
+class NamedLines(list):
+    """List of lines with a name attribute, like a file object"""
+    def __init__(self, name, lines):
+        list.__init__(self, lines)
+        self.name = name
+        self.xreadlines = lambda: iter(self)
+
+class Memory(object):
+    """Trivial byte-by-byte model used as a reference"""
+    def __init__(self):
+        self.mem = {}
+    def write(self, addr, data):
+        for i, c in enumerate(bytearray(data)):
+            self.mem[addr + i] = c
+
+class SplitSample(unittest.TestCase):
+    """A sample split into two hex files must compose to the same blocks"""
+    def runTest(self):
+        lines = [l.strip() for l in gzresource(STM32Program.hexfile).xreadlines()]
+        bootinfo = {'McuType': 'STM32F4XX', 'EraseBlock': 0x4000,
+                    'BootStart': 0xe0000, 'McuSize': 0x100000}
+        kit = devkit.factory(bootinfo)
+        hexfile.load(gzresource(STM32Program.hexfile), kit)
+        # The first line is an extended linear address record
+        half = len(lines) // 2
+        image = Image()
+        image.add(NamedLines('a.hex', lines[:half] + [':00000001FF']))
+        image.add(NamedLines('b.hex', lines[:1] + lines[half:]))
+        self.assertEqual(image.overlaps(), [])
+        self.assertEqual(image.write_to(devkit.factory(bootinfo)).blocks, kit.blocks)
+
+class OverlapPolicies(unittest.TestCase):
+    def runTest(self):
+        app = NamedLines('app.hex', hexrecords([(0x100, b'\x01' * 16),
+                                                (0x110, b'\x02' * 16)]))
+        cal = NamedLines('cal.hex', hexrecords([(0x118, b'\xaa' * 4)]))
+        image = Image().add(app).add(cal)
+        overlaps = image.overlaps()
+        self.assertEqual(len(overlaps), 1)
+        self.assertEqual(tuple(overlaps[0]), (0x118, 0x11c, 'app.hex', 'cal.hex'))
+        try:
+            image.write_to(Memory())
+            self.fail('OverlapError not raised')
+        except OverlapError as err:
+            self.assertEqual(err.overlaps, overlaps)
+        mem = Image('last-wins').add(app).add(cal).write_to(Memory()).mem
+        self.assertEqual([mem[a] for a in (0x117, 0x118, 0x11b, 0x11c)],
+                         [2, 0xaa, 0xaa, 2])
+        mem = Image('first-wins').add(app).add(cal).write_to(Memory()).mem
+        self.assertEqual([mem[a] for a in (0x117, 0x118, 0x11b, 0x11c)],
+                         [2, 2, 2, 2])
+
+class RandomComposition(unittest.TestCase):
+    """Compare the overlap resolution with a byte-by-byte reference"""
+    count = 10
+    def runTest(self):
+        files = []
+        for i in xrange(random.randint(1, 4)):
+            records = []
+            for j in xrange(random.randint(1, 30)):
+                addr = random.randint(0, 0x200)
+                size = random.randint(1, 32)
+                records.append((addr, bytearray([random.randint(0, 255)
+                                                 for k in xrange(size)])))
+            files.append(NamedLines('%d.hex' % i, hexrecords(records)))
+        for policy, order in (('last-wins', files), ('first-wins', files[::-1])):
+            reference = Memory()
+            for f in order:
+                hexfile.load(f, reference)
+            image = Image(policy)
+            for f in files:
+                image.add(f)
+            self.assertEqual(image.write_to(Memory()).mem, reference.mem)
+            index = image.index()
+            for (s1, e1, _, _), (s2, e2, _, _) in zip(index, index[1:]):
+                self.assertLessEqual(e1, s2)
+
+_stm32 = {'McuType': 'STM32F4XX', 'EraseBlock': 0x4000,
+          'BootStart': 0xe0000, 'McuSize': 0x100000}
+
+def image(records):
+    return Image().add(NamedLines('test.hex', hexrecords(records)))
+
+class ValidateImage(unittest.TestCase):
+    """Check if problems are reported with their addresses, coalesced"""
+    def runTest(self):
+        kit = devkit.factory(_stm32)
+        ok = image([(0x8000000, b'\x00' * 16)])
+        self.assertEqual(kit.validate(ok.index()), [])
+        bad = image([(0x80dfff0, b'\x00' * 32), (0x80e0010, b'\x00' * 16),
+                     (0x80ffff0, b'\x00' * 32), (0x9000000, b'\x00' * 16)])
+        with self.assertRaises(devkit.ImageError) as cm:
+            kit.validate(bad.index())
+        self.assertEqual([tuple(p) for p in cm.exception.problems], [
+            ('bootloader', 0x80e0000, 0x80e0020),
+            ('bootloader', 0x80ffff0, 0x8100000),
+            ('outside', 0x8100000, 0x8100010),
+            ('outside', 0x9000000, 0x9000010),
+        ])
+        self.assertEqual(len(kit.blocks), 0)
+        # PIC24: non-null padding bytes and configuration data are not fatal
+        kit = devkit.factory({'McuType': 'DSPIC33', 'EraseBlock': 0xc00,
+                              'BootStart': 0x54000, 'McuSize': 0x80400})
+        config = image([(0x1f00008, b'\x01\x02\x03\x00')])
+        self.assertEqual([tuple(p) for p in kit.validate(config.index())],
+                         [('config', 0x1f00008, 0x1f0000c)])
+        padding = image([(0x100, b'\x01\x02\x03\x00' + b'\x01\x02\x03\x04' * 2)])
+        self.assertEqual([tuple(p) for p in kit.validate(padding.index())],
+                         [('padding', 0x104, 0x10c)])
+        with self.assertRaises(devkit.ImageError) as cm:
+            kit.validate(image([(0x100, b'\x01\x02\x03\x04'),
+                                (0x54000 * 2, b'\x00' * 4)]).index())
+        self.assertEqual([tuple(p) for p in cm.exception.problems],
+                         [('bootloader', 0xa8000, 0xa8004)])
+
+class ValidateBeforeBoot(unittest.TestCase):
+    """A rejected image must not cause the device to enter BOOT mode"""
+    def runTest(self):
+        fakefile = FakeDevFile(unhexlify(re.sub(r'\s+', '', STM32Program.bootinfo)))
+        bad = image([(0x8000000, b'\x00' * 16), (0x80f0000, b'\x00' * 16)])
+        self.assertRaises(devkit.ImageError,
+                          lambda: Device(fakefile).program(bad, False))
+        self.assertEqual(len(fakefile.transfers), 2)  # INFO command and reply
+        self.assertFalse(fakefile.bootloadermode)
+
+class DelayedImage(BackgroundImage):
+    """BackgroundImage which only starts parsing when released"""
+    def __init__(self, *args):
+        self.release = threading.Event()
+        BackgroundImage.__init__(self, *args)
+    def _run(self):
+        self.release.wait()
+        BackgroundImage._run(self)
+
+class BackgroundPrepare(unittest.TestCase):
+    """While the image is being prepared, INFO is sent to keep the device
+       in the bootloader; afterwards, the session proceeds as usual"""
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'sample.hex')
+        with open(self.path, 'wb') as f:
+            f.write(gzresource(STM32Program.hexfile).read())
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+    def runTest(self):
+        fakefile = FakeDevFile(unhexlify(re.sub(r'\s+', '', STM32Program.bootinfo)))
+        pending = DelayedImage([self.path])
+        threading.Timer(.25, pending.release.set).start()
+        Device(fakefile).program(pending, False, keepalive=.05)
+        info = fakefile.transfers[0]
+        pings = 0
+        while fakefile.transfers[2*pings + 2] == info:
+            pings += 1
+        self.assertGreater(pings, 0)
+        expected = [line.strip() for line in gzresource(STM32Program.capfile).xreadlines()]
+        self.assertEqual(fakefile.transfers[:2] + fakefile.transfers[2*pings + 2:], expected)
+        # errors found while preparing the image happen before BOOT
+        with open(self.path, 'w') as f:
+            f.write(':0400000001020304FF\n')  # bad checksum
+        fakefile = FakeDevFile(unhexlify(re.sub(r'\s+', '', STM32Program.bootinfo)))
+        self.assertRaises(IOError, lambda: Device(fakefile).program(
+            BackgroundImage([self.path]), False))
+        self.assertFalse(fakefile.bootloadermode)
+        # missing files are reported before waiting for the device
+        self.assertRaises(IOError, lambda: BackgroundImage(
+            [self.path, os.path.join(self.dir, 'missing.hex')]))
+
+load_tests = repeatable.make_load_tests([SplitSample, OverlapPolicies,
+                                         RandomComposition, ValidateImage,
+                                         ValidateBeforeBoot, BackgroundPrepare])
@@ -0,0 +1,46 @@
+import re, json, time, threading, logging, unittest
+from binascii import unhexlify
+import mikroeuhb.inventory as inventory
+from device import FakeDevFile, STM32Program, PIC18Program, PIC32Program
+import repeatable
+inventory.logger.addHandler(logging.NullHandler())
+
+class SlowDevFile(FakeDevFile):
+    """FakeDevFile which takes some time to reply"""
+    delay = .2
+    def read(self, size):
+        time.sleep(self.delay)
+        return FakeDevFile.read(self, size)
+
+class MuteDevFile(FakeDevFile):
+    """FakeDevFile which never replies"""
+    def read(self, size):
+        threading.Event().wait()
+
+def bootinforaw(sample):
+    return unhexlify(re.sub(r'\s+', '', sample.bootinfo))
+
+class ParallelScan(unittest.TestCase):
+    """Check if devices are queried concurrently and grouped"""
+    def runTest(self):
+        samples = 8*[STM32Program] + 6*[PIC18Program] + 4*[PIC32Program]
+        devs = [('dev%d' % i, SlowDevFile(bootinforaw(sample)))
+                for i, sample in enumerate(samples)]
+        devs.append(('mute', MuteDevFile(bootinforaw(STM32Program))))
+        start = time.time()
+        results = inventory.scan(devs, timeout=1.)
+        self.assertLess(time.time() - start, 1.5)
+        self.assertEqual(results[-1], ('mute', None, 'timeout'))
+        groups = dict([(key[0], names) for key, names in inventory.group(results)])
+        self.assertEqual(groups, {
+            'STM32F4XX': ['dev%d' % i for i in range(8)],
+            'PIC18': ['dev%d' % i for i in range(8, 14)],
+            'PIC32': ['dev%d' % i for i in range(14, 18)],
+        })
+        report = json.loads(inventory.to_json(results))
+        self.assertEqual(sorted([(g['McuType'], g['count']) for g in report['groups']]),
+                         [('PIC18', 6), ('PIC32', 4), ('STM32F4XX', 8)])
+        self.assertEqual(report['errors'], [{'device': 'mute', 'error': 'timeout'}])
+        self.assertIn('STM32F4XX', inventory.format_text(results))
+
+load_tests = repeatable.make_load_tests([ParallelScan])
@@ -0,0 +1,109 @@
+import os, re, shutil, logging, tempfile, unittest
+from binascii import unhexlify
+import mikroeuhb.devkit as devkit
+import mikroeuhb.hexfile as hexfile
+import mikroeuhb.flash as flash
+from mikroeuhb.device import Device, Command
+from device import gzresource, STM32Program, PIC18Program, \
+    DSPIC33Program, PIC32Program
+from emulator import EmulatedDevFile, Faults
+import repeatable
+flash.logger.addHandler(logging.NullHandler())  # journal disabled without a port
+
+class JournalCase(unittest.TestCase):
+    """Interrupt a programming session by dropping an ACK, then resume it
+       on the same (emulated) device, and check the final Flash contents"""
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp('journal')
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def _emulator(self, faults=None, previous=None):
+        bootinforaw = unhexlify(re.sub(r'\s+', '', self.sample.bootinfo))
+        emu = EmulatedDevFile(bootinforaw, faults=faults)
+        if previous:
+            emu.flash = previous.flash
+            emu.erased = previous.erased
+        return emu
+
+    def _program(self, emu, resume, port='1-1'):
+        Device(emu, port=port).program(gzresource(self.sample.hexfile), False,
+                                       journal_dir=self.tempdir, resume=resume)
+
+    def _erases(self, emu):
+        return [Command.from_buf(unhexlify(t[2:])) for t in emu.transfers
+                if t.startswith(b'o 0f15')]
+
+    def runTest(self):
+        kit = devkit.factory(self._emulator().bootinfo)
+        hexfile.load(gzresource(self.sample.hexfile), kit)
+        kit.fix_bootloader()
+
+        # Uninterrupted session: blocks which make the MCU start the
+        # bootloader must be the last ones to be erased
+        emu = self._emulator()
+        self._program(emu, resume=False)
+        last_erase = self._erases(emu)[-1]
+        self.assertIn(emu._erase_map[last_erase.addr], kit.patched['reset'])
+        self.assertEqual(os.listdir(self.tempdir), [])
+        full = len(emu.transfers)
+
+        # Session interrupted near the end
+        emu = self._emulator(Faults(drop=[emu.acks - 2]))
+        self.assertRaises(IOError, lambda: self._program(emu, resume=False))
+        self.assertEqual(len(os.listdir(self.tempdir)), 1)
+
+        emu = self._emulator(previous=emu)
+        self._program(emu, resume=True)
+        self.assertLess(len(emu.transfers), full)
+        for blk, data in kit.blocks.items():
+            self.assertEqual(emu.flash[blk], data)
+        self.assertEqual(os.listdir(self.tempdir), [])
+
+class TwoBoards(JournalCase):
+    """Boards of the same model attached at different ports keep separate
+       journals, and no journal is kept for a board whose port is unknown"""
+    sample = STM32Program
+    def runTest(self):
+        emu = self._emulator()
+        self._program(emu, resume=False)
+        full = len(emu.transfers)
+
+        # both sessions are interrupted, at different points
+        first = self._emulator(Faults(drop=[emu.acks - 2]))
+        self.assertRaises(IOError, lambda: self._program(first, False, '1-1'))
+        second = self._emulator(Faults(drop=[emu.acks // 2]))
+        self.assertRaises(IOError, lambda: self._program(second, False, '1-2'))
+        self.assertEqual(len(os.listdir(self.tempdir)), 2)
+
+        # a fresh board at another port does not resume from either journal
+        emu = self._emulator()
+        self._program(emu, resume=True, port='1-3')
+        self.assertEqual(len(emu.transfers), full)
+        self.assertEqual(len(os.listdir(self.tempdir)), 2)
+
+        for board, port in ((second, '1-2'), (first, '1-1')):
+            emu = self._emulator(previous=board)
+            self._program(emu, resume=True, port=port)
+            self.assertLess(len(emu.transfers), full)
+        self.assertEqual(os.listdir(self.tempdir), [])
+
+        emu = self._emulator(Faults(drop=[emu.acks - 2]))
+        self.assertRaises(IOError, lambda: self._program(emu, False, None))
+        self.assertEqual(os.listdir(self.tempdir), [])
+
+class STM32Journal(JournalCase):
+    sample = STM32Program
+
+class PIC18Journal(JournalCase):
+    sample = PIC18Program
+
+class DSPIC33Journal(JournalCase):
+    sample = DSPIC33Program
+
+class PIC32Journal(JournalCase):
+    sample = PIC32Program
+
+load_tests = repeatable.make_load_tests([
+    TwoBoards, STM32Journal, PIC18Journal, DSPIC33Journal, PIC32Journal
+])
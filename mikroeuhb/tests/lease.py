@@ -0,0 +1,94 @@
+import os, sys, time, shutil, tempfile, subprocess, logging, unittest
+from mikroeuhb.lease import Registry, claim
+import mikroeuhb.lease as lease
+import repeatable
+lease.logger.addHandler(logging.NullHandler())
+
+_holder = """
+import sys, time
+from mikroeuhb.lease import Registry
+l = Registry(sys.argv[1]).acquire('1-2.3', '/dev/hidraw7')
+sys.stdout.write('claimed\\n')
+sys.stdout.flush()
+time.sleep(30)
+"""
+
+class LeaseTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.registry = Registry(self.dir)
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+class ExclusiveLease(LeaseTest):
+    """A board may only be leased once at a time, and is free again once
+       the lease is released"""
+    def runTest(self):
+        l = self.registry.acquire('1-2.3', '/dev/hidraw0')
+        self.assertNotEqual(l, None)
+        self.assertEqual(self.registry.acquire('1-2.3'), None)
+        other = self.registry.acquire('1-2.4')
+        self.assertNotEqual(other, None)
+        self.assertEqual(sorted([(key, pid) for key, pid, _, _ in self.registry.holders()]),
+                         [('1-2.3', os.getpid()), ('1-2.4', os.getpid())])
+        l.release()
+        other.release()
+        self.assertEqual(os.listdir(self.dir), [])
+        with self.registry.acquire('1-2.3') as l:
+            self.assertNotEqual(l, None)
+        self.assertNotEqual(self.registry.acquire('1-2.3'), None)
+
+class OtherProcess(LeaseTest):
+    """Leases are held across processes, and taken over once their
+       holder dies"""
+    def runTest(self):
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+        proc = subprocess.Popen([sys.executable, '-c', _holder, self.dir],
+                                stdout=subprocess.PIPE, env=env)
+        try:
+            self.assertEqual(proc.stdout.readline().strip(), b'claimed')
+            self.assertEqual(self.registry.acquire('1-2.3'), None)
+            self.assertEqual(self.registry.holders(),
+                             [('1-2.3', proc.pid, '/dev/hidraw7',
+                               self.registry.holders()[0][3])])
+            self.assertEqual(self.registry.cleanup(), 0)
+        finally:
+            proc.kill()
+            proc.wait()
+            proc.stdout.close()
+        # the lease file was left behind, but its lock died with the holder
+        self.assertEqual(self.registry.holders(), [])
+        self.assertEqual(self.registry.cleanup(), 1)
+        self.assertEqual(os.listdir(self.dir), [])
+        proc = subprocess.Popen([sys.executable, '-c', _holder, self.dir],
+                                stdout=subprocess.PIPE, env=env)
+        proc.stdout.readline()
+        proc.kill()
+        proc.wait()
+        proc.stdout.close()
+        l = self.registry.acquire('1-2.3')
+        self.assertNotEqual(l, None)
+        l.release()
+
+class ClaimNode(LeaseTest):
+    """The device node is locked along with the lease, and the lease
+       may be used as a file object"""
+    def runTest(self):
+        node = os.path.join(self.dir, 'hidraw0')
+        open(node, 'wb').close()
+        opener = lambda node: open(node, 'r+b', buffering=0)
+        l = claim(self.registry, '1-1', node, opener)
+        l.write(b'abc')
+        self.assertEqual(l.name, node)
+        # another board path, but the same node (e.g. a stale USB path)
+        self.assertEqual(claim(self.registry, '1-9', node, opener), None)
+        self.assertEqual([key for key, _, _, _ in self.registry.holders()], ['1-1'])
+        self.assertEqual(claim(self.registry, '1-2', node + 'x', opener), None)
+        l.close()
+        with open(node, 'rb') as f:
+            self.assertEqual(f.read(), b'abc')
+        l = claim(self.registry, '1-9', node, opener)
+        self.assertNotEqual(l, None)
+        l.close()
+
+load_tests = repeatable.make_load_tests([ExclusiveLease, OtherProcess, ClaimNode])
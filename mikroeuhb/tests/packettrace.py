@@ -0,0 +1,39 @@
+import re, unittest
+from binascii import unhexlify
+from mikroeuhb.device import Device
+from mikroeuhb.packettrace import PacketTrace
+from mikroeuhb.replay import parse_capture
+from mikroeuhb.util import hexlify
+from device import FakeDevFile, gzresource, STM32Program
+import repeatable
+
+class TraceProgram(unittest.TestCase):
+    """Check if the trace keeps the last reports of a programming session
+       in the same format as the test captures"""
+    def trace(self, capacity):
+        fakefile = FakeDevFile(unhexlify(re.sub(r'\s+', '', STM32Program.bootinfo)))
+        trace = PacketTrace(capacity)
+        Device(fakefile, trace=trace).program(gzresource(STM32Program.hexfile), False)
+        return fakefile.transfers, trace
+    def dump(self, trace):
+        lines = []
+        class Lines(object):
+            write = lambda self, s: lines.append(s)
+        trace.dump(Lines())
+        return ''.join(lines).splitlines()
+    def runTest(self):
+        transfers, trace = self.trace(1 << 16)
+        self.assertEqual(trace.count, len(transfers))
+        self.assertEqual(trace.dropped(), 0)
+        records = list(parse_capture(self.dump(trace)))
+        self.assertEqual([(d + ' ' + hexlify(data)).encode('ascii')
+                          for _, d, data in records], transfers)
+        timestamps = [ts for ts, _, _ in records]
+        self.assertEqual(timestamps, sorted(timestamps))
+        # A small ring buffer keeps only the last reports
+        transfers, trace = self.trace(100)
+        self.assertEqual(trace.dropped(), len(transfers) - 100)
+        self.assertEqual([(d + ' ' + hexlify(data)).encode('ascii')
+                          for _, d, data in trace.packets()], transfers[-100:])
+
+load_tests = repeatable.make_load_tests([TraceProgram])
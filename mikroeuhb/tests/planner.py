@@ -0,0 +1,103 @@
+import re, json, unittest
+from binascii import unhexlify
+import mikroeuhb.planner as planner
+import mikroeuhb.timing as timing
+from mikroeuhb.device import Device, Command
+from mikroeuhb.profiler import PhaseTimer
+from mikroeuhb.image import load
+from device import FakeDevFile, gzresource, \
+    STM32Program, PIC18Program, DSPIC33Program, PIC32Program
+from emulator import EmulatedDevFile
+from image import NamedLines
+import repeatable
+
+def bootinforaw(sample):
+    return unhexlify(re.sub(r'\s+', '', sample.bootinfo))
+
+def commands(transfers):
+    """Commands sent in a transcript, skipping the data which follows WRITE"""
+    cmds, data = [], 0
+    for t in transfers:
+        if not t.startswith(b'o '):
+            continue
+        if data > 0:
+            data -= 64
+            continue
+        cmd = Command.from_buf(unhexlify(t[2:]))
+        cmds.append(cmd)
+        if cmd.cmd == Command.WRITE:
+            data = cmd.counter
+    return cmds
+
+class PlanMatchesTranscript(unittest.TestCase):
+    """The plan contains exactly the commands and reports of a real session"""
+    def runTest(self):
+        fakefile = FakeDevFile(bootinforaw(STM32Program))
+        Device(fakefile).program(gzresource(STM32Program.hexfile), False)
+        cmds = commands(fakefile.transfers)
+        plan = planner.plan(bootinforaw(STM32Program), gzresource(STM32Program.hexfile))
+        self.assertEqual([(s.cmd, s.addr, s.counter) for s in plan.steps],
+                         [(c.cmd, c.addr, c.counter) for c in cmds])
+        self.assertEqual(sum([s.reports() for s in plan.steps]), len(fakefile.transfers))
+        totals = plan.totals()
+        self.assertEqual(totals['replies'],
+                         len([t for t in fakefile.transfers if t.startswith(b'i ')]))
+        self.assertEqual(totals['blocks'], 5)
+        self.assertEqual(json.loads(plan.to_json(timing.profile('STM32F4XX')))['totals'],
+                         totals)
+
+class EstimateCase(unittest.TestCase):
+    """The estimated duration matches the time simulated by the emulator,
+       also after calibrating a wrong profile against a measured session"""
+    def runTest(self):
+        raw = bootinforaw(self.sample)
+        actual = timing.TimingProfile(0.030, 0.002, 0.006)
+        emu = EmulatedDevFile(raw, profile=actual, record=False)
+        timer = PhaseTimer(lambda: emu.time)
+        Device(emu, timer).program(gzresource(self.sample.hexfile), False)
+        plan = planner.plan(raw, gzresource(self.sample.hexfile))
+        self.assertAlmostEqual(plan.estimate(actual), emu.time)
+        wrong = timing.TimingProfile(0.010, 0.001, 0.020)
+        self.assertNotAlmostEqual(plan.estimate(wrong), emu.time, places=2)
+        calibrated = planner.calibrate(wrong, json.loads(timer.to_json()), plan.kit)
+        self.assertAlmostEqual(plan.estimate(calibrated), emu.time, places=3)
+
+class STM32Estimate(EstimateCase):
+    sample = STM32Program
+
+class PIC18Estimate(EstimateCase):
+    sample = PIC18Program
+
+class DSPIC33Estimate(EstimateCase):
+    sample = DSPIC33Program
+
+class PIC32Estimate(EstimateCase):
+    sample = PIC32Program
+
+_patch = NamedLines('patch.hex', [':020000040800F2', ':02401000123468', ':00000001FF'])
+
+class ImageDiff(unittest.TestCase):
+    """Only the blocks which differ are erased and written"""
+    def runTest(self):
+        raw = bootinforaw(STM32Program)
+        old = load([gzresource(STM32Program.hexfile)])
+        changed, plan = planner.diff(raw, old, load([gzresource(STM32Program.hexfile)]))
+        self.assertEqual(changed, [])
+        self.assertEqual(plan.totals()['ERASE'], 0)
+        new = load([gzresource(STM32Program.hexfile), _patch], 'last-wins')
+        changed, plan = planner.diff(raw, old, new)
+        self.assertEqual(changed, [1])
+        self.assertEqual([(s.name, s.addr) for s in plan.steps if s.name == 'ERASE'],
+                         [('ERASE', 0x4000)])
+        self.assertEqual(plan.totals()['bytes'], 0x4000)
+
+class ReadBootInfo(unittest.TestCase):
+    def runTest(self):
+        raw = planner.read_bootinfo(STM32Program.bootinfo)
+        self.assertEqual(len(raw), 64)
+        self.assertEqual(raw.rstrip(b'\x00'), bootinforaw(STM32Program).rstrip(b'\x00'))
+
+load_tests = repeatable.make_load_tests([
+    PlanMatchesTranscript, STM32Estimate, PIC18Estimate, DSPIC33Estimate, PIC32Estimate,
+    ImageDiff, ReadBootInfo
+])
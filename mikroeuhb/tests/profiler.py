@@ -0,0 +1,30 @@
+import re, json, unittest
+from binascii import unhexlify
+from mikroeuhb.device import Device, Command
+from mikroeuhb.profiler import PhaseTimer
+from device import FakeDevFile, gzresource, STM32Program
+import repeatable
+
+class ProfiledProgram(unittest.TestCase):
+    """Check if every phase of a programming session is recorded, with
+       one erase and one write phase for each ERASE and WRITE command"""
+    def runTest(self):
+        fakefile = FakeDevFile(unhexlify(re.sub(r'\s+', '', STM32Program.bootinfo)))
+        timer = PhaseTimer()
+        Device(fakefile, timer).program(gzresource(STM32Program.hexfile), False)
+        cmds = [Command.from_buf(unhexlify(t[2:])).cmd
+                for t in fakefile.transfers if t.startswith(b'o 0f')]
+        counts = dict([(name, count) for name, count, _, _, _ in timer.summary()])
+        self.assertEqual(counts, {
+            'info': 1, 'boot': 1, 'sync': 1, 'devkit': 1, 'parse': 1, 'validate': 1,
+            'load': 1, 'fix': 1,
+            'erase': cmds.count(Command.ERASE),
+            'write': cmds.count(Command.WRITE),
+            'reboot': 1,
+        })
+        report = json.loads(timer.to_json())
+        self.assertEqual(len(report['phases']), len(timer.phases))
+        self.assertTrue(all(['addr' in p for p in report['phases']
+                             if p['name'] in ('erase', 'write')]))
+
+load_tests = repeatable.make_load_tests([ProfiledProgram])
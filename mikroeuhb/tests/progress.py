@@ -0,0 +1,77 @@
+import re, unittest
+from binascii import unhexlify
+import mikroeuhb.devkit as devkit
+import mikroeuhb.hexfile as hexfile
+from mikroeuhb.device import Device
+from mikroeuhb.progress import Progress, ProgressHooks, ProgressBar
+from mikroeuhb.timing import TimingProfile
+from device import gzresource, STM32Program, PIC18Program
+from emulator import EmulatedDevFile
+import repeatable
+
+class Recorder(ProgressHooks):
+    def __init__(self):
+        self.events = []
+    def on_range_start(self, progress, start, end):
+        self.events.append(('range', progress.bytes_done, progress.eta(), (start, end)))
+    def on_chunk_acked(self, progress):
+        self.events.append(('acked', progress.bytes_done, progress.eta(), progress.clock()))
+    def on_done(self, progress):
+        self.events.append(('done', progress.bytes_done, progress.eta(), progress.clock()))
+
+class ProgressCase(unittest.TestCase):
+    """Check the progress callbacks, their throttling and the ETA against
+       the simulated time taken by an emulated device"""
+    def runTest(self):
+        emu = EmulatedDevFile(unhexlify(re.sub(r'\s+', '', self.sample.bootinfo)),
+                              record=False)
+        dev = Device(emu)
+        kit = devkit.factory(dev.cmd_info())
+        hexfile.load(gzresource(self.sample.hexfile), kit)
+        kit.fix_bootloader()
+        dev.cmd_boot()
+        dev.cmd_sync()
+        hooks = Recorder()
+        # A pessimistic profile, to be corrected by the measurements
+        profile = TimingProfile(*[3 * t for t in (emu.profile.erase_block_time,
+                                                  emu.profile.erase_kib_time,
+                                                  emu.profile.write_kib_time)])
+        progress = Progress(hooks, profile, clock=lambda: emu.time, interval=.02)
+        start = emu.time
+        kit.transfer(dev, progress=progress)
+        total = sum([len(data) for data in kit.blocks.values()])
+        self.assertEqual(progress.bytes_total, total)
+        self.assertEqual(hooks.events[-1][:2], ('done', total))
+        self.assertEqual(len([e for e in hooks.events if e[0] == 'range']),
+                         len(kit._ranges(kit.blocks.keys())))
+        acked = [e for e in hooks.events if e[0] == 'acked']
+        self.assertTrue(acked)
+        self.assertLessEqual(len(acked), (emu.time - start) / .02 + 1)
+        # Once calibrated, the ETA should be close to the remaining time
+        for _, done, eta, now in acked:
+            if done > total / 2:
+                self.assertAlmostEqual(eta, emu.time - now, delta=.25 * (emu.time - now) + .05)
+
+class STM32Progress(ProgressCase):
+    sample = STM32Program
+
+class PIC18Progress(ProgressCase):
+    sample = PIC18Program
+
+class Bar(unittest.TestCase):
+    def runTest(self):
+        lines = []
+        class Stream(object):
+            write = lambda self, s: lines.append(s)
+            flush = lambda self: None
+        t = [0.]
+        progress = Progress(ProgressBar(Stream(), width=10), clock=lambda: t[0])
+        progress.start(1000, 1000, 1)
+        t[0] = 1.
+        progress.acked(500, 1.)
+        progress.done()
+        self.assertIn('[#####     ]  50%', lines[0])
+        self.assertIn('ETA 0:01', lines[0])
+        self.assertIn('took 0:01', lines[1])
+
+load_tests = repeatable.make_load_tests([STM32Progress, PIC18Progress, Bar])
@@ -0,0 +1,46 @@
+import logging, unittest
+import mikroeuhb.reboot as reboot
+import repeatable
+reboot.logger.addHandler(logging.NullHandler())
+
+BOOTLOADER, APP, OTHER = (0x1234, 0x0001), (0x1234, 0x0002), (0x046d, 0xc52b)
+
+class FakeEvents(object):
+    """Serves (time, event) tuples, advancing a simulated clock"""
+    def __init__(self, events):
+        self.events = list(events)
+        self.now = 0.
+    def clock(self):
+        return self.now
+    def poll(self, timeout):
+        if self.events and self.events[0][0] <= self.now + timeout:
+            self.now, event = self.events.pop(0)
+            return event
+        self.now += timeout
+        return None
+
+class WaitReboot(unittest.TestCase):
+    def wait(self, events, app=None, timeout=5., window=1.):
+        fake = FakeEvents(events)
+        return reboot.wait_reboot(fake.poll, BOOTLOADER, app, start=0.,
+                                  timeout=timeout, reenter_window=window,
+                                  clock=fake.clock)
+    def runTest(self):
+        events = [(.1, ('remove', OTHER)), (.2, ('remove', BOOTLOADER)),
+                  (.9, ('add', OTHER)), (1.5, ('add', APP))]
+        self.assertEqual(self.wait(events), .2)
+        self.assertEqual(self.wait(events, APP), 1.5)
+        self.assertRaises(reboot.RebootTimeout, lambda: self.wait(events, APP, 1.))
+        self.assertRaises(reboot.RebootTimeout, lambda: self.wait([]))
+        self.assertRaises(reboot.BootloaderReentered, lambda: self.wait(
+            [(.2, ('remove', BOOTLOADER)), (.8, ('add', BOOTLOADER))], APP))
+        # without an application ID, the bootloader coming back within the
+        # window after it went away is also detected
+        reentered = [(.2, ('remove', BOOTLOADER)), (.8, ('add', BOOTLOADER))]
+        self.assertRaises(reboot.BootloaderReentered, lambda: self.wait(reentered))
+        self.assertEqual(self.wait(reentered, window=.5), .2)
+        # the window may extend beyond the timeout
+        self.assertRaises(reboot.BootloaderReentered, lambda: self.wait(
+            [(.2, ('remove', BOOTLOADER)), (1.1, ('add', BOOTLOADER))], timeout=1.))
+
+load_tests = repeatable.make_load_tests([WaitReboot])
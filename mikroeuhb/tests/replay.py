@@ -0,0 +1,72 @@
+import unittest, logging
+import mikroeuhb.replay as replay
+from mikroeuhb.device import Device, Command
+from mikroeuhb.replay import ReplayDevFile, ReplayMismatch
+from device import gzresource, STM32Program, PIC18Program, \
+    DSPIC33Program, PIC32Program
+import repeatable
+replay.logger.addHandler(logging.NullHandler())  # mismatches are expected
+
+class ReplayCase(unittest.TestCase):
+    """Replay a shipped capture, and check that the host side still
+       sends exactly the same reports"""
+    def runTest(self):
+        f = ReplayDevFile(gzresource(self.sample.capfile))
+        Device(f).program(gzresource(self.sample.hexfile), False)
+        self.assertEqual(f.mismatches, 0)
+        self.assertRaises(ReplayMismatch, lambda: f.read(64))
+
+class STM32Replay(ReplayCase):
+    sample = STM32Program
+
+class PIC18Replay(ReplayCase):
+    sample = PIC18Program
+
+class DSPIC33Replay(ReplayCase):
+    sample = DSPIC33Program
+
+class PIC32Replay(ReplayCase):
+    sample = PIC32Program
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 100.
+    def clock(self):
+        return self.now
+    def sleep(self, secs):
+        self.now += secs
+
+class ReplayTiming(unittest.TestCase):
+    """Responses must only be served after the recorded delay, counted
+       from the last report sent by the host"""
+    capture = ['0.000 o 0f01' + 124*'0', '0.250 i 0f01' + 124*'0',
+               '0.300 o 0f01' + 124*'0', '0.400 i 0f01' + 124*'0']
+    def runTest(self):
+        clk = FakeClock()
+        f = ReplayDevFile(self.capture, clock=clk.clock, sleep=clk.sleep)
+        dev = Device(f)
+        dev.cmd_sync()
+        self.assertAlmostEqual(clk.now, 100.25)
+        clk.now += 1.  # host is slower than in the capture
+        dev.send(Command.from_attr(Command.SYNC))
+        clk.now += 0.04
+        dev.recv()
+        self.assertAlmostEqual(clk.now, 101.35)
+        self.assertAlmostEqual(f.device_wait, 0.31)
+
+class ReplayDivergence(unittest.TestCase):
+    """Check that divergences from the capture are detected"""
+    def runTest(self):
+        capture = ['o 0f02' + 124*'0', 'i ' + 128*'0']
+        dev = Device(ReplayDevFile(capture))
+        self.assertRaises(ReplayMismatch, dev.cmd_sync)
+        f = ReplayDevFile(capture, strict=False)
+        Device(f).send(Command.from_attr(Command.SYNC))
+        self.assertEqual(f.mismatches, 1)
+        self.assertRaises(ReplayMismatch, Device(f).send,
+                          Command.from_attr(Command.SYNC))
+
+load_tests = repeatable.make_load_tests([
+    STM32Replay, PIC18Replay, DSPIC33Replay, PIC32Replay,
+    ReplayTiming, ReplayDivergence
+])
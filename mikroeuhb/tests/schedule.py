@@ -0,0 +1,146 @@
+import re, logging, threading, unittest
+from binascii import unhexlify
+import mikroeuhb.schedule as schedule
+from mikroeuhb.schedule import Scheduler, tt_group
+from mikroeuhb.flash import flash
+from mikroeuhb.image import load
+from device import FakeDevFile, gzresource, STM32Program, PIC32Program
+from emulator import EmulatedDevFile
+import repeatable
+schedule.logger.addHandler(logging.NullHandler())  # failed sessions
+
+def session_cost(sample):
+    """Duration and number of bytes written of a session programming a
+       sample onto an emulated device attached alone to the station"""
+    emu = EmulatedDevFile(unhexlify(re.sub(r'\s+', '', sample.bootinfo)),
+                          record=False)
+    result = flash(emu, gzresource(sample.hexfile))
+    return emu.time, result.bytes_written
+
+class Station(object):
+    """Simulated station whose groups of boards share the bandwidth of a
+       transaction translator. A group with n sessions running progresses
+       as min(n, capacity) sessions running alone would, slowed down by a
+       factor of 1 + penalty for each session beyond the capacity (due
+       to the transactions which are retried)."""
+    def __init__(self, capacity, penalty):
+        self.capacity, self.penalty = capacity, penalty
+        self.now = 0.
+
+    def speed(self, n):
+        """Aggregate speed of a group with n sessions running"""
+        return min(n, self.capacity) / (1. + self.penalty * max(0, n - self.capacity))
+
+    def run(self, scheduler):
+        """Run the sessions of a Scheduler whose jobs are (group, duration,
+           nbytes) tuples. Returns the time taken."""
+        running = {}   # name -> [group, work left, nbytes]
+        while True:
+            for name, (group, duration, nbytes) in scheduler.ready():
+                running[name] = [group, duration, nbytes]
+            if not running:
+                return self.now
+            counts = {}
+            for group, _, _ in running.values():
+                counts[group] = counts.get(group, 0) + 1
+            rate = dict([(group, self.speed(n) / n) for group, n in counts.items()])
+            dt = min([left / rate[group] for group, left, _ in running.values()])
+            self.now += dt
+            for name, session in sorted(running.items()):
+                session[1] -= dt * rate[session[0]]
+                if session[1] <= 1e-9:
+                    del running[name]
+                    scheduler.done(name, session[2])
+
+# Three single-TT hubs (1-1.1 to 1-1.3) with 4 boards each, cascaded
+# behind another one (1-1) whose TT they do not use, a multi-TT hub (1-2)
+# with 2 boards, and a full-speed hub (1-2.3) with 12 boards behind it
+_hs_single = [('1-1', 480., False), ('usb1', 480., False)]
+_hs_multi = [('1-2', 480., True), ('usb1', 480., False)]
+_fs_hub = [('1-2.3', 12., False)] + _hs_multi
+topology = dict(
+    [('1-1.%d.%d' % (i, j), [('1-1.%d.%d' % (i, j), 12., False),
+                             ('1-1.%d' % i, 480., False)] + _hs_single)
+     for i in (1, 2, 3) for j in (1, 2, 3, 4)] +
+    [('1-2.%d' % i, [('1-2.%d' % i, 12., False)] + _hs_multi) for i in (1, 2)] +
+    [('1-2.3.%d' % i, [('1-2.3.%d' % i, 12., False)] + _fs_hub) for i in xrange(1, 13)])
+
+class Grouping(unittest.TestCase):
+    def runTest(self):
+        self.assertEqual(tt_group(topology['1-1.2.4']), '1-1.2')
+        self.assertEqual(tt_group(topology['1-2.1']), '1-2.1')
+        self.assertEqual(tt_group(topology['1-2.2']), '1-2.2')
+        self.assertEqual(tt_group(topology['1-2.3.2']), '1-2.3')
+        # full-speed device on a root port, high-speed device behind a hub
+        self.assertEqual(tt_group([('2-1', 12., False), ('usb2', 12., False)]), 'usb2')
+        self.assertEqual(tt_group([('1-1.1', 480., False)] + _hs_single), 'usb1')
+        self.assertEqual(tt_group(None), None)
+
+class AdaptiveCase(unittest.TestCase):
+    """The scheduler finds the capacity of each group, and finishes sooner
+       than programming every board at once or one board at a time"""
+    def makespan(self, initial, ceiling, cost):
+        station = Station(self.capacity, .5)
+        scheduler = Scheduler(initial, ceiling, clock=lambda: station.now)
+        for port, chain in sorted(topology.items()):
+            scheduler.add(port, tt_group(chain), (tt_group(chain),) + cost)
+        return station.run(scheduler), scheduler
+
+    def runTest(self):
+        cost = session_cost(self.sample)
+        adaptive, scheduler = self.makespan(1, 8, cost)
+        all_at_once, _ = self.makespan(100, 100, cost)
+        one_at_a_time, _ = self.makespan(1, 1, cost)
+        self.assertLess(adaptive, all_at_once)
+        self.assertLess(adaptive, one_at_a_time)
+        limits = scheduler.limits()
+        self.assertEqual(limits['1-2.3'], self.capacity)
+
+class STM32Adaptive(AdaptiveCase):
+    sample, capacity = STM32Program, 2
+class PIC32Adaptive(AdaptiveCase):
+    sample, capacity = PIC32Program, 3
+
+class ThreadedRun(unittest.TestCase):
+    """run() programs every device, never running more sessions at once in
+       a group than its limit, and reports failed sessions"""
+    def runTest(self):
+        raw = unhexlify(re.sub(r'\s+', '', STM32Program.bootinfo))
+        prepared = load([gzresource(STM32Program.hexfile)]).freeze()
+        lock = threading.Lock()
+        running, peak = {}, {}
+        scheduler = Scheduler(initial=2, ceiling=2)
+        def job(group, f):
+            def run():
+                with lock:
+                    running[group] = running.get(group, 0) + 1
+                    peak[group] = max(peak.get(group, 0), running[group])
+                try:
+                    return flash(f, prepared)
+                finally:
+                    with lock:
+                        running[group] -= 1
+            return run
+        fakefiles = {}
+        for i in xrange(8):
+            group = 'hub%d' % (i % 2)
+            fakefiles[i] = FakeDevFile(raw)
+            scheduler.add(i, group, job(group, fakefiles[i]))
+        def broken():
+            raise IOError('device detached')
+        scheduler.add('broken', 'hub0', broken)
+        results = scheduler.run()
+        self.assertEqual(sorted(results), sorted(fakefiles.keys()) + ['broken'])
+        expected = [line.strip() for line in gzresource(STM32Program.capfile).xreadlines()]
+        for i, f in fakefiles.items():
+            result, error = results[i]
+            self.assertEqual(error, None)
+            self.assertEqual(f.transfers, expected)
+        self.assertTrue(isinstance(results['broken'][1], IOError))
+        self.assertEqual(peak, {'hub0': 2, 'hub1': 2})
+        self.assertEqual(scheduler.pending(), 0)
+        self.assertEqual(scheduler.running(), 0)
+
+load_tests = repeatable.make_load_tests([
+    Grouping, STM32Adaptive, PIC32Adaptive, ThreadedRun
+])
@@ -0,0 +1,121 @@
+import re, errno, ctypes, unittest
+from binascii import unhexlify
+from mikroeuhb.device import Device
+from mikroeuhb.usbfs import UsbFsDevFile, find_hid_interface
+from device import FakeDevFile, gzresource, STM32Program, PIC32Program
+import repeatable
+
+# device, configuration, interface (HID), HID class and two interrupt
+# endpoint descriptors, as read from a usbfs node
+_descriptors = unhexlify(
+    '1201000200000008341201000001010200010902290001010080320904000002030000'
+    '000921110100012222000705810340000107050103400001')
+
+class MockUsbFs(object):
+    """Stands in for usbfs.UsbFs, delivering the reports of OUT URBs to a
+       FakeDevFile and filling IN URBs with its responses. Each reap
+       completes the oldest URB in flight, so completions happen in the
+       order the host controller would give them."""
+    def __init__(self, fakefile):
+        self.fakefile = fakefile
+        self.calls = []
+        self.pending = []   # submitted URBs, in order
+        self.max_in_flight = 0
+        self.fail = None    # errno with which the next OUT URB completes
+    def open(self, path):
+        self.calls.append('open')
+        return 42
+    def descriptors(self, fd):
+        return _descriptors
+    def close(self, fd):
+        self.calls.append('close')
+    def claim(self, fd, ifno):
+        self.calls.append('claim %d' % ifno)
+    def release(self, fd, ifno):
+        self.calls.append('release %d' % ifno)
+    def disconnect(self, fd, ifno):
+        self.calls.append('disconnect %d' % ifno)
+    def connect(self, fd, ifno):
+        self.calls.append('connect %d' % ifno)
+    def submit(self, fd, urb):
+        assert(urb not in self.pending)
+        self.pending.append(urb)
+        self.max_in_flight = max(self.max_in_flight,
+                                 len([u for u in self.pending if not u.endpoint & 0x80]))
+    def discard(self, fd, urb):
+        if urb in self.pending:
+            self.pending.remove(urb)
+            urb.status = -errno.ENOENT
+            self.discarded = urb
+    def _completable(self):
+        for urb in self.pending:
+            if not urb.endpoint & 0x80:
+                return urb
+        for urb in self.pending:
+            if self.fakefile.response is not None:
+                return urb
+        return None
+    def reap(self, fd, wait=True):
+        if getattr(self, 'discarded', None) is not None:
+            urb, self.discarded = self.discarded, None
+            return ctypes.addressof(urb)
+        urb = self._completable()
+        if urb is None:
+            assert(not wait)  # the host would block forever
+            return None
+        self.pending.remove(urb)
+        if urb.endpoint & 0x80:
+            data = self.fakefile.read(64)
+            ctypes.memmove(urb.buffer, data, len(data))
+            urb.actual_length = len(data)
+        elif self.fail:
+            urb.status, self.fail = -self.fail, None
+        else:
+            self.fakefile.write(b'\x00' + ctypes.string_at(urb.buffer, urb.buffer_length))
+            urb.actual_length = urb.buffer_length
+        return ctypes.addressof(urb)
+
+class DescriptorParsing(unittest.TestCase):
+    def runTest(self):
+        self.assertEqual(find_hid_interface(_descriptors), (0, 0x81, 0x01, 64))
+        self.assertRaises(IOError, find_hid_interface, _descriptors, 1)
+        # without the OUT endpoint
+        self.assertRaises(IOError, find_hid_interface, _descriptors[:-7])
+
+class UsbFsCase(unittest.TestCase):
+    """Program a sample through the usbfs transport and check that the
+       device sees exactly the same reports as through hidraw"""
+    def runTest(self):
+        fakefile = FakeDevFile(unhexlify(re.sub(r'\s+', '', self.sample.bootinfo)))
+        fs = MockUsbFs(fakefile)
+        f = UsbFsDevFile('/dev/bus/usb/001/002', fs=fs, depth=8)
+        Device(f).program(gzresource(self.sample.hexfile), False)
+        f.close()
+        expected = [line.strip() for line in gzresource(self.sample.capfile).xreadlines()]
+        self.assertListEqual(fakefile.transfers, expected)
+        self.assertEqual(fs.max_in_flight, 8)
+        self.assertEqual(fs.calls, ['open', 'disconnect 0', 'claim 0',
+                                    'release 0', 'connect 0', 'close'])
+        self.assertEqual(fs.pending, [])
+
+class STM32UsbFs(UsbFsCase):
+    sample = STM32Program
+
+class PIC32UsbFs(UsbFsCase):
+    sample = PIC32Program
+
+class FailedUrb(unittest.TestCase):
+    """Errors of OUT URBs are raised once they are reaped, and the
+       interface is still released when closing"""
+    def runTest(self):
+        fakefile = FakeDevFile(unhexlify(re.sub(r'\s+', '', STM32Program.bootinfo)))
+        fs = MockUsbFs(fakefile)
+        f = UsbFsDevFile('/dev/bus/usb/001/002', fs=fs)
+        dev = Device(f)
+        fs.fail = errno.EPIPE
+        self.assertRaises(IOError, dev.cmd_info)
+        f.close()
+        self.assertEqual(fs.calls[-3:], ['release 0', 'connect 0', 'close'])
+
+load_tests = repeatable.make_load_tests([DescriptorParsing, STM32UsbFs, PIC32UsbFs,
+                                         FailedUrb])
@@ -0,0 +1,91 @@
+import os, re, json, shutil, tempfile, unittest
+from binascii import unhexlify
+import mikroeuhb.validate as validate
+import mikroeuhb.planner as planner
+from device import gzresource, STM32Program, PIC18Program, DSPIC33Program, PIC32Program
+import repeatable
+
+samples = [STM32Program, PIC18Program, DSPIC33Program, PIC32Program]
+
+def bootinforaw(sample):
+    return unhexlify(re.sub(r'\s+', '', sample.bootinfo))
+
+class MatrixCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.files = []
+        for sample in samples:
+            filename = os.path.join(self.dir, sample.__name__ + '.hex')
+            with open(filename, 'wb') as f:
+                f.write(gzresource(sample.hexfile).read())
+            self.files.append(filename)
+        self.profiles = [(sample.__name__, bootinforaw(sample)) for sample in samples]
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+class SamplesMatrix(MatrixCase):
+    """Each sample fits into its own device (agreeing with the planner),
+       and the same reports are produced with or without a process pool"""
+    def runTest(self):
+        reports = validate.matrix(self.files, self.profiles, processes=1)
+        self.assertEqual(len(reports), len(samples) ** 2)
+        self.assertEqual([(r['image'], r['profile']) for r in reports],
+                         [(f, name) for f in self.files for name, _ in self.profiles])
+        for sample, filename in zip(samples, self.files):
+            report = [r for r in reports if r['image'] == filename and
+                      r['profile'] == sample.__name__][0]
+            self.assertEqual(report['errors'], [])
+            plan = planner.plan(bootinforaw(sample), gzresource(sample.hexfile))
+            self.assertEqual(report['blocks'], plan.totals()['blocks'])
+            self.assertEqual(report['bytes'], plan.totals()['bytes'])
+            self.assertGreater(report['estimate'], 0)
+        # a sample for another family does not fit, or lies above the
+        # configuration data address and would be dropped
+        report = [r for r in reports if r['image'] == self.files[0] and
+                  r['profile'] == 'PIC32Program'][0]
+        self.assertEqual([p['kind'] for p in report['errors']], ['outside'])
+        report = [r for r in reports if r['image'] == self.files[0] and
+                  r['profile'] == 'PIC18Program'][0]
+        self.assertEqual(report['errors'], [])
+        self.assertEqual([p['kind'] for p in report['truncated']], ['config'])
+        self.assertTrue(report in validate.failed(reports, strict=True))
+        self.assertFalse(report in validate.failed(reports))
+        self.assertEqual(validate.matrix(self.files, self.profiles, processes=2), reports)
+        decoded = json.loads(validate.to_json(reports))
+        self.assertEqual(decoded['failed'], len(validate.failed(reports)))
+        self.assertEqual(len(validate.format_text(reports).splitlines()),
+                         1 + len(reports) + sum([len(r['errors']) + len(r['truncated'])
+                                                 for r in reports]))
+
+class ConfigTruncated(MatrixCase):
+    """Configuration data, which the bootloader drops, is reported
+       without failing"""
+    def runTest(self):
+        filename = os.path.join(self.dir, 'config.hex')
+        with open(filename, 'w') as f:
+            # PIC18 configuration words at 0x300000
+            f.write(':0400000001020304F2\n:020000040030CA\n:020000001234B8\n'
+                    ':00000001FF\n')
+        report = validate.matrix([filename], self.profiles[1:2])[0]
+        self.assertEqual(report['errors'], [])
+        self.assertEqual(report['truncated'],
+                         [{'kind': 'config', 'start': 0x300000, 'end': 0x300002}])
+        # the block at 0, and the one changed by the bootloader fix
+        self.assertEqual(report['blocks'], 2)
+
+class ParseError(MatrixCase):
+    """A file which cannot be parsed fails against every profile"""
+    def runTest(self):
+        filename = os.path.join(self.dir, 'broken.hex')
+        with open(filename, 'w') as f:
+            f.write(':0400000001020304F3\n:00000001FF\n')
+        reports = validate.matrix([filename, self.files[0]], self.profiles)
+        for report in reports[:len(self.profiles)]:
+            self.assertEqual(report['errors'][0]['kind'], 'IOError')
+        self.assertEqual(reports[len(self.profiles):],
+                         validate.matrix([self.files[0]], self.profiles))
+
+load_tests = repeatable.make_load_tests([
+    SamplesMatrix, ConfigTruncated, ParseError
+])
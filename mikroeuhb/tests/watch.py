@@ -0,0 +1,77 @@
+import os, re, time, shutil, tempfile, threading, unittest
+from binascii import unhexlify
+from mikroeuhb.device import Device, Command
+from mikroeuhb.image import Image
+from mikroeuhb.watch import Watcher
+from device import gzresource, STM32Program
+from emulator import EmulatedDevFile
+from image import hexrecords, NamedLines
+import repeatable
+
+class IncrementalProgram(unittest.TestCase):
+    """Only blocks which changed since the previous session are written"""
+    def image(self, records):
+        image = Image('last-wins').add(gzresource(STM32Program.hexfile), 'sample')
+        return image.add(NamedLines('patch', hexrecords(records)))
+    def session(self, emu, image, baseline):
+        emu.bootloadermode = False  # the device was reset
+        emu.erased = set()
+        start = len(emu.transfers)
+        kit = Device(emu).program(image, False, baseline=baseline)
+        erases = [Command.from_buf(unhexlify(t[2:])).addr
+                  for t in emu.transfers[start:]
+                  if t.startswith(b'o 0f15')]
+        return kit, erases
+    def runTest(self):
+        emu = EmulatedDevFile(unhexlify(re.sub(r'\s+', '', STM32Program.bootinfo)))
+        kit, erases = self.session(emu, self.image([(0x8020000, b'\x00')]), None)
+        self.assertEqual(len(erases), 3)   # all blocks, in three contiguous ranges
+        baseline = kit.snapshot()
+        kit, erases = self.session(emu, self.image([(0x8020000, b'\x00'),
+                                                    (0x8008010, b'\x12\x34')]), baseline)
+        self.assertEqual(erases, [0x8000])
+        # block 5 no longer contains data, so it is erased
+        kit, erases = self.session(emu, self.image([(0x8008010, b'\x12\x34')]),
+                                   kit.snapshot())
+        self.assertEqual(erases, [0x20000])
+        for blk, data in kit.blocks.items():
+            self.assertEqual(emu.flash[blk], data)
+        self.assertEqual(emu.flash[5], bytearray(b'\xff' * len(emu.flash[5])))
+
+class WatchFiles(unittest.TestCase):
+    """Check if replaced and rewritten files are noticed"""
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.paths = [os.path.join(self.dir, name) for name in ('a.hex', 'b.hex')]
+        for path in self.paths:
+            self.write(path, 'old')
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+    def write(self, path, contents):
+        with open(path + '.tmp', 'w') as f:
+            f.write(contents)
+        os.rename(path + '.tmp', path)
+    def later(self, func, *args):
+        t = threading.Timer(.3, func, args)
+        t.start()
+        return t
+    def check(self, watcher):
+        self.assertEqual(watcher.wait(timeout=.3), [])
+        t = self.later(self.write, self.paths[1], 'new contents')
+        self.assertEqual(watcher.wait(timeout=5.), [self.paths[1]])
+        t.join()
+        def rewrite():
+            with open(self.paths[0], 'a') as f:
+                f.write('more')
+        t = self.later(rewrite)
+        self.assertEqual(watcher.wait(timeout=5.), [self.paths[0]])
+        t.join()
+        watcher.close()
+    def runTest(self):
+        self.check(Watcher(self.paths, settle=.1))
+        polling = Watcher(self.paths, settle=.1, poll=.05)
+        polling.close()
+        polling.inotify = None
+        self.check(polling)
+
+load_tests = repeatable.make_load_tests([IncrementalProgram, WatchFiles])
@@ -0,0 +1,62 @@
+"""Timing models of the UHB firmware and of the USB link, used for
+   simulating devices and for estimating how long a transfer takes"""
+
+HID_interval = 1e-3
+"""Polling interval (in seconds) of the full-speed HID interrupt endpoints.
+   At most one report is transferred in each direction per interval."""
+
+class TimingProfile(object):
+    """Durations (in seconds) of the operations carried out by the firmware.
+       Erasing a block takes erase_block_time plus erase_kib_time for each
+       KiB of the block. Programming takes write_kib_time per KiB."""
+    def __init__(self, erase_block_time, erase_kib_time, write_kib_time,
+                 hid_interval=HID_interval):
+        self.erase_block_time = erase_block_time
+        self.erase_kib_time = erase_kib_time
+        self.write_kib_time = write_kib_time
+        self.hid_interval = hid_interval
+
+    def erase_time(self, nbytes, nblocks=1):
+        """Time taken to erase nblocks blocks, adding up to nbytes bytes"""
+        return nblocks * self.erase_block_time + nbytes * self.erase_kib_time / 1024.
+
+    def write_time(self, nbytes):
+        """Time taken to program nbytes bytes to the Flash memory"""
+        return nbytes * self.write_kib_time / 1024.
+
+    def __repr__(self):
+        return 'TimingProfile(%r, %r, %r, %r)' % (
+            self.erase_block_time, self.erase_kib_time,
+            self.write_kib_time, self.hid_interval)
+
+# Ballpark figures taken from datasheets of typical parts of each family.
+# They are only meant to be a starting point: calibrate them against real
+# hardware if precise estimates are needed.
+profiles = {
+    'ARM':     TimingProfile(0.012, 0.,    0.005),  # 1 KiB pages, 20 us/word
+    'STM32':   TimingProfile(0.150, 0.007, 0.004),  # 16..128 KiB sectors
+    'PIC18':   TimingProfile(0.002, 0.,    0.064),  # 64 byte rows, 2 ms/32 bytes
+    'PIC24':   TimingProfile(0.020, 0.,    0.004),  # 1.5 ms per 128-instruction row
+    'PIC32':   TimingProfile(0.020, 0.,    0.004),  # 4 KiB pages, 2 ms per 512 bytes
+    'PIC32MZ': TimingProfile(0.020, 0.,    0.004),  # 16 KiB pages
+}
+
+_family = {
+    'STELLARIS_M3': 'ARM', 'STELLARIS_M4': 'ARM', 'STELLARIS': 'ARM',
+    'TIVA_M4': 'ARM',
+    'STM32L1XX': 'STM32', 'STM32F1XX': 'STM32', 'STM32F2XX': 'STM32',
+    'STM32F4XX': 'STM32',
+    'PIC18FJ': 'PIC18',
+    'DSPIC': 'PIC24', 'DSPIC33': 'PIC24',
+}
+
+def family(mcu):
+    """Name of the family (key of profiles) to which a McuType belongs"""
+    return _family.get(mcu, mcu)
+
+def profile(mcu):
+    """Return the TimingProfile of a McuType"""
+    try:
+        return profiles[family(mcu)]
+    except KeyError:
+        raise KeyError('no timing profile for MCU type %s' % mcu)
@@ -0,0 +1,249 @@
+"""Transport talking to the bootloader through Linux usbfs instead of
+   hidraw. Reports are sent as interrupt URBs submitted directly to the
+   endpoints, keeping several of them in flight, so the host is not
+   limited to one blocking write() per report."""
+import os, errno, ctypes, ctypes.util, logging
+logger = logging.getLogger(__name__)
+
+def _IOC(direction, nr, size):
+    return (direction << 30) | (size << 16) | (ord('U') << 8) | nr
+
+class _Urb(ctypes.Structure):
+    """struct usbdevfs_urb (without iso_frame_desc)"""
+    _fields_ = [('type', ctypes.c_ubyte),
+                ('endpoint', ctypes.c_ubyte),
+                ('status', ctypes.c_int),
+                ('flags', ctypes.c_uint),
+                ('buffer', ctypes.c_void_p),
+                ('buffer_length', ctypes.c_int),
+                ('actual_length', ctypes.c_int),
+                ('start_frame', ctypes.c_int),
+                ('number_of_packets', ctypes.c_int),
+                ('error_count', ctypes.c_int),
+                ('signr', ctypes.c_uint),
+                ('usercontext', ctypes.c_void_p)]
+
+class _Ioctl(ctypes.Structure):
+    """struct usbdevfs_ioctl"""
+    _fields_ = [('ifno', ctypes.c_int),
+                ('ioctl_code', ctypes.c_int),
+                ('data', ctypes.c_void_p)]
+
+URB_TYPE_INTERRUPT = 1
+SUBMITURB = _IOC(2, 10, ctypes.sizeof(_Urb))
+DISCARDURB = _IOC(0, 11, 0)
+REAPURB = _IOC(1, 12, ctypes.sizeof(ctypes.c_void_p))
+REAPURBNDELAY = _IOC(1, 13, ctypes.sizeof(ctypes.c_void_p))
+CLAIMINTERFACE = _IOC(2, 15, ctypes.sizeof(ctypes.c_uint))
+RELEASEINTERFACE = _IOC(2, 16, ctypes.sizeof(ctypes.c_uint))
+IOCTL = _IOC(3, 18, ctypes.sizeof(_Ioctl))
+DISCONNECT = _IOC(0, 22, 0)
+CONNECT = _IOC(0, 23, 0)
+
+class UsbFs(object):
+    """The usbfs system calls used by UsbFsDevFile, through ctypes. Tests
+       replace it by an object with the same methods."""
+    def __init__(self):
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+
+    def _ioctl(self, fd, request, arg):
+        if self.libc.ioctl(fd, ctypes.c_ulong(request), arg) < 0:
+            err = ctypes.get_errno()
+            raise IOError(err, os.strerror(err))
+
+    def open(self, path):
+        return os.open(path, os.O_RDWR)
+
+    def descriptors(self, fd):
+        """Return the device descriptor followed by the configuration ones"""
+        os.lseek(fd, 0, os.SEEK_SET)
+        return os.read(fd, 4096)
+
+    def close(self, fd):
+        os.close(fd)
+
+    def claim(self, fd, ifno):
+        self._ioctl(fd, CLAIMINTERFACE, ctypes.byref(ctypes.c_uint(ifno)))
+
+    def release(self, fd, ifno):
+        self._ioctl(fd, RELEASEINTERFACE, ctypes.byref(ctypes.c_uint(ifno)))
+
+    def _driver_ioctl(self, fd, ifno, code):
+        try:
+            self._ioctl(fd, IOCTL, ctypes.byref(_Ioctl(ifno, code, None)))
+        except IOError as err:
+            if err.errno != errno.ENODATA:  # no driver bound
+                raise
+
+    def disconnect(self, fd, ifno):
+        """Detach the kernel driver (usbhid) from the interface"""
+        self._driver_ioctl(fd, ifno, DISCONNECT)
+
+    def connect(self, fd, ifno):
+        """Let the kernel bind a driver to the interface again"""
+        self._driver_ioctl(fd, ifno, CONNECT)
+
+    def submit(self, fd, urb):
+        self._ioctl(fd, SUBMITURB, ctypes.byref(urb))
+
+    def reap(self, fd, wait=True):
+        """Return the address of a completed URB. If wait is False and no
+           URB is complete, return None instead of blocking."""
+        addr = ctypes.c_void_p()
+        try:
+            self._ioctl(fd, REAPURB if wait else REAPURBNDELAY, ctypes.byref(addr))
+        except IOError as err:
+            if err.errno == errno.EAGAIN and not wait:
+                return None
+            raise
+        return addr.value
+
+    def discard(self, fd, urb):
+        try:
+            self._ioctl(fd, DISCARDURB, ctypes.byref(urb))
+        except IOError as err:
+            if err.errno != errno.EINVAL:  # already completed
+                raise
+
+def find_hid_interface(descriptors, interface=None):
+    """Find a HID interface with interrupt IN and OUT endpoints in raw USB
+       descriptors. Returns an (interface number, IN endpoint address, OUT
+       endpoint address, max packet size) tuple, or raises IOError."""
+    desc = bytearray(descriptors)
+    pos, current, found = 0, None, {}
+    while pos + 2 <= len(desc) and desc[pos] >= 2:
+        length, kind = desc[pos], desc[pos+1]
+        if kind == 4 and length >= 9:       # interface
+            ifno, alt, cls = desc[pos+2], desc[pos+3], desc[pos+5]
+            current = None
+            if cls == 3 and alt == 0 and interface in (None, ifno):
+                current = found.setdefault(ifno, {})
+        elif kind == 5 and length >= 7 and current is not None:   # endpoint
+            addr, attrs = desc[pos+2], desc[pos+3]
+            if attrs & 3 == 3:   # interrupt
+                current['in' if addr & 0x80 else 'out'] = addr
+                current['size'] = desc[pos+4] | (desc[pos+5] << 8)
+        pos += length
+    for ifno in sorted(found):
+        eps = found[ifno]
+        if 'in' in eps and 'out' in eps:
+            return ifno, eps['in'], eps['out'], eps['size']
+    raise IOError(errno.ENODEV, 'no HID interface with interrupt IN and OUT endpoints')
+
+class UsbFsDevFile(object):
+    """File-like object exchanging HID reports with a device through its
+       usbfs node (/dev/bus/usb/BBB/DDD), usable in place of a hidraw file
+       by device.Device. The kernel driver is detached from the interface
+       while it is claimed, and attached again by close().
+
+       write() submits an interrupt-OUT URB and returns at once, unless
+       depth URBs are already in flight. Completions are reaped in batches
+       whenever a free URB or a report from the device is needed. Since
+       the host controller processes URBs of an endpoint in order, reports
+       still reach the device in the order they were written."""
+    def __init__(self, path, fs=None, depth=16, interface=None):
+        self.name = path
+        self.fs = fs or UsbFs()
+        self.fd = self.fs.open(path)
+        try:
+            self.ifno, ep_in, ep_out, size = find_hid_interface(
+                self.fs.descriptors(self.fd), interface)
+            self.fs.disconnect(self.fd, self.ifno)
+            self.fs.claim(self.fd, self.ifno)
+        except:
+            self.fs.close(self.fd)
+            raise
+        self._urbs = {}  # URB address -> (URB, buffer)
+        self._free = [self._urb(ep_out, size) for i in xrange(depth)]
+        self._in = self._urb(ep_in, size)
+        self._in_pending = False
+        self._received = []
+        self.in_flight = 0  # OUT URBs submitted and not yet reaped
+
+    def _urb(self, endpoint, size):
+        buf = ctypes.create_string_buffer(size)
+        urb = _Urb(type=URB_TYPE_INTERRUPT, endpoint=endpoint,
+                   buffer=ctypes.cast(buf, ctypes.c_void_p), buffer_length=size)
+        self._urbs[ctypes.addressof(urb)] = (urb, buf)
+        return urb
+
+    def _complete(self, addr):
+        urb, buf = self._urbs[addr]
+        if urb.endpoint & 0x80:
+            self._in_pending = False
+            if urb.status == 0:
+                self._received.append(buf.raw[:urb.actual_length])
+        else:
+            self._free.append(urb)
+            self.in_flight -= 1
+        if urb.status != 0:
+            raise IOError(-urb.status, 'URB to endpoint 0x%02x failed: %s' % (
+                urb.endpoint, os.strerror(-urb.status)))
+
+    def _reap(self):
+        """Wait for a URB to complete, then reap every other URB which
+           already completed"""
+        addr = self.fs.reap(self.fd, True)
+        while addr is not None:
+            self._complete(addr)
+            addr = self.fs.reap(self.fd, False)
+
+    def _submit_in(self):
+        if not self._in_pending:
+            self._in.status = self._in.actual_length = 0
+            self.fs.submit(self.fd, self._in)
+            self._in_pending = True
+
+    def write(self, buf):
+        """Send a report, given as in hidraw (the first byte is the report
+           number, which must be zero)"""
+        data = buf[1:]
+        while not self._free:
+            self._reap()
+        urb = self._free.pop()
+        urbbuf = self._urbs[ctypes.addressof(urb)][1]
+        assert(len(data) <= len(urbbuf))
+        ctypes.memmove(urbbuf, bytes(data), len(data))
+        urb.buffer_length = len(data)
+        urb.status = urb.actual_length = 0
+        self.fs.submit(self.fd, urb)
+        self.in_flight += 1
+        return len(buf)
+
+    def read(self, size):
+        """Wait for a report from the device. An IN URB is kept pending
+           from then on, so the next report is received as soon as the
+           device sends it."""
+        self._submit_in()
+        while not self._received:
+            self._reap()
+        self._submit_in()
+        return self._received.pop(0)[:size]
+
+    def flush(self):
+        """Wait until every report written was delivered"""
+        while self.in_flight:
+            self._reap()
+
+    def fileno(self):
+        return self.fd
+
+    def close(self):
+        if self.fd is None:
+            return
+        try:
+            try:
+                self.flush()
+            finally:
+                if self._in_pending:
+                    self.fs.discard(self.fd, self._in)
+                    try:
+                        while self._in_pending:
+                            self._reap()
+                    except IOError:
+                        pass  # the discarded URB completes with ENOENT
+                self.fs.release(self.fd, self.ifno)
+                self.fs.connect(self.fd, self.ifno)
+        finally:
+            self.fs.close(self.fd)
+            self.fd = None
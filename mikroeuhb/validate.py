@@ -0,0 +1,107 @@
+"""Batch validation of hex files against the bootinfo of several devices,
+without any device attached (e.g. as a continuous integration gate).
+Each hex file is parsed once, and checked against every bootinfo
+profile: against the memory map of the device, by building the devkit
+model and fixing the bootloader, and by planning the transfer, to count
+the blocks touched and estimate how long programming would take."""
+import json, multiprocessing
+import devkit, planner, timing
+from bootinfo import BootInfo
+from image import prepare
+
+def _problems(problems):
+    return [{'kind': p.kind, 'start': p.start, 'end': p.end} for p in problems]
+
+def check(bootinforaw, image, profile=None):
+    """Check an image.PreparedImage (or image.Image) against the raw
+       BootInfo of a device. Returns a dictionary with the McuType, the
+       fatal problems found (errors), the configuration data and padding
+       bytes which would be dropped (truncated), the number of blocks and
+       bytes which would be written, and the estimated duration of the
+       session (using the supplied timing.TimingProfile, or that of the
+       MCU family)."""
+    mcu = BootInfo(bootinforaw)['McuType']
+    report = {'mcu': mcu, 'errors': [], 'truncated': [], 'blocks': 0,
+              'bytes': 0, 'estimate': None}
+    try:
+        plan = planner.plan(bootinforaw, image)
+    except devkit.ImageError as err:
+        report['errors'] = _problems(err.problems)
+        return report
+    except Exception as err:
+        report['errors'] = [{'kind': type(err).__name__, 'message': str(err)}]
+        return report
+    report['truncated'] = _problems(plan.kit.problems)
+    totals = plan.totals()
+    report['blocks'], report['bytes'] = totals['blocks'], totals['bytes']
+    try:
+        report['estimate'] = plan.estimate(profile or timing.profile(mcu))
+    except KeyError:
+        pass
+    return report
+
+def _check_file(task):
+    """Parse a hex file and check it against a list of (name, raw BootInfo)
+       profiles, returning a report for each profile"""
+    filename, profiles, policy = task
+    try:
+        image = prepare([filename], policy)
+    except (EnvironmentError, ValueError) as err:
+        error = {'kind': type(err).__name__, 'message': str(err)}
+        return [{'image': filename, 'profile': name, 'mcu': BootInfo(raw)['McuType'],
+                 'errors': [error], 'truncated': [], 'blocks': 0, 'bytes': 0,
+                 'estimate': None} for name, raw in profiles]
+    return [dict(check(raw, image), image=filename, profile=name)
+            for name, raw in profiles]
+
+def matrix(filenames, profiles, processes=None, policy='error'):
+    """Check every hex file against every (name, raw BootInfo) profile,
+       using a pool of processes (as many as CPUs by default, or none if
+       processes is 1). Each file is parsed once, by the process checking
+       it against all of the profiles. Returns the reports of check(), with
+       image and profile keys added, ordered by file and then by profile."""
+    tasks = [(filename, list(profiles), policy) for filename in filenames]
+    if processes == 1 or len(tasks) < 2:
+        results = map(_check_file, tasks)
+    else:
+        pool = multiprocessing.Pool(processes)
+        try:
+            results = pool.map(_check_file, tasks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    return [report for reports in results for report in reports]
+
+def failed(reports, strict=False):
+    """Reports with fatal problems (or, if strict, also with configuration
+       data or padding bytes which would be dropped, e.g. because the
+       image was built for another family and lies above
+       config_data_addr)"""
+    return [report for report in reports
+            if report['errors'] or (strict and report['truncated'])]
+
+def format_text(reports):
+    """Return the reports as a human-readable table, followed by the
+       problems found"""
+    lines = ['%-30s %-16s %-12s %6s %9s %9s' % ('image', 'profile', 'mcu',
+                                              'blocks', 'time', 'status')]
+    for r in reports:
+        status = 'FAIL' if r['errors'] else (
+            'truncated' if r['truncated'] else 'ok')
+        estimate = '-' if r['estimate'] is None else '%.3fs' % r['estimate']
+        lines.append('%-30s %-16s %-12s %6d %9s %9s' % (
+            r['image'], r['profile'], r['mcu'], r['blocks'], estimate, status))
+    for r in reports:
+        for p in r['errors'] + r['truncated']:
+            if 'start' in p:
+                where = '0x%x-0x%x' % (p['start'], p['end'])
+            else:
+                where = p['message']
+            lines.append('%s on %s: %s %s' % (r['image'], r['profile'],
+                                              p['kind'], where))
+    return '\n'.join(lines) + '\n'
+
+def to_json(reports, strict=False):
+    return json.dumps({'reports': reports,
+                       'failed': len(failed(reports, strict))},
+                      sort_keys=True)
@@ -0,0 +1,122 @@
+"""Waiting for files to change (e.g. hex files rebuilt by a compiler)"""
+import os, sys, time, errno, select, struct, logging
+logger = logging.getLogger(__name__)
+
+class _Inotify(object):
+    """Minimal ctypes binding to the Linux inotify API"""
+    IN_CLOSE_WRITE = 0x008
+    IN_MOVED_TO = 0x080
+    IN_CREATE = 0x100
+    _event = struct.Struct('iIII')
+
+    def __init__(self):
+        import ctypes, ctypes.util
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init()
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        self.dirs = {}  # watch descriptor -> directory
+
+    def add_watch(self, directory, mask):
+        wd = self.libc.inotify_add_watch(self.fd, directory.encode(sys.getfilesystemencoding()), mask)
+        if wd < 0:
+            raise OSError('cannot watch %s' % directory)
+        self.dirs[wd] = directory
+
+    def read(self, timeout):
+        """Return the paths of the files for which events were received
+           until timeout (in seconds, or None to block)"""
+        try:
+            ready, _, _ = select.select([self.fd], [], [], timeout)
+        except select.error as err:
+            if err.args[0] == errno.EINTR:
+                return []
+            raise
+        if not ready:
+            return []
+        buf = os.read(self.fd, 65536)
+        paths, pos = [], 0
+        while pos < len(buf):
+            wd, mask, cookie, length = self._event.unpack_from(buf, pos)
+            pos += self._event.size
+            name = buf[pos:pos+length].rstrip(b'\x00').decode(sys.getfilesystemencoding())
+            pos += length
+            if wd in self.dirs:
+                paths.append(os.path.join(self.dirs[wd], name))
+        return paths
+
+    def close(self):
+        os.close(self.fd)
+
+def _stat(path):
+    try:
+        st = os.stat(path)
+        return st.st_mtime, st.st_size, st.st_ino
+    except OSError:
+        return None
+
+class Watcher(object):
+    """Waits for any of a list of files to change. Uses inotify if
+       available (watching their directories, so that files replaced by
+       renaming are also noticed), otherwise polls their modification
+       times every poll seconds."""
+    def __init__(self, paths, settle=.2, poll=.5):
+        self.paths = [os.path.abspath(path) for path in paths]
+        self.settle, self.poll = settle, poll
+        self.stats = dict([(path, _stat(path)) for path in self.paths])
+        self.inotify = None
+        if sys.platform.startswith('linux'):
+            try:
+                self.inotify = _Inotify()
+                for directory in set([os.path.dirname(path) for path in self.paths]):
+                    self.inotify.add_watch(directory, _Inotify.IN_CLOSE_WRITE |
+                                           _Inotify.IN_MOVED_TO | _Inotify.IN_CREATE)
+            except (OSError, AttributeError) as err:
+                logger.info('inotify unavailable (%s) -- polling instead' % err)
+                self.inotify = None
+
+    def _changed(self):
+        """Return the paths whose stat changed since the last call"""
+        changed = []
+        for path in self.paths:
+            st = _stat(path)
+            if st != self.stats[path]:
+                self.stats[path] = st
+                if st is not None:
+                    changed.append(path)
+        return changed
+
+    def _wait_event(self, timeout):
+        """Wait until some event possibly concerning the files happens"""
+        if self.inotify:
+            return any([path in self.paths for path in self.inotify.read(timeout)])
+        time.sleep(min(self.poll, timeout) if timeout is not None else self.poll)
+        return True
+
+    def wait(self, timeout=None):
+        """Wait for files to change, returning the list of changed paths
+           (empty if timeout seconds elapsed). Once a change is noticed,
+           waits until the files stay unchanged for settle seconds, so
+           that files still being written by a compiler are not read."""
+        deadline = None if timeout is None else time.time() + timeout
+        changed = set()
+        while True:
+            remaining = None if deadline is None else max(0., deadline - time.time())
+            if self._wait_event(remaining):
+                changed.update(self._changed())
+            if changed:
+                break
+            if deadline is not None and time.time() >= deadline:
+                return []
+        while True:
+            time.sleep(self.settle)
+            more = self._changed()
+            if not more:
+                break
+            changed.update(more)
+        return sorted(changed)
+
+    def close(self):
+        if self.inotify:
+            self.inotify.close()